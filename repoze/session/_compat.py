@@ -6,6 +6,10 @@ PY2 = not PY3
 if PY3: #pragma NO COVER Py3k
 
     import pickle
+    from io import StringIO
+    from http.cookies import SimpleCookie
+
+    text_type = str
 
     def get_code(method):
         return method.__code__
@@ -13,6 +17,10 @@ if PY3: #pragma NO COVER Py3k
 else: #pragma NO COVER Python 2
 
     import cPickle as pickle
+    from StringIO import StringIO
+    from Cookie import SimpleCookie
+
+    text_type = unicode
 
     def get_code(method):
         return method.im_func.func_code
@@ -0,0 +1,159 @@
+""" An asyncio facade for session access (Python 3.5+ only).
+
+ZODB connections block, and both they and their transactions belong
+to a single thread.  :class:`AsyncSessionManager` therefore runs all
+ZODB work for a session manager factory on a bounded set of worker
+threads, each of which holds one connection open for its lifetime, and
+hands them out one at a time to coroutines::
+
+  sessions = AsyncSessionManager(factory, workers=4)
+
+  async def handle(key):
+      async with sessions.session() as session:
+          data = await session.get(key)
+          data['hits'] = data.get('hits', 0) + 1
+          await session.commit()
+
+Session data objects returned by a session must only be used until the
+``async with`` block exits; anything not committed by then is aborted.
+"""
+import asyncio
+import concurrent.futures
+import sys
+
+import transaction
+
+from repoze.session.manager import ConnectionManager
+
+class _Worker(object):
+    """ A single thread owning a ZODB connection and the session
+    manager loaded through it. """
+    def __init__(self, factory, name):
+        self.factory = factory
+        kw = {}
+        if sys.version_info >= (3, 6): # pragma: no branch
+            kw['thread_name_prefix'] = name
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, **kw)
+        self.cm = ConnectionManager()
+        self.manager = None
+
+    # the methods below run in the worker thread
+
+    def begin(self):
+        if self.manager is None:
+            # opens the connection in this thread, using its
+            # (thread-local) default transaction manager
+            self.manager = self.factory(self.cm)
+        # start a fresh transaction, which also brings the connection
+        # up to date with changes committed by other connections
+        transaction.begin()
+
+    def get(self, key):
+        return self.manager.get(key)
+
+    def query(self, key, default=None):
+        return self.manager.query(key, default)
+
+    def commit(self):
+        transaction.commit()
+
+    def abort(self):
+        transaction.abort()
+
+    def close(self):
+        transaction.abort()
+        if self.manager is not None:
+            self.manager = None
+            self.cm.close()
+
+class AsyncSession(object):
+    """ Exclusive use of one worker (and so of one ZODB connection and
+    transaction) for the duration of an ``async with`` block. """
+    def __init__(self, manager):
+        self._manager = manager
+        self._worker = None
+
+    async def __aenter__(self):
+        self._worker = await self._manager._acquire()
+        try:
+            await self._run('begin')
+        except:
+            self._manager._release(self._worker)
+            self._worker = None
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        worker, self._worker = self._worker, None
+        try:
+            await self._manager._run(worker, worker.abort)
+        finally:
+            self._manager._release(worker)
+
+    def _run(self, name, *args):
+        # check before looking up the worker's method, so that using
+        # an inactive session raises RuntimeError
+        worker = self._worker
+        if worker is None:
+            raise RuntimeError('Session is not active')
+        return self._manager._run(worker, getattr(worker, name), *args)
+
+    async def get(self, key):
+        """ See :meth:`repoze.session.interfaces.ISessionDataManager.get`.
+        """
+        return await self._run('get', key)
+
+    async def query(self, key, default=None):
+        """ See :meth:`repoze.session.interfaces.ISessionDataManager.query`.
+        """
+        return await self._run('query', key, default)
+
+    async def commit(self):
+        """ Commit the session's transaction; a new one is started. """
+        await self._run('commit')
+
+    async def abort(self):
+        """ Abort the session's transaction; a new one is started. """
+        await self._run('abort')
+
+class AsyncSessionManager(object):
+    """ Run the session manager produced by ``factory`` (e.g. a
+    :class:`repoze.session.manager.FileStorageSessionManagerFactory`)
+    on ``workers`` threads, each with its own ZODB connection.  At most
+    ``workers`` sessions are active at once; others wait for a free
+    worker without blocking the event loop.  An instance must only be
+    used from one event loop."""
+    def __init__(self, factory, workers=4):
+        if workers < 1:
+            raise ValueError('workers must be at least 1, not %r' % workers)
+        self.factory = factory
+        self._workers = [_Worker(factory, 'repoze.session.aio-%d' % i)
+                         for i in range(workers)]
+        self._idle = None
+
+    def session(self):
+        """ Return an :class:`AsyncSession` to be used with
+        ``async with``. """
+        return AsyncSession(self)
+
+    async def _acquire(self):
+        if self._idle is None:
+            # created lazily so that it belongs to the running loop
+            self._idle = asyncio.Queue()
+            for worker in self._workers:
+                self._idle.put_nowait(worker)
+        return await self._idle.get()
+
+    def _release(self, worker):
+        self._idle.put_nowait(worker)
+
+    def _run(self, worker, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(worker.executor, func, *args)
+
+    def close(self):
+        """ Close every worker's connection and stop its thread. """
+        for worker in self._workers:
+            worker.executor.submit(worker.close).result()
+            worker.executor.shutdown()
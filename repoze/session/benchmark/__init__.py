@@ -0,0 +1 @@
+# i am a package
@@ -0,0 +1,457 @@
+""" A conflict load generator for the ZODB session manager.
+
+Each scenario populates a session manager with ``sessions`` sessions,
+then starts ``workers`` workers replaying a traffic mix against it:
+
+``new``
+  ``get`` a session nobody has used yet and set a key in it.
+
+``read``
+  ``query`` an existing session and read a key (which copies it
+  forward when it lives in an older bucket).
+
+``write``
+  ``get`` an existing session and set a key in it.
+
+``invalidate``
+  ``query`` an existing session and invalidate it.
+
+Existing sessions are picked by a key popularity distribution: every
+session equally often (``uniform``), or by a Zipf law (``zipf``),
+where the ``n``-th most popular session is picked in proportion to
+``1 / n ** skew``.  Each unit of work is committed after ``think``
+seconds and retried up to ``retries`` times after a conflict.
+
+With the ``zeo`` storage, a ZEO server is started on a temporary
+``FileStorage`` and the workers are processes, each with its own
+:class:`ZEOSessionManagerFactory`.  This needs ZEO 5 or later (for
+``ZEO.server``) and Python 3.4 or later (to spawn the worker
+processes instead of forking the one running the server).
+A ``FileStorage`` can only be opened by one process, so with the
+``file`` storage the workers are threads sharing one
+:class:`FileStorageSessionManagerFactory`.
+
+It reports units of work committed per second, how many conflicts
+were raised on the session manager itself (its ring of buckets), on
+its buckets and on the sessions, and how many units needed how many
+retries.  Run it before and after changing a ``_p_resolveConflict``::
+
+  python -m repoze.session.benchmark.conflicts --help
+"""
+import bisect
+import multiprocessing
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import transaction
+from ZODB.POSException import ConflictError
+
+from repoze.session.benchmark.hotpaths import BUCKET_TYPES
+from repoze.session.benchmark.hotpaths import make_key
+from repoze.session.benchmark.hotpaths import timer
+from repoze.session.manager import FileStorageSessionManagerFactory
+from repoze.session.manager import ZEOSessionManagerFactory
+
+STORAGES = ('file', 'zeo')
+OPERATIONS = ('new', 'read', 'write', 'invalidate')
+POPULARITIES = ('uniform', 'zipf')
+KINDS = ('manager', 'bucket', 'session', 'other')
+
+APPNAME = 'sessions'
+
+_KIND_BY_CLASS = {
+    'SessionDataManager': 'manager',
+    'ShardedSessionDataManager': 'manager',
+    'OOBTree': 'bucket',
+    'OOBucket': 'bucket',
+    'LOBTree': 'bucket',
+    'LOBucket': 'bucket',
+    'MergingBucket': 'bucket',
+    'PartitionedBucket': 'bucket',
+    'AppendOnlyDict': 'bucket',
+    'SessionData': 'session',
+    'CompressedSessionData': 'session',
+    }
+
+def conflict_kind(class_name):
+    """ Return the kind of object (one of ``KINDS``) a conflict error
+    was raised on, given the error's class name. """
+    if not class_name:
+        return 'other'
+    return _KIND_BY_CLASS.get(class_name.split('.')[-1], 'other')
+
+def conflict_class_name(error, manager=None):
+    """ Return the class name of the object a conflict error was raised
+    on.  Read conflicts only carry the object's oid; its class is then
+    looked up in the connection of ``manager``, if given. """
+    class_name = error.get_class_name()
+    if not class_name and error.oid is not None and manager is not None:
+        try:
+            klass = manager._p_jar.get(error.oid).__class__
+        except Exception:
+            return ''
+        class_name = '%s.%s' % (klass.__module__, klass.__name__)
+    return class_name or ''
+
+def parse_mix(value):
+    """ Parse a traffic mix such as ``new=1,read=6,write=3`` into a
+    dict of operation weights. """
+    mix = {}
+    for part in value.split(','):
+        if not part:
+            continue
+        operation, weight = part.split('=')
+        if operation not in OPERATIONS:
+            raise ValueError('Unknown operation %r' % operation)
+        mix[operation] = float(weight)
+    if not sum(mix.values()) > 0:
+        raise ValueError('Empty traffic mix %r' % value)
+    return mix
+
+class Chooser(object):
+    """ Pick items at random in proportion to their weights. """
+    def __init__(self, items, weights):
+        self.items = list(items)
+        self.cumulative = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self.cumulative.append(total)
+        self.total = total
+
+    def choose(self, rng):
+        i = bisect.bisect_right(self.cumulative, rng.random() * self.total)
+        return self.items[min(i, len(self.items) - 1)]
+
+def popularity_chooser(popularity, sessions, skew=1.0):
+    """ Return a :class:`Chooser` of session numbers under the named
+    key popularity distribution. """
+    if popularity == 'uniform':
+        weights = [1.0] * sessions
+    elif popularity == 'zipf':
+        weights = [1.0 / (n ** skew) for n in range(1, sessions + 1)]
+    else:
+        raise ValueError('Unknown popularity %r' % popularity)
+    return Chooser(range(sessions), weights)
+
+class LoadResult(object):
+    """ The outcome of a :class:`LoadScenario` run, or of one of its
+    workers. """
+    def __init__(self):
+        self.units = 0        # units of work committed
+        self.failures = 0     # units given up after too many conflicts
+        self.conflicts = {}   # class name -> conflicts raised
+        self.retries = {}     # retries needed -> committed units
+        self.operations = {}  # operation -> committed units
+        self.elapsed = 0.0
+
+    def add(self, other):
+        """ Add the counts of ``other``, a worker's result, to this
+        one; the elapsed time is the slowest worker's. """
+        self.units += other.units
+        self.failures += other.failures
+        for counts, others in ((self.conflicts, other.conflicts),
+                               (self.retries, other.retries),
+                               (self.operations, other.operations)):
+            for k, count in others.items():
+                counts[k] = counts.get(k, 0) + count
+        self.elapsed = max(self.elapsed, other.elapsed)
+
+    @property
+    def units_per_sec(self):
+        if not self.elapsed:
+            return 0.0
+        return self.units / self.elapsed
+
+    @property
+    def conflict_count(self):
+        return sum(self.conflicts.values())
+
+    @property
+    def conflict_rate(self):
+        attempts = self.units + self.conflict_count
+        if not attempts:
+            return 0.0
+        return float(self.conflict_count) / attempts
+
+    @property
+    def conflicts_by_kind(self):
+        kinds = dict.fromkeys(KINDS, 0)
+        for class_name, count in self.conflicts.items():
+            kinds[conflict_kind(class_name)] += count
+        return kinds
+
+class LoadScenario(object):
+    """ ``workers`` workers, each doing ``ops`` units of work drawn
+    from the traffic ``mix`` (a dict of operation weights) against a
+    session manager holding ``sessions`` sessions, picked by the
+    ``popularity`` distribution.  ``timeout``, ``period`` and
+    ``bucket_type`` (a name in
+    ``repoze.session.benchmark.hotpaths.BUCKET_TYPES``) configure the
+    session manager."""
+    def __init__(self, storage='file', sessions=1000, workers=4, ops=200,
+                 mix=None, popularity='uniform', skew=1.0,
+                 bucket_type='oobtree', think=0.001, retries=5,
+                 timeout=1200, period=20):
+        self.storage = storage
+        self.sessions = sessions
+        self.workers = workers
+        self.ops = ops
+        if mix is None:
+            mix = {'new': 1, 'read': 6, 'write': 3}
+        self.mix = mix
+        self.popularity = popularity
+        self.skew = skew
+        self.bucket_type = bucket_type
+        self.think = think
+        self.retries = retries
+        self.timeout = timeout
+        self.period = period
+
+    def describe(self):
+        mix = ','.join(['%s=%g' % (operation, self.mix[operation])
+                        for operation in OPERATIONS
+                        if operation in self.mix])
+        popularity = self.popularity
+        if popularity == 'zipf':
+            popularity = 'zipf(%g)' % self.skew
+        return '%s/%s sessions=%d workers=%d mix=%s keys=%s' % (
+            self.storage, self.bucket_type, self.sessions, self.workers,
+            mix, popularity)
+
+    def run(self):
+        """ Run the workers; return a :class:`LoadResult`. """
+        if self.storage not in STORAGES:
+            raise ValueError('Unknown storage type %r' % self.storage)
+        if self.storage == 'zeo':
+            reason = zeo_unsupported()
+            if reason is not None:
+                raise RuntimeError(reason)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            if self.storage == 'zeo':
+                return self._run_zeo(tmpdir)
+            return self._run_file(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _run_file(self, tmpdir):
+        factory = FileStorageSessionManagerFactory(
+            os.path.join(tmpdir, 'sessions.fs'), APPNAME, self.timeout,
+            self.period, bucket_type=BUCKET_TYPES[self.bucket_type],
+            pooled=True, pool_size=self.workers + 1)
+        try:
+            self.populate(factory)
+            result = LoadResult()
+            lock = threading.Lock()
+            def work(n):
+                try:
+                    worker_result = self.work(factory, n)
+                finally:
+                    factory.close_thread_connection()
+                with lock:
+                    result.add(worker_result)
+            threads = [threading.Thread(target=work, args=(i,))
+                       for i in range(self.workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return result
+        finally:
+            transaction.abort()
+            factory.db.close()
+
+    def _run_zeo(self, tmpdir):
+        import ZEO
+        address, stop = ZEO.server(os.path.join(tmpdir, 'sessions.fs'))
+        try:
+            factory = self.zeo_factory(address)
+            try:
+                self.populate(factory)
+            finally:
+                transaction.abort()
+                factory.db.close()
+            # the server runs in a thread of this process, which forked
+            # workers would inherit
+            pool = multiprocessing.get_context('spawn').Pool(self.workers)
+            try:
+                worker_results = pool.map(
+                    _work_in_process,
+                    [(self, address, i) for i in range(self.workers)])
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            stop()
+        result = LoadResult()
+        for worker_result in worker_results:
+            result.add(worker_result)
+        return result
+
+    def zeo_factory(self, address):
+        return ZEOSessionManagerFactory(
+            address, APPNAME, self.timeout, self.period,
+            bucket_type=BUCKET_TYPES[self.bucket_type], pooled=True)
+
+    def populate(self, factory):
+        with factory.session_manager() as manager:
+            for i in range(self.sessions):
+                manager.get(make_key(i))['n'] = i
+                if i % 1000 == 999:
+                    transaction.commit()
+            transaction.commit()
+
+    def work(self, factory, n):
+        """ Do worker ``n``'s units of work with sessions from
+        ``factory``; return a :class:`LoadResult`. """
+        rng = random.Random(n)
+        operations = Chooser(list(self.mix), list(self.mix.values()))
+        keys = popularity_chooser(self.popularity, self.sessions,
+                                  self.skew)
+        result = LoadResult()
+        begin = timer()
+        for i in range(self.ops):
+            operation = operations.choose(rng)
+            if operation == 'new':
+                key = make_key('new-%d-%d' % (n, i))
+            else:
+                key = make_key(keys.choose(rng))
+            for attempt in range(self.retries + 1):
+                manager = None
+                try:
+                    with factory.session_manager() as manager:
+                        self.do(manager, operation, key, (n, i))
+                        time.sleep(self.think)
+                        transaction.commit()
+                except ConflictError as e:
+                    transaction.abort()
+                    class_name = conflict_class_name(e, manager)
+                    result.conflicts[class_name] = (
+                        result.conflicts.get(class_name, 0) + 1)
+                else:
+                    result.units += 1
+                    result.retries[attempt] = (
+                        result.retries.get(attempt, 0) + 1)
+                    result.operations[operation] = (
+                        result.operations.get(operation, 0) + 1)
+                    break
+            else:
+                result.failures += 1
+        result.elapsed = timer() - begin
+        return result
+
+    def do(self, manager, operation, key, value):
+        if operation in ('new', 'write'):
+            manager.get(key)['hit'] = value
+        else:
+            session = manager.query(key)
+            if session is not None:
+                if operation == 'read':
+                    session.get('hit')
+                else:
+                    session.invalidate()
+
+def _work_in_process(args):
+    scenario, address, n = args
+    factory = scenario.zeo_factory(address)
+    try:
+        return scenario.work(factory, n)
+    finally:
+        factory.close_thread_connection()
+        factory.db.close()
+
+def report(scenario, result, out=sys.stdout):
+    out.write('%s\n' % scenario.describe())
+    out.write('%8s %8s %9s %9s %9s %9s %9s %9s\n' % (
+        'units', 'units/s', 'conflict%', 'manager', 'bucket', 'session',
+        'other', 'failures'))
+    kinds = result.conflicts_by_kind
+    out.write('%8d %8.0f %9.1f %9d %9d %9d %9d %9d\n' % (
+        result.units, result.units_per_sec, result.conflict_rate * 100,
+        kinds['manager'], kinds['bucket'], kinds['session'], kinds['other'],
+        result.failures))
+    out.write('retries: %s\n\n' % ' '.join(
+        ['%d=%d' % (retries, result.retries[retries])
+         for retries in sorted(result.retries)]))
+
+def _int_list(value):
+    return [int(x) for x in value.split(',') if x]
+
+def zeo_unsupported():
+    """ Return why the ``zeo`` storage can't be used here, or None if
+    it can. """
+    if sys.version_info < (3, 4):
+        return ('The zeo storage needs Python 3.4 or later, to spawn '
+                'its worker processes')
+    try:
+        import ZEO
+    except ImportError:
+        ZEO = None
+    if getattr(ZEO, 'server', None) is None:
+        return ('The zeo storage needs ZEO 5 or later (install '
+                'repoze.session[zeo])')
+    return None
+
+def main(argv=sys.argv, out=sys.stdout):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Generate conflicting session traffic and report '
+                    'where the conflicts are raised.')
+    parser.add_option('--storage', default='file',
+                      help='Comma-separated storages: %s (zeo needs ZEO 5 '
+                           'and Python 3.4+)' % ', '.join(STORAGES))
+    parser.add_option('--sessions', default='1000',
+                      help='Comma-separated session counts')
+    parser.add_option('--workers', default='4',
+                      help='Comma-separated worker counts')
+    parser.add_option('--ops', type='int', default=200,
+                      help='Units of work per worker')
+    parser.add_option('--mix', default='new=1,read=6,write=3',
+                      help='Traffic mix: comma-separated operation=weight '
+                           'pairs, operations being %s' % ', '.join(
+                               OPERATIONS))
+    parser.add_option('--popularity', default='uniform',
+                      help='Comma-separated key popularity distributions: '
+                           '%s' % ', '.join(POPULARITIES))
+    parser.add_option('--skew', type='float', default=1.0,
+                      help='The exponent of the zipf distribution')
+    parser.add_option('--bucket-type', default='oobtree',
+                      help='Comma-separated bucket types: %s' % ', '.join(
+                          sorted(BUCKET_TYPES)))
+    parser.add_option('--think', type='float', default=0.001,
+                      help='Seconds each unit of work waits before '
+                           'committing')
+    parser.add_option('--retries', type='int', default=5,
+                      help='Retries after a conflict before giving up')
+    parser.add_option('--timeout', type='int', default=1200,
+                      help='Session manager timeout in seconds')
+    parser.add_option('--period', type='int', default=20,
+                      help='Session manager period in seconds')
+    options, args = parser.parse_args(argv[1:])
+    mix = parse_mix(options.mix)
+    if 'zeo' in options.storage.split(','):
+        reason = zeo_unsupported()
+        if reason is not None:
+            parser.error(reason)
+
+    for storage in options.storage.split(','):
+        for bucket_type in options.bucket_type.split(','):
+            for popularity in options.popularity.split(','):
+                for sessions in _int_list(options.sessions):
+                    for workers in _int_list(options.workers):
+                        scenario = LoadScenario(
+                            storage, sessions, workers, options.ops, mix,
+                            popularity, options.skew, bucket_type,
+                            options.think, options.retries,
+                            options.timeout, options.period)
+                        report(scenario, scenario.run(), out)
+
+if __name__ == '__main__': # pragma: no cover
+    main()
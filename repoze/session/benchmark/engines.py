@@ -0,0 +1,138 @@
+""" Benchmarks comparing the session manager engines: the ZODB
+:class:`repoze.session.manager.SessionDataManager` (in a FileStorage),
+:class:`repoze.session.memory.MemorySessionDataManager` and
+:class:`repoze.session.sqlite.SQLiteSessionDataManager`.
+
+Each scenario populates an engine with ``sessions`` sessions, then
+times ``ops`` request-like units of work per workload, each including
+its commit (which is where the ZODB and SQLite engines write):
+
+``read``
+  ``get`` an existing session without changing it.
+
+``write``
+  ``get`` an existing session and set a key in it.
+
+``new``
+  ``get`` a session which does not exist yet and set a key in it.
+
+Run it as::
+
+  python -m repoze.session.benchmark.engines --help
+"""
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+
+import transaction
+
+from repoze.session.benchmark.hotpaths import Timings
+from repoze.session.benchmark.hotpaths import make_key
+from repoze.session.benchmark.hotpaths import timer
+
+ENGINES = ('zodb', 'memory', 'sqlite')
+WORKLOADS = ('read', 'write', 'new')
+
+def make_factory(engine, path, timeout, period):
+    """ Return a session manager factory for ``engine`` keeping its
+    files (if any) in the directory ``path``, and a function closing
+    it."""
+    if engine == 'zodb':
+        from repoze.session.manager import FileStorageSessionManagerFactory
+        factory = FileStorageSessionManagerFactory(
+            os.path.join(path, 'sessions.fs'), 'sessions', timeout, period,
+            pooled=True)
+        return factory, factory.db.close
+    if engine == 'memory':
+        from repoze.session.memory import MemorySessionManagerFactory
+        factory = MemorySessionManagerFactory(timeout, period)
+        return factory, lambda: None
+    if engine == 'sqlite':
+        from repoze.session.sqlite import SQLiteSessionManagerFactory
+        factory = SQLiteSessionManagerFactory(
+            os.path.join(path, 'sessions.db'), 'sessions', timeout, period)
+        return factory, factory.manager.close
+    raise ValueError('Unknown engine %r' % engine)
+
+class Scenario(object):
+    """ One benchmark configuration. """
+    def __init__(self, engine='zodb', sessions=1000, ops=200,
+                 timeout=1200, period=20):
+        self.engine = engine
+        self.sessions = sessions
+        self.ops = ops
+        self.timeout = timeout
+        self.period = period
+
+    def describe(self):
+        return '%s sessions=%d' % (self.engine, self.sessions)
+
+    def run(self):
+        """ Run every workload; return a mapping of workload to
+        :class:`repoze.session.benchmark.hotpaths.Timings`."""
+        tmpdir = tempfile.mkdtemp()
+        factory, close = make_factory(self.engine, tmpdir, self.timeout,
+                                      self.period)
+        try:
+            return self._run(factory)
+        finally:
+            transaction.abort()
+            close()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _run(self, factory):
+        for i in range(self.sessions):
+            factory().get(make_key(i))['n'] = i
+            if i % 1000 == 999:
+                transaction.commit()
+        transaction.commit()
+
+        results = {}
+        for workload in WORKLOADS:
+            timings = results[workload] = Timings()
+            for i in range(self.ops):
+                if workload == 'new':
+                    key = make_key('new-%d' % i)
+                else:
+                    key = make_key(i % self.sessions)
+                begin = timer()
+                sdo = factory().get(key)
+                if workload != 'read':
+                    sdo['hit'] = i
+                transaction.commit()
+                timings.add(timer() - begin, 0)
+        return results
+
+def report(scenario, results, out=sys.stdout):
+    out.write('%s\n' % scenario.describe())
+    out.write('%-8s %6s %12s %10s %10s\n' % (
+        'workload', 'n', 'ops/sec', 'p50 us', 'p99 us'))
+    for workload in WORKLOADS:
+        timings = results[workload]
+        out.write('%-8s %6d %12.0f %10.1f %10.1f\n' % (
+            workload, len(timings.samples), timings.ops_per_sec,
+            timings.p50 * 1e6, timings.p99 * 1e6))
+    out.write('\n')
+
+def main(argv=sys.argv, out=sys.stdout):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Compare session manager engines.')
+    parser.add_option('--engine', default=','.join(ENGINES),
+                      help='Comma-separated engines: %s' % ', '.join(
+                          ENGINES))
+    parser.add_option('--sessions', default='1000,10000',
+                      help='Comma-separated session counts')
+    parser.add_option('--ops', type='int', default=200,
+                      help='Units of work timed per workload')
+    options, args = parser.parse_args(argv[1:])
+
+    for engine in options.engine.split(','):
+        for sessions in [int(x) for x in options.sessions.split(',') if x]:
+            scenario = Scenario(engine, sessions, options.ops)
+            report(scenario, scenario.run(), out)
+
+if __name__ == '__main__': # pragma: no cover
+    main()
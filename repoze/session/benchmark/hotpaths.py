@@ -0,0 +1,515 @@
+""" Benchmarks for the :class:`repoze.session.manager.SessionDataManager`
+hot paths (``get``, ``query``, ``has_key``, ``search`` and
+``set_if_modified``).
+
+Each scenario populates a manager with ``sessions`` session objects
+spread evenly over ``depth`` timeslices (so the bucket chain is
+``depth`` nodes long, the same as a ``timeout / period`` ratio of
+``depth``), then times each operation against keys living in the
+newest bucket (``head``), the oldest bucket (``tail``) or in no bucket
+at all (``miss``).  Every timed operation is followed by an (untimed)
+commit so that the number of pickle bytes written per commit can be
+reported; this is where copy-forward and lazy session creation show
+up.
+
+With ``--concurrency``, it instead runs threads writing to sessions
+concurrently (see :class:`ConcurrencyScenario`) and reports commits
+per second and the fraction of commits which failed with a conflict,
+which is where the bucket types differ most.
+
+Run it as::
+
+  python -m repoze.session.benchmark.hotpaths --help
+"""
+import binascii
+from contextlib import contextmanager
+import hashlib
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import transaction
+from persistent.mapping import PersistentMapping
+from ZODB.DB import DB
+from ZODB.POSException import ConflictError
+
+from repoze.session.bucket import PartitionedBucket
+from repoze.session.data import SessionData
+from repoze.session.manager import SessionDataManager
+from repoze.session.manager import timeslice
+
+timer = getattr(time, 'perf_counter', time.time)
+
+OPERATIONS = ('get', 'query', 'has_key', 'search', 'set_if_modified')
+POSITIONS = ('head', 'tail', 'miss')
+STORAGES = ('mapping', 'file')
+
+class AppendOnlyDict(PersistentMapping):
+    """ The bucket type ``SessionDataManager`` was measured against
+    when ``OOBTree`` was chosen: a single mapping record which resolves
+    every conflict by merging the keys added on both sides."""
+
+    def _p_resolveConflict(self, old, committed, new):
+        resolved = dict(new)
+        data = dict(committed['data'])
+        data.update(new['data'])
+        resolved['data'] = data
+        return resolved
+
+BUCKET_TYPES = {
+    'oobtree': None, # the manager's default
+    'appendonlydict': AppendOnlyDict,
+    'partitioned': PartitionedBucket,
+    }
+
+class Timings(object):
+    """ A set of latency samples (in seconds) for one operation. """
+    def __init__(self):
+        self.samples = []
+        self.bytes_written = []
+
+    def add(self, elapsed, written):
+        self.samples.append(elapsed)
+        self.bytes_written.append(written)
+
+    @property
+    def ops_per_sec(self):
+        total = sum(self.samples)
+        if not total:
+            return 0.0
+        return len(self.samples) / total
+
+    @property
+    def p50(self):
+        return percentile(self.samples, 0.50)
+
+    @property
+    def p99(self):
+        return percentile(self.samples, 0.99)
+
+    @property
+    def bytes_per_commit(self):
+        if not self.bytes_written:
+            return 0.0
+        return float(sum(self.bytes_written)) / len(self.bytes_written)
+
+def percentile(samples, fraction):
+    """ Return the nearest-rank percentile of ``samples``. """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+def make_key(i):
+    return binascii.hexlify(hashlib.md5(str(i).encode('ascii')).digest())
+
+def open_storage(kind, path):
+    if kind == 'mapping':
+        from ZODB.MappingStorage import MappingStorage
+        return MappingStorage()
+    if kind == 'file':
+        from ZODB.FileStorage.FileStorage import FileStorage
+        return FileStorage(os.path.join(path, 'sessions.fs'))
+    raise ValueError('Unknown storage type %r' % kind)
+
+def bytes_committed(storage, last_tid):
+    """ Return the number of data bytes written to ``storage`` by the
+    transaction committed since ``last_tid``."""
+    tid = storage.lastTransaction()
+    if tid == last_tid:
+        return 0
+    written = 0
+    for txn in storage.iterator(tid, tid):
+        for record in txn:
+            if record.data:
+                written += len(record.data)
+    return written
+
+@contextmanager
+def pinned_clock(when=None):
+    """ Make ``time.time`` return ``when`` (by default, the time on
+    entry) until the block exits, so that no timeslice boundary passes
+    while a scenario runs: the manager methods which take no 'when'
+    argument read the clock, and a head rotation in the middle of a
+    scenario would skew its results."""
+    if when is None:
+        when = time.time()
+    wall_clock = time.time
+    time.time = lambda: when
+    try:
+        yield when
+    finally:
+        time.time = wall_clock
+
+def make_manager(bucket_type, timeout, period, when, **kw):
+    """ Return a session manager using the named bucket type. """
+    return SessionDataManager(timeout, period, when,
+                              bucket_type=BUCKET_TYPES[bucket_type], **kw)
+
+class Scenario(object):
+    """ One benchmark configuration. """
+    def __init__(self, storage='mapping', sessions=1000, depth=10,
+                 period=20, ops=200, bucket_type='oobtree',
+                 touch_granularity=1):
+        self.storage = storage
+        self.sessions = sessions
+        self.depth = depth
+        self.period = period
+        self.ops = ops
+        self.bucket_type = bucket_type
+        self.touch_granularity = touch_granularity
+
+    @property
+    def timeout(self):
+        # nothing expires while the benchmark runs
+        return self.depth * self.period
+
+    def describe(self):
+        return '%s/%s sessions=%d depth=%d period=%d touch=%d' % (
+            self.storage, self.bucket_type, self.sessions, self.depth,
+            self.period, self.touch_granularity)
+
+    def make_manager(self, when):
+        return make_manager(self.bucket_type, self.timeout, self.period,
+                            when, touch_granularity=self.touch_granularity)
+
+    def run(self):
+        """ Run every operation at every position; return a mapping of
+        ``(operation, position)`` to :class:`Timings`."""
+        tmpdir = tempfile.mkdtemp()
+        storage = open_storage(self.storage, tmpdir)
+        db = DB(storage)
+        try:
+            conn = db.open()
+            try:
+                with pinned_clock():
+                    return self._run(conn, storage)
+            finally:
+                transaction.abort()
+                conn.close()
+        finally:
+            db.close()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _run(self, conn, storage):
+        # The head slice must be the current one, because ``query``
+        # and ``has_key`` do not accept a 'when' argument; the clock
+        # is pinned, so it stays current.
+        now = timeslice(self.period)
+        start = now - (self.depth - 1) * self.period
+        manager = self.make_manager(start)
+        conn.root()['sessions'] = manager
+        transaction.commit()
+
+        slices = self.populate(manager, start)
+        keys = {
+            'head': list(slices[-1]),
+            'tail': list(slices[0]),
+            'miss': [make_key('miss-%d' % i)
+                     for i in range(self.ops * len(OPERATIONS))],
+            }
+
+        results = {}
+        for position in POSITIONS:
+            pool = keys[position]
+            # every operation gets keys no other operation has touched
+            # (a 'tail' key is copied forward into the head once found)
+            count = min(self.ops, len(pool) // len(OPERATIONS))
+            for operation in OPERATIONS:
+                timings = Timings()
+                results[(operation, position)] = timings
+                for key in [pool.pop() for i in range(count)]:
+                    last_tid = storage.lastTransaction()
+                    elapsed = self.time_op(manager, operation, key, now)
+                    transaction.commit()
+                    timings.add(elapsed, bytes_committed(storage, last_tid))
+        return results
+
+    def populate(self, manager, start):
+        slices = []
+        per_slice = max(1, self.sessions // self.depth)
+        n = 0
+        for i in range(self.depth):
+            when = start + i * self.period
+            slice_keys = []
+            for j in range(per_slice):
+                key = make_key(n)
+                n += 1
+                manager.set(key, SessionData({'n': n}), when)
+                slice_keys.append(key)
+                if n % 1000 == 0:
+                    transaction.commit()
+            transaction.commit()
+            slices.append(slice_keys)
+        return slices
+
+    def time_op(self, manager, operation, key, when):
+        if operation == 'get':
+            begin = timer()
+            manager.get(key, when)
+            return timer() - begin
+        if operation == 'query':
+            begin = timer()
+            manager.query(key)
+            return timer() - begin
+        if operation == 'has_key':
+            begin = timer()
+            manager.has_key(key)
+            return timer() - begin
+        if operation == 'search':
+            begin = timer()
+            manager.search(key, None, when)
+            return timer() - begin
+        if operation == 'set_if_modified':
+            sdo = manager.search(key, None, when)
+            if sdo is None:
+                sdo = SessionData()
+            old_lm = sdo.last_modified
+            sdo['hit'] = old_lm
+            begin = timer()
+            manager.set_if_modified(key, sdo, old_lm, when)
+            return timer() - begin
+        raise ValueError('Unknown operation %r' % operation)
+
+def report(scenario, results, out=sys.stdout):
+    out.write('%s\n' % scenario.describe())
+    out.write('%-16s %-5s %6s %12s %10s %10s %12s\n' % (
+        'operation', 'pos', 'n', 'ops/sec', 'p50 us', 'p99 us',
+        'bytes/commit'))
+    for position in POSITIONS:
+        for operation in OPERATIONS:
+            timings = results[(operation, position)]
+            out.write('%-16s %-5s %6d %12.0f %10.1f %10.1f %12.0f\n' % (
+                operation, position, len(timings.samples),
+                timings.ops_per_sec, timings.p50 * 1e6, timings.p99 * 1e6,
+                timings.bytes_per_commit))
+    out.write('\n')
+
+class ConcurrencyResult(object):
+    """ The outcome of a :class:`ConcurrencyScenario` run. """
+    def __init__(self):
+        self.commits = 0
+        self.conflicts = 0 # failed commits, retried
+        self.failures = 0  # operations given up after too many conflicts
+        self.elapsed = 0.0
+        self.bytes_written = 0
+
+    @property
+    def commits_per_sec(self):
+        if not self.elapsed:
+            return 0.0
+        return self.commits / self.elapsed
+
+    @property
+    def conflict_rate(self):
+        attempts = self.commits + self.conflicts
+        if not attempts:
+            return 0.0
+        return float(self.conflicts) / attempts
+
+    @property
+    def bytes_per_commit(self):
+        if not self.commits:
+            return 0.0
+        return float(self.bytes_written) / self.commits
+
+class ConcurrencyScenario(object):
+    """ ``threads`` threads, each with its own connection, each doing
+    ``ops`` units of work against one session manager: ``get`` a
+    session (a new one with probability ``new_fraction``, else one of
+    ``sessions`` existing ones), set a key in it, wait ``think``
+    seconds (as a request would do other work, letting the other
+    threads run) and commit, retrying up to ``retries`` times after a
+    conflict."""
+    def __init__(self, storage='file', sessions=1000, threads=4, ops=200,
+                 bucket_type='oobtree', new_fraction=0.5, think=0.001,
+                 retries=5, period=3600):
+        self.storage = storage
+        self.sessions = sessions
+        self.threads = threads
+        self.ops = ops
+        self.bucket_type = bucket_type
+        self.new_fraction = new_fraction
+        self.think = think
+        self.retries = retries
+        self.period = period
+
+    def describe(self):
+        return '%s/%s sessions=%d threads=%d new=%.2f' % (
+            self.storage, self.bucket_type, self.sessions, self.threads,
+            self.new_fraction)
+
+    def run(self):
+        """ Run the threads; return a :class:`ConcurrencyResult`. """
+        tmpdir = tempfile.mkdtemp()
+        storage = open_storage(self.storage, tmpdir)
+        db = DB(storage)
+        try:
+            with pinned_clock():
+                return self._run(db, storage)
+        finally:
+            transaction.abort()
+            db.close()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _run(self, db, storage):
+        # the sessions are created two timeslices back and copied
+        # forward twice, so that both current buckets follow a bucket
+        # holding all of them (bucket types which size themselves are
+        # sized as they would be in a steady state), and the first
+        # bucket has expired; the clock is pinned, so nothing replaces
+        # the head while the benchmark runs
+        now = timeslice(self.period)
+        first = now - 2 * self.period
+        conn = db.open()
+        try:
+            manager = make_manager(self.bucket_type, self.period,
+                                   self.period, first)
+            conn.root()['sessions'] = manager
+            for i in range(self.sessions):
+                manager.set(make_key(i), SessionData({'n': i}), first)
+                if i % 1000 == 999:
+                    transaction.commit()
+            transaction.commit()
+            for when in now - self.period, now:
+                for i in range(self.sessions):
+                    manager.search(make_key(i), when=when)
+                    if i % 1000 == 999:
+                        transaction.commit()
+                transaction.commit()
+        finally:
+            conn.close()
+
+        result = ConcurrencyResult()
+        first_tid = storage.lastTransaction()
+        lock = threading.Lock()
+        workers = [threading.Thread(target=self.work,
+                                    args=(db, i, result, lock))
+                   for i in range(self.threads)]
+        begin = timer()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        result.elapsed = timer() - begin
+        result.bytes_written = bytes_since(storage, first_tid)
+        return result
+
+    def work(self, db, n, result, lock):
+        rng = random.Random(n)
+        commits = conflicts = failures = 0
+        conn = db.open()
+        try:
+            manager = conn.root()['sessions']
+            for i in range(self.ops):
+                if rng.random() < self.new_fraction:
+                    key = make_key('new-%d-%d' % (n, i))
+                else:
+                    key = make_key(rng.randrange(self.sessions))
+                for attempt in range(self.retries + 1):
+                    try:
+                        transaction.begin()
+                        manager.get(key)['hit'] = (n, i)
+                        time.sleep(self.think)
+                        transaction.commit()
+                    except ConflictError:
+                        transaction.abort()
+                        conflicts += 1
+                    else:
+                        commits += 1
+                        break
+                else:
+                    failures += 1
+        finally:
+            transaction.abort()
+            conn.close()
+        with lock:
+            result.commits += commits
+            result.conflicts += conflicts
+            result.failures += failures
+
+def bytes_since(storage, first_tid):
+    """ Return the number of data bytes written to ``storage`` by the
+    transactions committed after ``first_tid``."""
+    written = 0
+    for txn in storage.iterator():
+        if txn.tid <= first_tid:
+            continue
+        for record in txn:
+            if record.data:
+                written += len(record.data)
+    return written
+
+def report_concurrency(scenario, result, out=sys.stdout):
+    out.write('%s\n' % scenario.describe())
+    out.write('%8s %10s %10s %9s %9s %12s\n' % (
+        'commits', 'commits/s', 'conflicts', 'conflict%', 'failures',
+        'bytes/commit'))
+    out.write('%8d %10.0f %10d %9.1f %9d %12.0f\n\n' % (
+        result.commits, result.commits_per_sec, result.conflicts,
+        result.conflict_rate * 100, result.failures,
+        result.bytes_per_commit))
+
+def _int_list(value):
+    return [int(x) for x in value.split(',') if x]
+
+def main(argv=sys.argv, out=sys.stdout):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Benchmark SessionDataManager hot paths.')
+    parser.add_option('--storage', default='mapping,file',
+                      help='Comma-separated storages: %s' % ', '.join(
+                          STORAGES))
+    parser.add_option('--sessions', default='1000,10000',
+                      help='Comma-separated session counts')
+    parser.add_option('--depth', default='1,10,60',
+                      help='Comma-separated bucket-chain depths '
+                           '(timeout / period ratios)')
+    parser.add_option('--period', type='int', default=20,
+                      help='Session manager period in seconds')
+    parser.add_option('--ops', type='int', default=200,
+                      help='Operations timed per operation and position')
+    parser.add_option('--bucket-type', default='oobtree',
+                      help='Comma-separated bucket types: %s' % ', '.join(
+                          sorted(BUCKET_TYPES)))
+    parser.add_option('--touch-granularity', default='1',
+                      help='Comma-separated touch granularities (slices '
+                           'within which hits are not copied forward)')
+    parser.add_option('--concurrency', default='',
+                      help='Comma-separated thread counts; if given, '
+                           'measure concurrent writes instead (use a '
+                           'file storage, which resolves conflicts)')
+    parser.add_option('--new-fraction', type='float', default=0.5,
+                      help='With --concurrency, the fraction of '
+                           'operations creating a new session')
+    options, args = parser.parse_args(argv[1:])
+
+    if options.concurrency:
+        for storage in options.storage.split(','):
+            for bucket_type in options.bucket_type.split(','):
+                for sessions in _int_list(options.sessions):
+                    for threads in _int_list(options.concurrency):
+                        scenario = ConcurrencyScenario(
+                            storage, sessions, threads, options.ops,
+                            bucket_type, options.new_fraction)
+                        report_concurrency(scenario, scenario.run(), out)
+        return
+
+    for storage in options.storage.split(','):
+        for bucket_type in options.bucket_type.split(','):
+            for sessions in _int_list(options.sessions):
+                for depth in _int_list(options.depth):
+                    for touch in _int_list(options.touch_granularity):
+                        scenario = Scenario(storage, sessions, depth,
+                                            options.period, options.ops,
+                                            bucket_type, touch)
+                        report(scenario, scenario.run(), out)
+
+if __name__ == '__main__': # pragma: no cover
+    main()
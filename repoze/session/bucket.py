@@ -0,0 +1,191 @@
+""" A session manager bucket type which resolves its write conflicts.
+
+``SessionDataManager`` keeps each timeslice's sessions in an
+``OOBTree`` by default.  Concurrent inserts into the same leaf of an
+``OOBTree`` usually merge, but not when one of them splits the leaf
+(which also rewrites the interior node) or when both insert the same
+key, as two requests copying the same session forward do.  Both are
+common in a busy head bucket.
+
+:class:`PartitionedBucket` avoids them: it routes each key by a stable
+hash to one of its :class:`MergingBucket` partitions.  The partitions
+are ``OOBucket`` objects, which never split, and they merge concurrent
+changes to distinct keys, and identical changes to the same key, in a
+three-way merge.  The partitioned bucket's own record is written only
+when it is created.  Select it with the ``bucket_type`` argument of
+the session manager (or its factory)::
+
+  from repoze.session.bucket import PartitionedBucket
+
+  factory = FileStorageSessionManagerFactory(
+      'sessions.fs', 'sessions', bucket_type=PartitionedBucket)
+
+Each write rewrites a single partition, so partitions are kept
+small: the session manager creates each new head bucket with
+:meth:`PartitionedBucket.following`, which gives it enough partitions
+for the previous head's population at about ``partition_size``
+sessions each.  A quiet timeslice thus creates a handful of
+partitions, and a busy one about as many as an ``OOBTree`` holding
+its sessions would have leaf buckets, all written by the commit which
+creates the bucket.  Iteration is ordered within each partition only.
+"""
+from BTrees.OOBTree import OOBucket
+from persistent import Persistent
+from ZODB.POSException import ConflictError
+
+from repoze.session.manager import shard_hash
+
+_marker = ()
+
+class MergingBucket(OOBucket):
+    """ An ``OOBucket`` whose conflict resolution merges the changes
+    of both transactions key by key, accepting identical changes to
+    the same key."""
+
+    # Process-local statistics (see repoze.session.stats); never
+    # persisted.
+    stats = None
+
+    def _p_resolveConflict(self, old, committed, new):
+        stats = self.stats
+        try:
+            resolved = _merge(old, committed, new)
+        except ConflictError:
+            if stats is not None:
+                stats.incr_labeled('conflicts_raised', 'bucket')
+            raise
+        if stats is not None:
+            stats.incr_labeled('conflicts_resolved', 'bucket')
+        return resolved
+
+def _items(state):
+    # the items of an OOBucket state: ((k1, v1, k2, v2, ...),) or
+    # ((k1, v1, ...), next_bucket)
+    if len(state) > 1:
+        raise ConflictError('Bucket in a BTree')
+    flat = state[0]
+    return dict(zip(flat[::2], flat[1::2]))
+
+def _same(a, b):
+    if a is b:
+        return True
+    try:
+        # PersistentReferences compare by oid; they raise ValueError
+        # for references they can't compare (e.g. weak references)
+        return bool(a == b)
+    except ValueError:
+        return False
+
+def _merge(old, committed, new):
+    o = _items(old)
+    c = _items(committed)
+    n = _items(new)
+    resolved = {}
+    for k in set(o) | set(c) | set(n):
+        ov = o.get(k, _marker)
+        cv = c.get(k, _marker)
+        nv = n.get(k, _marker)
+        if _same(cv, ov):
+            value = nv
+        elif _same(nv, ov) or _same(cv, nv):
+            value = cv
+        else:
+            raise ConflictError('Conflicting changes to %r' % (k,))
+        if value is not _marker:
+            resolved[k] = value
+    flat = []
+    for k in sorted(resolved):
+        flat.append(k)
+        flat.append(resolved[k])
+    return (tuple(flat),)
+
+class PartitionedBucket(Persistent):
+    """ A mapping spread over ``partition_count`` (by default
+    ``min_partitions``) :class:`MergingBucket` partitions by key hash;
+    usable as ``SessionDataManager``'s bucket type."""
+
+    # the bounds of the number of partitions of a bucket created by
+    # 'following'
+    min_partitions = 8
+    max_partitions = 4096
+
+    # the number of sessions per partition 'following' sizes for
+    partition_size = 16
+
+    # the number of partitions 'following' counts the sessions of
+    _sample_size = 4
+
+    # Make the partition type replaceable for unit tests.
+    _PARTITION_TYPE = MergingBucket
+
+    def __init__(self, partition_count=None):
+        if partition_count is None:
+            partition_count = self.min_partitions
+        self.partitions = tuple([self._PARTITION_TYPE()
+                                 for i in range(partition_count)])
+
+    @classmethod
+    def following(cls, previous):
+        """ Return a new bucket to follow the head bucket ``previous``,
+        with enough partitions (a power of two between
+        ``min_partitions`` and ``max_partitions``) for as many
+        sessions as ``previous`` holds at ``partition_size`` sessions
+        each.  The population is estimated from a sample of the
+        partitions of ``previous`` if it is a :class:`PartitionedBucket`,
+        and taken to be small otherwise."""
+        count = cls.min_partitions
+        partitions = getattr(previous, 'partitions', None)
+        if partitions:
+            sample = partitions[:cls._sample_size]
+            population = (sum([len(partition) for partition in sample])
+                          * len(partitions) // len(sample))
+            while (count * cls.partition_size < population
+                   and count < cls.max_partitions):
+                count *= 2
+        return cls(count)
+
+    def _partition(self, key):
+        partitions = self.partitions
+        return partitions[shard_hash(key) % len(partitions)]
+
+    def get(self, key, default=None):
+        return self._partition(key).get(key, default)
+
+    def __getitem__(self, key):
+        return self._partition(key)[key]
+
+    def __setitem__(self, key, value):
+        self._partition(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._partition(key)[key]
+
+    def __contains__(self, key):
+        return key in self._partition(key)
+
+    has_key = __contains__
+
+    def __len__(self):
+        return sum([len(partition) for partition in self.partitions])
+
+    def __bool__(self):
+        for partition in self.partitions:
+            if partition:
+                return True
+        return False
+
+    __nonzero__ = __bool__
+
+    def keys(self):
+        return [k for partition in self.partitions for k in partition.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def values(self):
+        return [v for partition in self.partitions
+                for v in partition.values()]
+
+    def items(self):
+        return [item for partition in self.partitions
+                for item in partition.items()]
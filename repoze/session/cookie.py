@@ -0,0 +1,264 @@
+""" Client-side session data kept in a signed cookie.
+
+:class:`CookieSessionDataManager` treats the cookie value (a "token")
+as the session key: ``get(token)`` returns a
+:class:`repoze.session.data.SessionData` decoded from the token, and
+:meth:`CookieSessionDataManager.dumps` encodes a session into the
+token to send back::
+
+  sessions = CookieSessionDataManager(secret, fallback=zodb_manager)
+
+  sdo = sessions.get(request.cookies.get('session'))
+  sdo['first_name'] = 'fred'
+  token = sessions.dumps(sdo)
+  if token:
+      response.set_cookie('session', token)
+  elif token == '':
+      response.delete_cookie('session')
+
+The session data is serialized as JSON and signed with HMAC-SHA256; if
+an ``encryption_key`` is given it is also encrypted (this needs the
+``cryptography`` package: install ``repoze.session[crypto]``).  A
+session whose data does not survive a JSON round trip unchanged, or
+whose token would be longer than ``max_size``, is moved into the
+``fallback`` session manager (for instance a ZODB
+:class:`repoze.session.manager.SessionDataManager`) and the cookie then
+only carries a signed reference to it.
+
+The server never sees a cookie session expire unless the browser sends
+its token again, so an ``ISessionEndEvent`` is sent for a cookie
+session only when an expired token is presented.
+
+Nor can the server revoke a token: invalidating a session (on logout,
+say) only makes :meth:`CookieSessionDataManager.dumps` tell the caller
+to delete the cookie, and a copy of the token captured earlier is
+still accepted until ``timeout`` seconds after it was issued.  Only a
+session which was moved into the ``fallback`` manager is invalidated
+for every copy of its token, because its data lives on the server.
+Keep sessions which must be revocable in a server-side manager.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from zope.interface import implementer
+from zope.event import notify
+
+from repoze.session.data import SessionData
+from repoze.session.interfaces import ISessionDataManager
+from repoze.session.manager import SessionBeginEvent
+from repoze.session.manager import notify_ended
+from repoze.session._compat import text_type
+
+# token kinds
+_COOKIE = 'c'
+_REFERENCE = 'r'
+
+class InvalidToken(ValueError):
+    """ A token is malformed or its signature does not match. """
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+@implementer(ISessionDataManager)
+class CookieSessionDataManager(object):
+    """ Manage sessions stored in signed cookie tokens.
+
+    ``secret`` (text or bytes) signs the tokens.  A token not reissued
+    within ``timeout`` seconds expires; :meth:`dumps` reissues an
+    unchanged session's token once it is older than ``period``
+    seconds.  ``max_size`` is the longest token :meth:`dumps` returns
+    for a cookie session (browsers store about 4096 bytes per cookie,
+    name and attributes included).  ``fallback`` is the session
+    manager sessions too large for a cookie are moved to; without one,
+    :meth:`dumps` raises ``ValueError`` for them.  ``encryption_key``
+    is a ``cryptography.fernet.Fernet`` key.
+    """
+
+    _DATA_TYPE = SessionData
+
+    def __init__(self, secret, timeout=1200, period=20, max_size=4000,
+                 fallback=None, encryption_key=None):
+        if isinstance(secret, text_type):
+            secret = secret.encode('utf-8')
+        self.secret = secret
+        self.timeout = timeout # seconds
+        self.period = period   # seconds
+        self.max_size = max_size
+        self.fallback = fallback
+        self.fernet = None
+        if encryption_key is not None:
+            from cryptography.fernet import Fernet
+            self.fernet = Fernet(encryption_key)
+
+    #   ISessionDataManager implementation
+
+    def get(self, key, when=None): # 'when' for testing
+        """
+        Return the session data object of the token ``key``.
+
+        If the token is missing, invalid or expired (or its session
+        was invalidated), create a new session data object and return
+        it.
+        """
+        sdo = self.search(key, when=when)
+        if sdo is None or not sdo.is_valid():
+            sdo = self._DATA_TYPE()
+            sdo._v_issued = sdo._v_loaded_lm = sdo._v_reference = None
+            notify(SessionBeginEvent(sdo))
+        return sdo
+
+    def query(self, key, default=None):
+        """
+        Return the session data object of the token ``key``, or
+        ``default`` if the token is missing, invalid or expired.
+        """
+        return self.search(key, default)
+
+    def has_key(self, key):
+        """
+        Return true if the token ``key`` holds a current session.
+        """
+        return self.search(key, None) is not None
+
+    #
+    # Tokens
+    #
+    def sign(self, body):
+        digest = hmac.new(self.secret, body, hashlib.sha256).digest()
+        return _b64encode(digest)
+
+    def loads(self, token):
+        """ Return the ``(kind, issued, payload)`` of ``token``, raising
+        :class:`InvalidToken` if it was not made by :meth:`dumps` with
+        the same secret (and encryption key)."""
+        if isinstance(token, text_type):
+            token = token.encode('ascii')
+        try:
+            body, signature = token.rsplit(b'.', 1)
+        except ValueError:
+            raise InvalidToken('Malformed token')
+        if not hmac.compare_digest(signature, self.sign(body)):
+            raise InvalidToken('Bad signature')
+        try:
+            if self.fernet is not None:
+                body = self.fernet.decrypt(body)
+            else:
+                body = _b64decode(body)
+            kind, issued, payload = json.loads(body.decode('utf-8'))
+        except Exception:
+            raise InvalidToken('Undecodable token')
+        return kind, issued, payload
+
+    def _token(self, kind, issued, payload):
+        body = json.dumps([kind, issued, payload], separators=(',', ':'))
+        body = body.encode('utf-8')
+        if self.fernet is not None:
+            body = self.fernet.encrypt(body)
+        else:
+            body = _b64encode(body)
+        token = body + b'.' + self.sign(body)
+        return token.decode('ascii')
+
+    def search(self, key, default=None, when=None): # 'when' for testing
+        if not key:
+            return default
+        try:
+            kind, issued, payload = self.loads(key)
+        except InvalidToken:
+            return default
+
+        if when is None:
+            when = time.time()
+
+        if kind == _REFERENCE:
+            if self.fallback is None:
+                return default
+            sdo = self.fallback.query(payload, default)
+            if sdo is not default:
+                sdo._v_issued = issued
+                sdo._v_loaded_lm = sdo.last_modified
+                sdo._v_reference = payload
+            return sdo
+
+        data, created, last_modified, flags = payload
+        sdo = self._DATA_TYPE()
+        sdo.__setstate__((data, created, last_modified, flags))
+        sdo._v_issued = issued
+        sdo._v_loaded_lm = sdo.last_modified
+        sdo._v_reference = None
+        if when - issued > self.timeout:
+            notify_ended([sdo])
+            return default
+        return sdo
+
+    def dumps(self, sdo, when=None): # 'when' for testing
+        """ Return the token to send back for the session data object
+        ``sdo`` (returned by this manager), or None if the token the
+        browser has is still good, or an empty string if ``sdo`` was
+        invalidated (the cookie should be deleted; copies of the old
+        token are still accepted until they time out).
+
+        A session which does not fit in a cookie is moved to the
+        ``fallback`` manager under a random key, in the current
+        transaction, and the token refers to it."""
+        if when is None:
+            when = time.time()
+        issued = getattr(sdo, '_v_issued', None)
+        reference = getattr(sdo, '_v_reference', None)
+        recent = issued is not None and when - issued <= self.period
+
+        if not sdo.is_valid():
+            return ''
+
+        if reference is not None:
+            # changes are committed to the fallback manager
+            if recent:
+                return None
+            sdo._v_issued = int(when)
+            return self._token(_REFERENCE, int(when), reference)
+
+        unchanged = sdo.last_modified == getattr(sdo, '_v_loaded_lm', None)
+        if unchanged and (recent or issued is None):
+            # the browser's token is good, or this is a new session
+            # which was never modified (see SessionDataManager.get)
+            return None
+
+        data, created, last_modified, flags = SessionData.__getstate__(sdo)
+        token = None
+        if _json_safe(data):
+            token = self._token(_COOKIE, int(when),
+                                [data, created, last_modified, flags])
+            if len(token) > self.max_size:
+                token = None
+        if token is None:
+            token = self._move_to_fallback(sdo, when)
+        sdo._v_issued = int(when)
+        return token
+
+    def _move_to_fallback(self, sdo, when):
+        if self.fallback is None:
+            raise ValueError('Session too large for a cookie and no '
+                             'fallback session manager')
+        reference = binascii.hexlify(os.urandom(16)).decode('ascii')
+        moved = self.fallback._DATA_TYPE()
+        moved.__setstate__(SessionData.__getstate__(sdo))
+        self.fallback.set(reference, moved)
+        sdo._v_reference = reference
+        return self._token(_REFERENCE, int(when), reference)
+
+def _json_safe(data):
+    # only data which comes back from JSON unchanged may be stored in
+    # a cookie (JSON would turn tuples into lists, integer keys into
+    # strings, and so on)
+    try:
+        return json.loads(json.dumps(data)) == data
+    except (TypeError, ValueError):
+        return False
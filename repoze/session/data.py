@@ -1,11 +1,13 @@
-import pprint
 import time
+import zlib
 
 from zope.interface import implementer
 from ZODB.POSException import ConflictError
 
 from persistent.mapping import PersistentMapping
 from repoze.session.interfaces import ISessionData
+from repoze.session._compat import PY2
+from repoze.session._compat import pickle
 
 def manage_modified(wrapped):
     """ Decorator which sets last modified time on session data
@@ -18,6 +20,17 @@ def manage_modified(wrapped):
 
 _marker = object()
 
+class _default(object):
+    # a non-data descriptor computing an attribute missing from the
+    # instance dict (like persistent.mapping's)
+    def __init__(self, func):
+        self.func = func
+
+    def __get__(self, inst, class_):
+        if inst is None:
+            return self
+        return self.func(inst)
+
 @implementer(ISessionData)
 class SessionData(PersistentMapping):
     """ Dictionary-like object that supports additional methods and
@@ -36,6 +49,10 @@ class SessionData(PersistentMapping):
     # _iv indicates that this node is invalid if true.
     _iv = False
 
+    # Process-local statistics (see repoze.session.stats); never
+    # persisted.
+    stats = None
+
     def __init__(self, d=None):
         # _ct is creation time
         self._ct = time.time()
@@ -100,24 +117,192 @@ class SessionData(PersistentMapping):
 
     created = property(_get_created)
 
+    # Compact pickle state: rather than Persistent's attribute dict,
+    # pickle a (data, created, last_modified, flags) tuple, with the
+    # timestamps rounded down to integer seconds.  The dict form is
+    # still loaded (and still written by subclasses which add their
+    # own persistent attributes).
+
+    def __getstate__(self):
+        state = PersistentMapping.__getstate__(self)
+        if not _COMPACT_KEYS.issuperset(state):
+            return state
+        return self._pack(_compact(state))
+
+    def _pack(self, state):
+        # hook for subclasses transforming the compact state
+        return state
+
+    def __setstate__(self, state):
+        if _is_compact(state):
+            state = _expand(state)
+        PersistentMapping.__setstate__(self, state)
+
     # ZODB conflict resolution (to prevent write conflicts)
 
     def _p_resolveConflict(self, old, committed, new):
-        # dict modifiers set '_lm'.
-        if committed['_lm'] != new['_lm']:
-            # we are operating against the PersistentMapping.__getstate__
-            # representation, which aliases '_container' to self.data.
-            c_data = committed['data']
-            n_data = new['data']
-            if c_data != n_data:
-                msg = "Competing writes to session data: \n%s\n----\n%s" % (
-                        pprint.pformat(c_data),
-                        pprint.pformat(n_data))
-                raise ConflictError(msg)
+        stats = self.stats
+        try:
+            resolved = self._resolve_conflict(old, committed, new)
+        except ConflictError:
+            if stats is not None:
+                stats.incr_labeled('conflicts_raised', 'data')
+            raise
+        if stats is not None:
+            stats.incr_labeled('conflicts_resolved', 'data')
+        return resolved
+
+    def _resolve_conflict(self, old, committed, new):
+        # we are operating against the __getstate__ representation:
+        # either the compact tuple or Persistent's attribute dict.  The
+        # resolved state is in the form of 'new'.
+        compact = _is_compact(new)
+        old, committed, new = [_expand(state) if _is_compact(state)
+                               else state
+                               for state in (old, committed, new)]
+        c_data = committed['data']
+        n_data = new['data']
 
         resolved = dict(new)
+        if not _same(c_data, n_data):
+            # dict modifiers set '_lm'; merge the keys they touched
+            # on each side against the common ancestor.
+            resolved['data'] = _merge(old.get('data', {}), c_data, n_data)
+
         invalid = committed.get('_iv') or new.get('_iv')
         if invalid:
             resolved['_iv'] = True
         resolved['_lm'] = max(committed['_lm'], new['_lm'])
+        if compact:
+            return self._pack(_compact(resolved))
         return resolved
+
+class CompressedSessionData(SessionData):
+    """ A :class:`SessionData` which zlib-compresses its data when
+    its pickle is at least ``compress_threshold`` bytes long, and
+    decompresses it on first access after loading.  Use it by setting
+    a session manager's ``_DATA_TYPE``; change ``compress_threshold``
+    or ``compress_level`` by subclassing.
+
+    The data is pickled on its own to be compressed, so the values in
+    compressed sessions must not be persistent objects (see the
+    "Gotchas" in the usage documentation). """
+
+    compress_threshold = 4096 # bytes
+    compress_level = 6
+
+    def _pack(self, state):
+        data, ct, lm, flags = state
+        if flags & _COMPRESSED:
+            return state
+        raw = pickle.dumps(data, _PROTOCOL)
+        if len(raw) < self.compress_threshold:
+            return state
+        packed = zlib.compress(raw, self.compress_level)
+        stats = self.stats
+        if stats is not None:
+            stats.incr('compressed_states')
+            stats.incr('compression_bytes_in', len(raw))
+            stats.incr('compression_bytes_out', len(packed))
+        if len(packed) >= len(raw):
+            return state
+        return (packed, ct, lm, flags | _COMPRESSED)
+
+    def __getstate__(self):
+        if 'data' not in self.__dict__ and '_v_packed' in self.__dict__:
+            # never decompressed since it was loaded; write the
+            # compressed data back as it is
+            state = PersistentMapping.__getstate__(self)
+            state['data'] = self._v_packed
+            state = _compact(state)
+            return state[:3] + (state[3] | _COMPRESSED,)
+        return SessionData.__getstate__(self)
+
+    def __setstate__(self, state):
+        if _is_compact(state) and state[3] & _COMPRESSED:
+            packed, ct, lm, flags = state
+            state = _expand((None, ct, lm, flags & ~_COMPRESSED))
+            del state['data']
+            PersistentMapping.__setstate__(self, state)
+            self._v_packed = packed
+        else:
+            SessionData.__setstate__(self, state)
+
+    @_default
+    def data(self):
+        # We don't want to cause a write on read (see
+        # PersistentMapping.data)
+        data = _unpack(self.__dict__.pop('_v_packed'))
+        self.__dict__['data'] = data
+        return data
+
+# flag bits of the compact pickle state
+_INVALID = 1
+_COMPRESSED = 2
+
+# pickle protocol of compressed data (the one ZODB uses)
+_PROTOCOL = 2 if PY2 else 3
+
+_COMPACT_KEYS = frozenset(('data', '_ct', '_lm', '_iv'))
+
+def _is_compact(state):
+    # Persistent's own tuple state form is a (dict, slots) pair
+    return isinstance(state, tuple) and len(state) == 4
+
+def _seconds(t):
+    if t is None:
+        return None
+    return int(t)
+
+def _compact(state):
+    flags = 0
+    if state.get('_iv'):
+        flags |= _INVALID
+    return (state['data'], _seconds(state.get('_ct')),
+            _seconds(state.get('_lm')), flags)
+
+def _unpack(packed):
+    return pickle.loads(zlib.decompress(packed))
+
+def _expand(state):
+    data, ct, lm, flags = state
+    if flags & _COMPRESSED:
+        data = _unpack(data)
+    expanded = {'data': data}
+    if ct is not None:
+        expanded['_ct'] = ct
+    if lm is not None:
+        expanded['_lm'] = lm
+    if flags & _INVALID:
+        expanded['_iv'] = True
+    return expanded
+
+def _same(a, b):
+    if a is b:
+        return True
+    try:
+        return a == b
+    except ValueError:
+        # ZODB's PersistentReference refuses to compare references to
+        # different objects
+        return False
+
+def _merge(old, committed, new):
+    """ Three-way merge of session data dicts: keys added, changed or
+    deleted on only one side (or identically on both) merge cleanly; a
+    key changed differently on both sides is a conflict."""
+    merged = dict(committed)
+    for k in set(old) | set(new):
+        o = old.get(k, _marker)
+        c = committed.get(k, _marker)
+        n = new.get(k, _marker)
+        if _same(c, n) or _same(o, n):
+            continue # committed already has the right value
+        if not _same(o, c):
+            raise ConflictError(
+                'Competing writes to session data key %r' % (k,))
+        if n is _marker:
+            del merged[k]
+        else:
+            merged[k] = n
+    return merged
@@ -0,0 +1,130 @@
+""" Out-of-band session manager housekeeping.
+
+Session managers created with ``external_housekeeping=True`` never
+expire their buckets or send ``ISessionEndEvent`` notifications while
+serving a request (unless housekeeping falls so far behind that a new
+head bucket needs the slot of an expired one).  Call :func:`housekeep`
+from a cron job or a worker thread / process instead, or run the
+``repoze-session-housekeep`` console script.
+"""
+import logging
+import optparse
+import sys
+import time
+
+import transaction
+from ZODB.POSException import ConflictError
+
+from repoze.session.manager import ConnectionManager
+
+logger = logging.getLogger(__name__)
+
+def housekeep(factory, when=None, retries=3):
+    """ Expire and finalize the sessions of the session manager
+    produced by ``factory`` (e.g. a
+    :class:`repoze.session.manager.FileStorageSessionManagerFactory`)
+    in a transaction of its own, retrying up to ``retries`` times on a
+    ``ConflictError``.  Return the number of expired buckets."""
+    for attempt in range(retries + 1):
+        cm = ConnectionManager()
+        try:
+            transaction.begin()
+            try:
+                manager = factory(cm)
+                expired = manager.housekeep(when)
+                transaction.commit()
+                return expired
+            except ConflictError:
+                transaction.abort()
+                if attempt == retries:
+                    raise
+                logger.debug('Conflict during housekeeping, retrying')
+            except:
+                transaction.abort()
+                raise
+        finally:
+            if getattr(cm, 'conn', None) is not None:
+                cm.close()
+
+def main(argv=sys.argv, sleep=time.sleep):
+    parser = optparse.OptionParser(
+        usage='%prog [options] [filename] appname',
+        description='Expire and finalize the sessions of a session '
+                    'manager stored in a ZODB FileStorage (filename), '
+                    'on a ZEO server (--zeo) or in the storage a ZODB '
+                    'configuration file describes (--zconfig).  A '
+                    'FileStorage can only be opened by one process, so '
+                    'use one of the latter two while the application '
+                    'is running.')
+    parser.add_option('--zeo', metavar='ADDRESS',
+                      help='Use the ZEO server at ADDRESS (HOST:PORT or '
+                           'a Unix socket path)')
+    parser.add_option('--storage', default='1',
+                      help='The name of the ZEO storage (default: 1)')
+    parser.add_option('--zconfig', metavar='URI',
+                      help='Use the storage configured by the ZODB '
+                           'configuration file (path or URL) URI')
+    parser.add_option('--timeout', type='int', default=1200,
+                      help='The timeout of a session manager created by '
+                           'this script (default: 1200)')
+    parser.add_option('--period', type='int', default=20,
+                      help='The period of a session manager created by '
+                           'this script (default: 20)')
+    parser.add_option('--interval', type='int', default=0,
+                      help='Keep running, housekeeping every INTERVAL '
+                           'seconds (default: run once)')
+    parser.add_option('--log-level', default='INFO',
+                      help='The level of the messages logged to stderr '
+                           '(default: INFO)')
+    options, args = parser.parse_args(argv[1:])
+    if options.zeo and options.zconfig:
+        parser.error('--zeo and --zconfig are mutually exclusive')
+    if options.zeo or options.zconfig:
+        if len(args) != 1:
+            parser.error('appname is required')
+        appname, = args
+    else:
+        if len(args) != 2:
+            parser.error('filename and appname are required')
+        filename, appname = args
+    level = getattr(logging, options.log_level.upper(), None)
+    if not isinstance(level, int):
+        parser.error('unknown log level %r' % options.log_level)
+
+    logging.basicConfig(
+        level=level, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    # the application normally creates the session manager; if this
+    # script gets there first, create one which leaves expiry to it
+    settings = dict(timeout=options.timeout, period=options.period,
+                    external_housekeeping=True)
+    if options.zeo:
+        from repoze.session.manager import ZEOSessionManagerFactory
+        factory = ZEOSessionManagerFactory(
+            _zeo_address(options.zeo), appname, storage=options.storage,
+            **settings)
+    elif options.zconfig:
+        from ZODB.config import storageFromURL
+        from repoze.session.manager import SessionManagerFactory
+        factory = SessionManagerFactory(
+            storageFromURL(options.zconfig), appname, **settings)
+    else:
+        from repoze.session.manager import FileStorageSessionManagerFactory
+        factory = FileStorageSessionManagerFactory(filename, appname,
+                                                   **settings)
+    try:
+        while True:
+            expired = housekeep(factory)
+            logger.info('Expired %d bucket(s) of %s', expired, appname)
+            if not options.interval:
+                break
+            sleep(options.interval)
+    finally:
+        factory.db.close()
+
+def _zeo_address(address):
+    # 'host:port' or a Unix socket path
+    host, sep, port = address.rpartition(':')
+    if sep and host and port.isdigit():
+        return (host, int(port))
+    return address
@@ -61,3 +61,10 @@ class ISessionBeginEvent(Interface):
 class ISessionEndEvent(Interface):
     """ An interface representing an event that happens when a session ends
     """
+
+class ISessionsEndedEvent(Interface):
+    """ An interface representing an event that happens once for all
+    the sessions which ended in one expiry pass
+    """
+    sessions = Attribute("""\
+    A sequence of the session data objects which ended.""")
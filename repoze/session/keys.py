@@ -0,0 +1,58 @@
+""" Key codecs: compact forms of session keys.
+
+Session keys are usually long hex or base64 strings, and every bucket
+holding a session, every index entry and every key comparison in the
+BTree code pays for their length.  A session manager created with a
+``key_codec`` stores each key in the codec's compact form instead,
+using the codec's bucket and index types::
+
+  from repoze.session.keys import IntegerKeyCodec
+
+  manager = SessionDataManager(1200, 20, key_codec=IntegerKeyCodec())
+
+:class:`DigestKeyCodec` turns keys into 16-byte digests, kept in
+``OOBTree`` buckets.  :class:`IntegerKeyCodec` turns them into 64-bit
+integers, kept in ``LOBTree`` buckets, which store their keys unboxed
+and compare them in C.
+
+Both codecs hash the key (with SHA-256), so two keys could map to the
+same compact key and share a session.  For random keys the odds are
+about ``n ** 2 / 2 ** 129`` for ``n`` live sessions with
+:class:`DigestKeyCodec` and ``n ** 2 / 2 ** 65`` with
+:class:`IntegerKeyCodec` (one in 37 million for a million sessions).
+Use :class:`IntegerKeyCodec` when that risk is acceptable, for its
+faster buckets; use :class:`DigestKeyCodec` when it is not, as its
+odds are negligible for any number of sessions.
+"""
+import hashlib
+import struct
+
+from BTrees.LOBTree import LOBTree
+from BTrees.OOBTree import OOBTree
+
+from repoze.session._compat import text_type
+
+def _digest(key):
+    if not isinstance(key, bytes):
+        if not isinstance(key, text_type):
+            key = repr(key)
+        key = key.encode('utf-8')
+    return hashlib.sha256(key).digest()
+
+class DigestKeyCodec(object):
+    """ Store keys as 16-byte digests. """
+    bucket_type = OOBTree
+    index_type = OOBTree
+
+    def encode(self, key):
+        """ Return the compact form of ``key``. """
+        return _digest(key)[:16]
+
+class IntegerKeyCodec(object):
+    """ Store keys as signed 64-bit integers. """
+    bucket_type = LOBTree
+    index_type = LOBTree
+
+    def encode(self, key):
+        """ Return the compact form of ``key``. """
+        return struct.unpack('>q', _digest(key)[:8])[0]
@@ -1,3 +1,7 @@
+""" The linked list of buckets which session managers used before
+the ring of :class:`repoze.session.manager.SessionDataManager`; kept to
+unpickle (and migrate) managers stored by earlier versions. """
+
 class ListNode(object):
     __slots__ = ('ob', 'next')
 
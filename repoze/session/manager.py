@@ -1,23 +1,36 @@
+from contextlib import contextmanager
 import operator
+import sys
+import threading
 import time
+import zlib
 
+from BTrees.LOBTree import LOBTree
+from BTrees.LOBTree import LOBucket
+from BTrees.LOBTree import difference as lo_difference
 from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import difference
 from persistent import Persistent
 import transaction
 from ZODB.POSException import ConflictError
 
+from zope.component import getSiteManager
+from zope.interface import implementedBy
 from zope.interface import implementer
+import zope.event
 from zope.event import notify
 
 from repoze.session.interfaces import ISessionBeginEvent
 from repoze.session.interfaces import ISessionEndEvent
+from repoze.session.interfaces import ISessionsEndedEvent
 from repoze.session.interfaces import ISessionDataManager
 
-from repoze.session.linkedlist import deserialize
-from repoze.session.linkedlist import ListNode
+from repoze.session.linkedlist import serialize
 
 from repoze.session.data import SessionData
 
+from repoze.session._compat import text_type
+
 
 @implementer(ISessionBeginEvent)
 class SessionBeginEvent(object):
@@ -33,11 +46,88 @@ class SessionEndEvent(object):
     def __init__(self, session):
         self.session = session
 
+@implementer(ISessionsEndedEvent)
+class SessionsEndedEvent(object):
+    """ An event that is sent via ``zope.event.notify`` once for all
+    the sessions which ended in one expiry pass.
+    """
+    def __init__(self, sessions):
+        self.sessions = sessions
+
+def _listened(event_class):
+    # Return true if notifying an event of 'event_class' could reach a
+    # subscriber: any zope.event subscriber but zope.component's
+    # dispatcher, or a handler registered with zope.component for the
+    # event.
+    subscribers = zope.event.subscribers
+    if not subscribers:
+        return False
+    dispatch = getattr(sys.modules.get('zope.component.event'), 'dispatch',
+                       None)
+    for subscriber in subscribers:
+        if subscriber is not dispatch:
+            return True
+    return bool(getSiteManager().adapters.subscriptions(
+        (implementedBy(event_class),), None))
+
+def end_listeners(each=True):
+    """ Return a pair of flags: whether anything listens for the
+    ``ISessionEndEvent`` of each ended session (always false unless
+    ``each``), and whether anything listens for ``ISessionsEndedEvent``.
+    """
+    return (each and _listened(SessionEndEvent),
+            _listened(SessionsEndedEvent))
+
+def notify_ended(sessions, each=True):
+    """ Send an ``ISessionEndEvent`` for each of the ended ``sessions``
+    (unless ``each`` is false) and one ``ISessionsEndedEvent`` for all
+    of them, skipping the events nothing listens for."""
+    if not sessions:
+        return
+    notify_each, notify_all = end_listeners(each)
+    if notify_each:
+        for session in sessions:
+            notify(SessionEndEvent(session))
+    if notify_all:
+        notify(SessionsEndedEvent(sessions))
+
 _marker = ()
 
 @implementer(ISessionDataManager)
 class SessionDataManager(Persistent):
     """ An object that manages sessions.
+
+    Sessions live in one bucket per timeslice, kept in a ring of
+    ``timeout // period + 2`` slots (see :meth:`get_head`).  Putting a
+    new head bucket into the ring expires the buckets older than
+    ``timeout``.
+
+    If ``index`` is true, the manager also keeps an index mapping each
+    key to the timeslice of the newest bucket holding it, which turns
+    a search into one index probe plus one bucket probe.
+
+    If ``external_housekeeping`` is true, expired sessions are not
+    finalized on the request path; see :meth:`housekeep`.
+
+    Sessions found within the newest ``touch_granularity`` timeslices
+    are not copied forward into the head bucket.
+
+    If ``period_bounds`` is a ``(min_period, max_period)`` tuple, the
+    period is adaptive: each time the head bucket is replaced, the
+    manager picks the period of the new one within those bounds (see
+    :meth:`adapt_period`).
+
+    ``bucket_type`` replaces the ``OOBTree`` holding each timeslice's
+    sessions, e.g. with :class:`repoze.session.bucket.PartitionedBucket`.
+
+    Each expiry pass sends one ``ISessionsEndedEvent`` for the sessions
+    which ended, and, unless ``session_end_events`` is false, an
+    ``ISessionEndEvent`` for each of them.  Events nothing subscribes
+    to are not sent.
+
+    If ``key_codec`` is given (see :mod:`repoze.session.keys`), keys
+    are stored in the codec's compact form, in buckets (and an index)
+    of the codec's types unless ``bucket_type`` says otherwise.
     """
 
     # We have the option of using an OOBTree as a bucket type or an
@@ -47,19 +137,133 @@ class SessionDataManager(Persistent):
     # some conflicts are generated due to interior node splits.  But
     # empirical testing shows that using an OOBTree makes session
     # access faster and produces much smaller pickles, even if its
-    # usage does imply tolerating some conflicts.
+    # usage does imply tolerating some conflicts.  See
+    # ``repoze.session.benchmark.hotpaths`` (``--bucket-type``) to
+    # reproduce the comparison.  Deployments which would rather not
+    # tolerate them can pass ``bucket_type=PartitionedBucket`` (see
+    # ``repoze.session.bucket``), which resolves its conflicts while
+    # keeping pickles small; ``--concurrency`` measures the tradeoff.
 
     _BUCKET_TYPE = OOBTree
 
     # Make the data type replaceable for unit tests.
     _DATA_TYPE = SessionData
 
+    # Optional secondary index mapping each key to the timeslice of
+    # the newest bucket holding it, so that a search probes one bucket
+    # instead of every current bucket.  Managers created without
+    # ``index=True`` (and managers pickled before the index existed)
+    # have no index.
+    index = None
+
+    _INDEX_TYPE = OOBTree
+
+    # Maps the keys passed to the manager to the keys stored in its
+    # buckets and index (see repoze.session.keys); None stores them
+    # as given.
+    key_codec = None
+
+    # If true, replacing the head never expires buckets or finalizes
+    # sessions (searches just skip expired buckets); 'housekeep' must
+    # be called out of band instead.
+    external_housekeeping = False
+
+    # A value found within the newest 'touch_granularity' timeslices
+    # is returned without being copied forward into the head bucket.
+    # The default of 1 copies forward everything not found in the head
+    # bucket.  Larger values trade expiry precision (a session may end
+    # up to 'touch_granularity - 1' periods early) for fewer writes to
+    # (and conflicts on) the head bucket of read-mostly sessions.
+    touch_granularity = 1
+
+    # If set, a '(min_period, max_period)' tuple; 'period' is then
+    # picked anew within those bounds whenever the head is replaced.
+    # Slices of different widths may coexist in the ring: expiry only
+    # compares the slice indices the slices start at.
+    period_bounds = None
+
+    # The number of sessions an adaptive manager aims to write into
+    # each head bucket; more make the head bucket a conflict hotspot.
+    target_slice_writes = 500
+
+    # An adaptive manager widens its period when more than this many
+    # conflicts on the manager itself (racing head replacements and
+    # bucket expiries) were resolved during the last timeslice.
+    max_slice_conflicts = 4
+
+    # The number of conflicts on the manager resolved since the head
+    # was last replaced; only counted by adaptive managers.
+    slice_conflicts = 0
+
+    # Whether to send an ISessionEndEvent for each ended session; an
+    # ISessionsEndedEvent for all the sessions which ended in one pass
+    # is sent either way.
+    session_end_events = True
+
+    # Process-local statistics (see repoze.session.stats); never
+    # persisted.
+    stats = None
+
     nonlazy = False # for unit testing
 
-    def __init__(self, timeout, period, when=None):
+    # The transaction and timeslice the lookup memo (see '_memo')
+    # belongs to, and the memo.  Volatile: each connection has its own
+    # copy of the manager, and the memo is dropped when the manager is
+    # ghosted.
+    _v_memo_txn = None
+    _v_memo_slice = None
+    _v_memo = None
+
+    # The current buckets, newest first (see '_chain'), and the slots
+    # they were found in.  Volatile, like the memo.
+    _v_chain = None
+
+    # Buckets which had expired, but were not finalized yet, when the
+    # manager was migrated from a linked list of buckets to the ring;
+    # finalized by the next expiry.
+    _expired_buckets = ()
+
+    # True if the index of a migrated manager maps keys to the
+    # timestamps the linked list used rather than to slice indices.
+    _index_in_seconds = False
+
+    def __init__(self, timeout, period, when=None, index=False,
+                 external_housekeeping=False, touch_granularity=1,
+                 period_bounds=None, bucket_type=None, key_codec=None,
+                 session_end_events=True):
         self.timeout = timeout # seconds
         self.period = period   # seconds
-        self.head = self.new_head(None, when)
+        if not session_end_events:
+            self.session_end_events = False
+        if key_codec is not None:
+            self.key_codec = key_codec
+            if bucket_type is None:
+                bucket_type = key_codec.bucket_type
+            self._INDEX_TYPE = key_codec.index_type
+        if bucket_type is not None:
+            self._BUCKET_TYPE = bucket_type
+        if period_bounds is not None:
+            min_period, max_period = period_bounds
+            if not 0 < min_period <= period <= max_period:
+                raise ValueError('period %r is not within period_bounds %r'
+                                 % (period, period_bounds))
+            self.period_bounds = (min_period, max_period)
+        # slice indices count 'tick' seconds, the narrowest period
+        if period_bounds is None:
+            self.tick = period
+        else:
+            self.tick = min_period
+        head_index = self._slice_index(when)
+        slots = [None] * _ring_size(timeout, self.tick)
+        slots[head_index % len(slots)] = (head_index, self._BUCKET_TYPE())
+        self.slots = tuple(slots)
+        self.head_index = head_index
+        if index:
+            self.index = self._INDEX_TYPE()
+        if external_housekeeping:
+            self.external_housekeeping = True
+        if touch_granularity != 1:
+            self.touch_granularity = touch_granularity
 
     #   ISessionDataManager implementation
 
@@ -70,33 +274,53 @@ class SessionDataManager(Persistent):
 
         Otherwise, create a new subobject of the type supported by this
         container with key "k" and return it.
-        """
-        sdo = self.search(key, when=when)
-
-        if sdo is None or not sdo.is_valid():
-            sdo = self._DATA_TYPE()
-            # It is useful to only need to persist the data object
-            # into the head bucket iff it was actually modified during
-            # the transaction.  This potentially cuts down on the
-            # number of writes to the database by an order of
-            # magnitude in the case where someone unleashes "ab" or a
-            # similar tool against a page which accesses a session but
-            # does not write to it (such as a login form that uses
-            # session auth or a shopping cart page).  If we are
-            # 'lazy', we only set the new session data object into the
-            # head bucket if it has been modified during the
-            # transaction.  We use a ZODB 'beforeCommitHook' to
-            # perform this conditional.  If self.nonlazy is true, we
-            # don't use this behavior, but this is typically only
-            # useful for unit tests.
-            t = transaction.get()
-            if self.nonlazy:
-                self.set(key, sdo, when)
-            else:
-                lm = sdo.last_modified
-                t.addBeforeCommitHook(self.set_if_modified,(key, sdo, lm, when))
 
-            notify(SessionBeginEvent(sdo))
+        Within a transaction, repeated calls for the same key return
+        the same object without searching again.
+        """
+        memo = self._memo(when)
+        entry = memo.get(key)
+        if entry is None:
+            sdo = self.search(key, when=when)
+        else:
+            sdo = entry[0]
+            stats = self.stats
+            if stats is not None:
+                stats.incr('memo_hits')
+
+        if sdo is not None and sdo.is_valid():
+            if entry is None:
+                memo[key] = (sdo, _marker)
+            return sdo
+
+        sdo = self._DATA_TYPE()
+        # It is useful to only need to persist the data object
+        # into the head bucket iff it was actually modified during
+        # the transaction.  This potentially cuts down on the
+        # number of writes to the database by an order of
+        # magnitude in the case where someone unleashes "ab" or a
+        # similar tool against a page which accesses a session but
+        # does not write to it (such as a login form that uses
+        # session auth or a shopping cart page).  If we are
+        # 'lazy', we only set the new session data object into the
+        # head bucket if it has been modified during the
+        # transaction.  We use a ZODB 'beforeCommitHook' to
+        # perform this conditional.  If self.nonlazy is true, we
+        # don't use this behavior, but this is typically only
+        # useful for unit tests.
+        t = transaction.get()
+        if self.nonlazy:
+            self.set(key, sdo, when)
+        else:
+            lm = sdo.last_modified
+            t.addBeforeCommitHook(self.set_if_modified,(key, sdo, lm, when))
+            memo[key] = (sdo, lm)
+
+        stats = self.stats
+        if stats is not None:
+            stats.incr('sessions_created')
+
+        notify(SessionBeginEvent(sdo))
 
         return sdo
 
@@ -105,162 +329,642 @@ class SessionDataManager(Persistent):
         Return value associated with key k.  If value associated with
         k does not exist, return default.
         """
-        return self.search(key, default)
+        memo = self._memo()
+        entry = memo.get(key)
+        if entry is None:
+            entry = memo[key] = (self.search(key), _marker)
+        else:
+            stats = self.stats
+            if stats is not None:
+                stats.incr('memo_hits')
+        value, created_lm = entry
+        if value is None:
+            return default
+        if created_lm is not _marker and value.last_modified == created_lm:
+            # created by 'get' in this transaction and not (yet) worth
+            # storing
+            return default
+        return value
+
+    def get_many(self, keys, when=None):  # 'when' for testing
+        """
+        Return a dict mapping each of ``keys`` to its session data
+        object, creating new ones as ``get`` does.  The buckets are walked
+        once for all keys not looked up earlier in the transaction, and
+        a single before-commit hook is registered for all lazily created
+        session data objects.
+        """
+        memo = self._memo(when)
+        entries = self._memoized_many(memo, keys, when)
+        result = {}
+        created = []
+
+        for key in keys:
+            if key in result:
+                continue
+            sdo = entries[key][0]
+            if sdo is None or not sdo.is_valid():
+                sdo = self._DATA_TYPE()
+                created.append((key, sdo, sdo.last_modified))
+            result[key] = sdo
+
+        if created:
+            # see 'get' for the rationale behind laziness
+            if self.nonlazy:
+                for key, sdo, lm in created:
+                    self.set(key, sdo, when)
+            else:
+                t = transaction.get()
+                t.addBeforeCommitHook(self.set_many_if_modified,
+                                      (created, when))
+                for key, sdo, lm in created:
+                    memo[key] = (sdo, lm)
+            stats = self.stats
+            if stats is not None:
+                stats.incr('sessions_created', len(created))
+            for key, sdo, lm in created:
+                notify(SessionBeginEvent(sdo))
+
+        return result
+
+    def query_many(self, keys, default=None):
+        """
+        Return a dict mapping each of ``keys`` to its value, or to
+        ``default`` if it has none.  The buckets are walked once for all
+        keys not looked up earlier in the transaction.
+        """
+        entries = self._memoized_many(self._memo(), keys)
+        result = {}
+        for key in keys:
+            value, created_lm = entries[key]
+            if value is None or (created_lm is not _marker and
+                                 value.last_modified == created_lm):
+                # see 'query'
+                value = default
+            result[key] = value
+        return result
+
+    def _memoized_many(self, memo, keys, when=None):
+        # Return a dict mapping each of 'keys' to its memo entry,
+        # searching (once, for all of them) the keys not in 'memo' and
+        # adding them to it.
+        entries = {}
+        missing = []
+        for key in keys:
+            entry = memo.get(key)
+            if entry is None:
+                missing.append(key)
+            else:
+                entries[key] = entry
+        stats = self.stats
+        if stats is not None and entries:
+            stats.incr('memo_hits', len(entries))
+        if missing:
+            found = self.search_many(missing, when)
+            for key in missing:
+                entries[key] = memo[key] = (found.get(key), _marker)
+        return entries
 
     def has_key(self, key):
         """
         Return true if manager has value associated with key k, else
         return false.
         """
-        return self.search(key, None) is not None
-
-    #
-    # Linked list management
-    #
-    def new_head(self, old_head, when=None):
+        return self.query(key) is not None
+
+    def _memo(self, when=None):
+        # Map each key looked up by 'get' or 'query' in the current
+        # transaction to a '(value, created_lm)' tuple; 'value' is
+        # None for a miss, and 'created_lm' is the last modified time
+        # of a value lazily created by 'get' (else _marker).  A new
+        # transaction starts a new memo, and so does a new timeslice
+        # (sessions can only expire when the head bucket is replaced).
         if when is None:
             when = time.time()
+        txn = transaction.get()
+        now_slice = timeslice(self.period, when)
+        if self._v_memo_txn is not txn or self._v_memo_slice != now_slice:
+            self._v_memo_txn = txn
+            self._v_memo_slice = now_slice
+            self._v_memo = {}
+        return self._v_memo
 
-        bucket = self._BUCKET_TYPE()
-        head = ListNode((when, bucket), old_head)
-        return head
+    #
+    # Ring management
+    #
+    def _slice_index(self, when):
+        # the index of the timeslice 'when' falls into, in ticks
+        return int(timeslice(self.period, when) // self.tick)
 
     def get_head(self, when=None):
+        """ Return the head entry, ``(slice_index, bucket)``, first
+        replacing the head bucket if ``when`` falls into a newer
+        timeslice."""
+        return self._advance(when)[0]
+
+    def _advance(self, when):
+        # Return the head entry, replacing the head first if it is not
+        # current, and the number of buckets expired by doing so.
         if when is None:
             when = time.time()
 
         now_slice = timeslice(self.period, when)
 
-        # head_slice is the slice in which the head bucket was created
-        head_slice, head_bucket = self.head.ob
+        # the index of the slice in which the head bucket was created
+        head_index = self.head_index
+        slots = self.slots
+        head = slots[head_index % len(slots)]
+        tick = self.tick
 
         # if the now timeslice is equal to or before the head was
         # created, we do not need to replace the head, as it is still
         # current.
-
-        if now_slice > head_slice:
-            # the head is not current, we need to replace it
-            self.head = self.new_head(self.head, now_slice)
-
-        return self.head
+        if now_slice <= head_index * tick:
+            return head, 0
+
+        # the head is not current, we need to replace it
+        if self.period_bounds is not None:
+            self.adapt_period(head_index * tick, head[1], now_slice)
+            # start on a boundary of the new period, but not
+            # before the old head's slice has ended
+            now_slice = max(timeslice(self.period, when), now_slice)
+        expired = self._rotate(max(int(now_slice // tick), head_index + 1))
+        stats = self.stats
+        if stats is not None:
+            stats.incr('head_rotations')
+        slots = self.slots
+        return slots[self.head_index % len(slots)], expired
+
+    def _rotate(self, index):
+        # Put a new head bucket for slice 'index' into its slot,
+        # first expiring the buckets older than 'timeout' (unless
+        # housekeeping is external) and whatever the slot still held.
+        # Return the number of expired buckets.
+        slots = list(self.slots)
+        slot = index % len(slots)
+        bucket = self._new_bucket(slots[self.head_index % len(slots)])
+        doomed = []
+        if not self.external_housekeeping:
+            doomed = self._expired_slots(index)
+        if slots[slot] is not None and slot not in doomed:
+            # only possible with external housekeeping lagging by more
+            # than a period
+            doomed.append(slot)
+        expired = [slots[i] for i in doomed]
+        for i in doomed:
+            slots[i] = None
+        slots[slot] = (index, bucket)
+        self.slots = tuple(slots)
+        self.head_index = index
+        return self._end(expired)
+
+    def _new_bucket(self, head):
+        # A bucket to replace the bucket of the 'head' entry.  Bucket
+        # types which size themselves (see PartitionedBucket) are
+        # given the bucket they follow.
+        following = getattr(self._BUCKET_TYPE, 'following', None)
+        if following is None or head is None:
+            return self._BUCKET_TYPE()
+        return following(head[1])
+
+    def _expired_slots(self, head_index):
+        # the slots holding buckets older than 'timeout', given the
+        # head's slice index
+        limit = self.timeout
+        tick = self.tick
+        return [i for i, entry in enumerate(self.slots) if entry is not None
+                and (head_index - entry[0]) * tick > limit]
+
+    def _chain(self):
+        # The '(slice_index, bucket)' pairs of the current buckets,
+        # newest first; buckets older than 'timeout' which external
+        # housekeeping has not expired yet are left out.  Cached until
+        # the slots change.
+        slots = self.slots
+        cached = self._v_chain
+        if cached is not None and cached[0] is slots:
+            return cached[1]
+        head_index = self.head_index
+        limit = self.timeout
+        tick = self.tick
+        chain = []
+        for entry in slots:
+            if entry is not None and (head_index - entry[0]) * tick <= limit:
+                index = entry[0]
+                for bucket in entry[1:]:
+                    chain.append((index, bucket))
+        # stable: raced buckets of one slice keep their order
+        chain.sort(key=operator.itemgetter(0), reverse=True)
+        self._v_chain = (slots, chain)
+        return chain
+
+    def _indexed_entry(self, k, head_index):
+        # Return the current entry which the index says holds 'k', or
+        # None.
+        indexed = self.index.get(k)
+        if indexed is None:
+            return None
+        tick = self.tick
+        if self._index_in_seconds:
+            indexed = int(indexed // tick)
+        slots = self.slots
+        entry = slots[indexed % len(slots)]
+        if (entry is None or entry[0] != indexed or
+            (head_index - indexed) * tick > self.timeout):
+            return None
+        return entry
+
+    def _index_value(self, index):
+        # the value to store in the index for slice 'index'
+        if self._index_in_seconds:
+            return index * self.tick
+        return index
+
+    def adapt_period(self, head_slice, head_bucket, now_slice):
+        """ Pick the period of an adaptive manager's next head bucket
+        from the number of sessions written into the current one,
+        ``head_bucket``, between ``head_slice`` and ``now_slice``, and
+        from the number of conflicts on the manager resolved
+        meanwhile.
+
+        More writes than ``target_slice_writes`` per period shrink the
+        period in proportion and fewer widen it, as do more than
+        ``max_slice_conflicts`` conflicts.  The period changes by at
+        most a factor of two at a time and stays within
+        ``period_bounds``."""
+        period = self.period
+        min_period, max_period = self.period_bounds
+        # scale to one period, in case nothing happened for a while
+        elapsed = max(now_slice - head_slice, period)
+        writes = len(head_bucket) * float(period) / elapsed
+        if writes and self.slice_conflicts <= self.max_slice_conflicts:
+            new_period = period * float(self.target_slice_writes) / writes
+        else:
+            new_period = period * 2
+        new_period = min(max(new_period, period / 2.0), period * 2)
+        new_period = min(max(int(new_period), min_period), max_period)
+        if self.slice_conflicts:
+            self.slice_conflicts = 0
+        if new_period != period:
+            self.period = new_period
+            stats = self.stats
+            if stats is not None:
+                stats.incr('period_changes')
+        return new_period
 
     def search(self, k, default=None, when=None):   # 'when' for testing
         head = self.get_head(when)
-
-        head_slice, head_bucket = head.ob
-        node = head
-
-        current_buckets = []
-
-        while node is not None:
-
-            ignored, bucket = node.ob
-            current_buckets.append(bucket)
-
-            value = bucket.get(k, _marker)
-
-            if value is not _marker:
-                if node is not head:
-                    head_bucket[k] = value
-                return value
-
-            nextnode = node.next
-
-            if nextnode is not None:
-
-                next_slice, next_bucket = nextnode.ob
-
-                if head_slice - next_slice > self.timeout:
-                    self.notify_end(nextnode, current_buckets)
-                    node.next = None
-
-            node = node.next
+        head_index, head_bucket = head[:2]
+
+        codec = self.key_codec
+        if codec is not None:
+            k = codec.encode(k)
+
+        if self.index is not None:
+            # only the bucket(s) of the indexed timeslice can hold the
+            # key, and the ring finds their slot directly.
+            entry = self._indexed_entry(k, head_index)
+            if entry is not None:
+                index = entry[0]
+                for bucket in entry[1:]:
+                    value = bucket.get(k, _marker)
+                    if value is not _marker:
+                        return self._found(k, value, index, bucket, head)
+        else:
+            for index, bucket in self._chain():
+                value = bucket.get(k, _marker)
+                if value is not _marker:
+                    return self._found(k, value, index, bucket, head)
+
+        stats = self.stats
+        if stats is not None:
+            stats.incr('misses')
 
         return default
 
-    def notify_end(self, expired_node, current_buckets):
-        # finalize all values that don't have a key that is current
-
-        # flatten all keys in current buckets
-        current_keys = {}
-        for current_bucket in current_buckets:
-            for k in current_bucket.keys():
-                current_keys[k] = 1
-
-        while expired_node is not None:
-            ignored, bucket = expired_node.ob
-            for k, v in bucket.items():
-                if k in current_keys:
+    def _found(self, k, value, index, bucket, head):
+        # Finish a hit on 'k' in 'bucket' (of slice 'index'): copy the
+        # value forward unless it is in the head bucket already.
+        head_index, head_bucket = head[:2]
+        if bucket is not head_bucket:
+            self._copy_forward(k, value, index, head_index, head_bucket)
+        stats = self.stats
+        if stats is not None:
+            stats.incr_labeled('hits', head_index - index)
+        return value
+
+    def search_many(self, keys, when=None):   # 'when' for testing
+        """ Like ``search`` for each of ``keys``, but walking the
+        buckets once.  Return a dict containing the keys which were
+        found.  Like ``search``, this always looks in the buckets;
+        ``get_many`` and ``query_many`` consult the transaction's memo
+        first. """
+        head = self.get_head(when)
+        head_index = head[0]
+
+        # stored key -> key as given
+        codec = self.key_codec
+        if codec is None:
+            outstanding = dict([(k, k) for k in keys])
+        else:
+            outstanding = dict([(codec.encode(k), k) for k in keys])
+        found = {}
+
+        if self.index is not None:
+            for k in list(outstanding):
+                entry = self._indexed_entry(k, head_index)
+                if entry is None:
                     continue
-                event = SessionEndEvent(v)
-                notify(event)
-                # don't finalize data objects with the same key twice
-                current_keys[k] = v
-
-            expired_node = expired_node.next
+                index = entry[0]
+                for bucket in entry[1:]:
+                    value = bucket.get(k, _marker)
+                    if value is not _marker:
+                        found[outstanding.pop(k)] = self._found(
+                            k, value, index, bucket, head)
+                        break
+        else:
+            for index, bucket in self._chain():
+                if not outstanding:
+                    break
+                for k in list(outstanding):
+                    value = bucket.get(k, _marker)
+                    if value is not _marker:
+                        found[outstanding.pop(k)] = self._found(
+                            k, value, index, bucket, head)
+
+        stats = self.stats
+        if stats is not None and outstanding:
+            stats.incr('misses', len(outstanding))
+
+        return found
+
+    def _copy_forward(self, k, value, slice_index, head_index, head_bucket):
+        # Copy a value found in an older bucket into the head bucket,
+        # unless it was found within the newest 'touch_granularity'
+        # timeslices.
+        stats = self.stats
+        untouched = (self.touch_granularity - 1) * self.period
+        if (head_index - slice_index) * self.tick <= untouched:
+            if stats is not None:
+                stats.incr('copy_forwards_skipped')
+            return
+        head_bucket[k] = value
+        index = self.index
+        if index is not None:
+            index[k] = self._index_value(head_index)
+        if stats is not None:
+            stats.incr('copy_forwards')
+            stats.incr('head_writes')
+
+    def housekeep(self, when=None):
+        """ Expire the buckets older than ``timeout`` and finalize the
+        sessions that ended with them.  This is the work replacing the
+        head bucket does in passing unless ``external_housekeeping``
+        is true, in which case something else (see
+        ``repoze.session.housekeeping``) must call this method
+        periodically.  Return the number of expired buckets."""
+        head, expired = self._advance(when)
+        doomed = self._expired_slots(head[0])
+        if doomed or self._expired_buckets:
+            slots = list(self.slots)
+            entries = [slots[i] for i in doomed]
+            for i in doomed:
+                slots[i] = None
+            self.slots = tuple(slots)
+            expired += self._end(entries)
+        return expired
+
+    def _end(self, entries):
+        # Finalize the sessions in the buckets of the expired
+        # 'entries' (and in any buckets which had expired before the
+        # manager was migrated to the ring) which aren't in a current
+        # bucket.  Return the number of expired buckets.
+        entries = sorted(entries, key=operator.itemgetter(0), reverse=True)
+        expired = [bucket for entry in entries for bucket in entry[1:]]
+        if self._expired_buckets:
+            expired.extend(self._expired_buckets)
+            self._expired_buckets = ()
+        if expired:
+            current = [bucket for index, bucket in self._chain()]
+            self.notify_end(expired, current)
+        return len(expired)
+
+    def notify_end(self, expired_buckets, current_buckets):
+        # finalize all values in 'expired_buckets' (newest first) that
+        # don't have a key that is current.
+
+        # Rather than flattening the keys of every current bucket into
+        # one big dict, whittle each expired bucket down with BTrees'
+        # (C) set difference against every newer bucket.  Memory use
+        # is bounded by the size of one expired bucket, no matter how
+        # many sessions are live.
+        newer_buckets = list(current_buckets)
+        index = self.index
+        stats = self.stats
+        notify_each, notify_all = end_listeners(self.session_end_events)
+        sessions = []
+
+        for bucket in expired_buckets:
+            ended = bucket
+            for newer_bucket in newer_buckets:
+                if not ended:
+                    break
+                ended = _difference(ended, newer_bucket)
+            if index is not None:
+                for k in ended.keys():
+                    if k in index:
+                        del index[k]
+            if notify_each or notify_all:
+                sessions.extend(ended.values())
+            if stats is not None:
+                stats.incr('buckets_expired')
+                stats.incr('sessions_ended', len(ended))
+            # don't finalize data objects with the same key twice
+            newer_buckets.append(bucket)
+
+        notify_ended(sessions, self.session_end_events)
 
     def set(self, k, v, when=None):
-        head = self.get_head(when)
-        head_ts, bucket = head.ob
+        head_index, bucket = self.get_head(when)[:2]
+        memo = self._memo(when)
+        if k in memo:
+            memo[k] = (v, _marker)
+        codec = self.key_codec
+        if codec is not None:
+            k = codec.encode(k)
         bucket[k] = v
+        index = self.index
+        if index is not None:
+            value = self._index_value(head_index)
+            if index.get(k) != value:
+                index[k] = value
+        stats = self.stats
+        if stats is not None:
+            stats.incr('head_writes')
 
     def set_if_modified(self, k, v, old_lm, when=None):
         if v.last_modified is None:
             return
         if v.last_modified != old_lm:
             self.set(k, v, when)
+            stats = self.stats
+            if stats is not None:
+                stats.incr('sessions_persisted')
+
+    def set_many_if_modified(self, items, when=None):
+        for k, v, old_lm in items:
+            self.set_if_modified(k, v, old_lm, when)
 
     # Conflict resolution
 
     def _p_resolveConflict(self, old, committed, new):
+        stats = self.stats
+        try:
+            resolved = self._resolve_conflict(old, committed, new)
+        except ConflictError:
+            if stats is not None:
+                stats.incr_labeled('conflicts_raised', 'manager')
+            raise
+        if stats is not None:
+            stats.incr_labeled('conflicts_resolved', 'manager')
+        return resolved
+
+    def _resolve_conflict(self, old, committed, new):
+        # states pickled with the linked list of buckets
+        old, committed, new = [_migrate(state) for state in
+                               (old, committed, new)]
         oldob       = State(old)
         committedob = State(committed)
         newob       = State(new)
 
-        if not oldob.period == committedob.period == newob.period:
+        bounds = getattr(newob, 'period_bounds', None)
+        if not (getattr(oldob, 'period_bounds', None) ==
+                getattr(committedob, 'period_bounds', None) == bounds):
+            raise ConflictError('Conflicting period bounds')
+
+        # an adaptive manager's period changes with its head
+        if bounds is None and not (
+            oldob.period == committedob.period == newob.period):
             raise ConflictError('Conflicting periods')
 
         if not oldob.timeout == committedob.timeout == newob.timeout:
             raise ConflictError('Conflicting timeouts')
 
-        o_head, o_tail = _head_and_tail(oldob)
-        c_head, c_tail = _head_and_tail(committedob)
-        n_head, n_tail = _head_and_tail(newob)
-
-        # We are operating on the __setstate__ representation of the
-        # attached ListNodes (no clue why, we're operating on the
-        # __getstate__ representation of the PersistentMapping object
-        # in SessionDataObject).
-        o_head_ts = o_head.ob[0]
-        if o_head_ts < c_tail.ob[0]:
-            raise ConflictError('Committed has obsoleted old')
-
-        if o_head_ts < n_tail.ob[0]:
-            raise ConflictError('New has obsoleted old')
-
-        # find any slices added in 'new'
-        n_added = _prefix(n_head, o_head_ts)
-
-        # and portion of 'committed' newer than new's tail.
-        c_rest = _prefix(c_head, n_tail.ob[0], include_match=True)
-
-        head = deserialize(n_added + c_rest)
-        new['head'] = head
+        if not len(oldob.slots) == len(committedob.slots) == len(newob.slots):
+            raise ConflictError('Conflicting ring sizes')
+
+        # Each transaction may have put a new head into one slot and
+        # emptied the slots of expired buckets; merge slot by slot.
+        new['slots'] = tuple([_resolve_slot(o, c, n) for o, c, n in
+                              zip(oldob.slots, committedob.slots,
+                                  newob.slots)])
+        new['head_index'] = max(committedob.head_index, newob.head_index)
+
+        o_expired = getattr(oldob, '_expired_buckets', ())
+        c_expired = getattr(committedob, '_expired_buckets', ())
+        if not _same(c_expired, o_expired):
+            # committed finalized the buckets left over from migration
+            new['_expired_buckets'] = c_expired
+
+        if bounds is not None:
+            # the period and conflict count go with the newest head
+            if newob.head_index > committedob.head_index:
+                latest = newob
+            else:
+                latest = committedob
+            new['period'] = latest.period
+            new['slice_conflicts'] = getattr(latest, 'slice_conflicts', 0) + 1
         return new
 
-def _prefix(newer, ts, include_match=False):
-    result = []
-    op = include_match and operator.ge or operator.gt
-    while newer and op(newer.ob[0], ts):
-        result.append(newer.ob)
-        newer = newer.next
-    return result
+    def __setstate__(self, state):
+        Persistent.__setstate__(self, _migrate(state))
 
-def _head_and_tail(root):
-    head = tail = root.head
-    while tail and tail.next is not None:
-        tail = tail.next
-    return head, tail
+def _resolve_slot(old, committed, new):
+    # Merge the changes made to one slot of the ring by two
+    # transactions.  A slot changes when a transaction puts a new head
+    # bucket into it or empties it (expiring its bucket).
+    if _same(committed, old):
+        return new
+    if _same(new, old) or _same(new, committed):
+        return committed
+    if committed is None:
+        # committed expired the bucket new replaced by its head
+        return new
+    if new is None:
+        return committed
+    if committed[0] == new[0]:
+        # both replaced the head with a bucket for the same slice;
+        # keep both, so that neither transaction's writes are lost
+        buckets = list(new[1:])
+        for bucket in committed[1:]:
+            if not [b for b in buckets if _same(b, bucket)]:
+                buckets.append(bucket)
+        return (new[0],) + tuple(buckets)
+    raise ConflictError('Conflicting head buckets')
+
+def _same(a, b):
+    # The buckets in conflict resolution states are
+    # PersistentReferences, which compare equal by oid but raise
+    # ValueError when compared with a different reference.
+    if a is b:
+        return True
+    try:
+        return bool(a == b)
+    except ValueError:
+        return False
+
+def _ring_size(timeout, tick):
+    # a bucket older than 'timeout' is expired before its slot is
+    # reused, so a bucket never shares a slot with a current one
+    return int(timeout // tick) + 2
+
+def _migrate(state):
+    # Convert the state of a manager pickled with a linked list of
+    # buckets (repoze.session.linkedlist) into that of a ring.
+    if 'head' not in state:
+        return state
+    state = dict(state)
+    bounds = state.get('period_bounds')
+    tick = bounds and bounds[0] or state['period']
+    timeout = state['timeout']
+    slots = [None] * _ring_size(timeout, tick)
+    size = len(slots)
+    nodes = serialize(state.pop('head')) # (timestamp, bucket), newest first
+    head_ts = nodes[0][0]
+    expired = []
+    for ts, bucket in nodes:
+        if head_ts - ts > timeout:
+            expired.append(bucket)
+            continue
+        index = int(ts // tick)
+        entry = slots[index % size]
+        if entry is None:
+            slots[index % size] = (index, bucket)
+        else:
+            # slices of adaptive widths may round to the same index
+            slots[index % size] = entry + (bucket,)
+    state['slots'] = tuple(slots)
+    state['head_index'] = int(head_ts // tick)
+    state['tick'] = tick
+    if expired:
+        state['_expired_buckets'] = tuple(expired)
+    if state.get('index') is not None:
+        # it maps keys to timestamps
+        state['_index_in_seconds'] = True
+    return state
+
+def _difference(c1, c2):
+    # the items of mapping c1 whose keys are not in c2.  A difference
+    # is itself a bucket, and may be the c1 of the next one.
+    lo_types = (LOBTree, LOBucket)
+    if isinstance(c1, lo_types) and isinstance(c2, lo_types):
+        return lo_difference(c1, c2)
+    try:
+        return difference(c1, c2)
+    except TypeError:
+        # not a pair of OO BTrees family objects (e.g. a replacement
+        # _BUCKET_TYPE); do it the slow way.
+        return dict([(k, v) for k, v in c1.items() if k not in c2])
 
 class State:
     # make dealing with conflict resolution a bit easier
@@ -272,35 +976,352 @@ def timeslice(period, when=None):
         when =  time.time()
     return when - (when % period)
 
+def shard_hash(key):
+    """ Return a hash of ``key`` which is stable across processes (the
+    builtin ``hash`` of strings is randomized on Python 3)."""
+    if not isinstance(key, bytes):
+        if not isinstance(key, text_type):
+            key = repr(key)
+        key = key.encode('utf-8')
+    return zlib.crc32(key) & 0xffffffff
+
+@implementer(ISessionDataManager)
+class ShardedSessionDataManager(Persistent):
+    """ A session manager which routes each key by hash to one of
+    ``shards`` independent :class:`SessionDataManager` objects.  Each
+    shard has its own bucket chain, so head rotations and conflicts
+    are spread across ``shards`` database records instead of landing
+    on a single one.  The number of shards is fixed when the manager
+    is created."""
+
+    # Make the shard type replaceable for unit tests.
+    _SHARD_TYPE = SessionDataManager
+
+    def __init__(self, timeout, period, shards, when=None, index=False,
+                 external_housekeeping=False, touch_granularity=1,
+                 period_bounds=None, bucket_type=None, key_codec=None,
+                 session_end_events=True):
+        if shards < 1:
+            raise ValueError('shards must be at least 1, not %r' % shards)
+        self.timeout = timeout # seconds
+        self.period = period   # seconds
+        self.shards = tuple([self._SHARD_TYPE(timeout, period, when, index,
+                                              external_housekeeping,
+                                              touch_granularity,
+                                              period_bounds, bucket_type,
+                                              key_codec, session_end_events)
+                             for i in range(shards)])
+
+    @property
+    def shard_count(self):
+        return len(self.shards)
+
+    def shard_for(self, key):
+        """ Return the shard which stores ``key``. """
+        return self.shards[shard_hash(key) % len(self.shards)]
+
+    #   ISessionDataManager implementation
+
+    def get(self, key, when=None):  # 'when' for testing
+        """
+        If an object already exists in the manager with key "k", it
+        is returned.
+
+        Otherwise, create a new subobject of the type supported by this
+        container with key "k" and return it.
+        """
+        return self.shard_for(key).get(key, when)
+
+    def query(self, key, default=None):
+        """
+        Return value associated with key k.  If value associated with
+        k does not exist, return default.
+        """
+        return self.shard_for(key).query(key, default)
+
+    def has_key(self, key):
+        """
+        Return true if manager has value associated with key k, else
+        return false.
+        """
+        return self.shard_for(key).has_key(key)
+
+    def get_many(self, keys, when=None):  # 'when' for testing
+        """ See :meth:`SessionDataManager.get_many`. """
+        result = {}
+        for shard, shard_keys in self._by_shard(keys):
+            result.update(shard.get_many(shard_keys, when))
+        return result
+
+    def query_many(self, keys, default=None):
+        """ See :meth:`SessionDataManager.query_many`. """
+        result = {}
+        for shard, shard_keys in self._by_shard(keys):
+            result.update(shard.query_many(shard_keys, default))
+        return result
+
+    def _by_shard(self, keys):
+        shards = self.shards
+        grouped = {}
+        for key in keys:
+            grouped.setdefault(shard_hash(key) % len(shards), []).append(key)
+        return [(shards[i], shard_keys) for i, shard_keys in grouped.items()]
+
+    def search(self, k, default=None, when=None):   # 'when' for testing
+        return self.shard_for(k).search(k, default, when)
+
+    def set(self, k, v, when=None):
+        self.shard_for(k).set(k, v, when)
+
+    def housekeep(self, when=None):
+        """ Housekeep every shard; return the number of expired
+        buckets. """
+        return sum([shard.housekeep(when) for shard in self.shards])
+
+_local_lock = threading.Lock()
+
 class SessionManagerFactory(object):
+    """ Create a factory that is, in turn, capable of creating a
+    session manager.  The session manager is stored in the ZODB
+    storage ``storage``, which the factory's database owns and closes
+    with it; :class:`FileStorageSessionManagerFactory` and
+    :class:`ZEOSessionManagerFactory` open the storage themselves.
+
+    ``appname`` is the name in the ZODB under which the session
+    manager will be stored.  ``timeout`` is the session manager
+    :term:`timeout`, and ``period`` is the session manager
+    :term:`period`.  If ``shards`` is given, a newly created session
+    manager is a :class:`ShardedSessionDataManager` with that many
+    shards; an existing session manager is used as stored.  If
+    ``index`` is true, a newly created session manager keeps a
+    key-to-timeslice index, and if ``external_housekeeping`` is true
+    it leaves expiry to :mod:`repoze.session.housekeeping`.
+    ``touch_granularity``, ``period_bounds``, ``bucket_type``,
+    ``key_codec`` and ``session_end_events`` are passed along to a
+    newly created session manager (see :class:`SessionDataManager`).
+
+    If ``pooled`` is true, each thread opens one connection on its
+    first call and reuses it on every later call, instead of opening
+    a connection per call.  ``pool_size``, ``cache_size`` and
+    ``cache_size_bytes`` are passed to the ZODB ``DB``: the number of
+    connections kept open for reuse (more are opened, with a warning,
+    when more threads need one) and the per-connection object cache
+    limits in objects and bytes (0 meaning no byte limit)."""
+
+    # number of shards for newly created session managers; None means
+    # an unsharded SessionDataManager
+    shards = None
+
+    # whether newly created session managers keep a key-to-timeslice index
+    index = False
+
+    # whether newly created session managers leave expiry to 'housekeep'
+    external_housekeeping = False
+
+    # the touch granularity of newly created session managers
+    touch_granularity = 1
+
+    # the period bounds of newly created session managers (None for a
+    # fixed period)
+    period_bounds = None
+
+    # the bucket type of newly created session managers (None for the
+    # default OOBTree)
+    bucket_type = None
+
+    # the key codec of newly created session managers (None to store
+    # keys as given)
+    key_codec = None
+
+    # whether newly created session managers send an ISessionEndEvent
+    # per ended session
+    session_end_events = True
+
+    # whether each thread reuses a single connection (see __call__)
+    pooled = False
+
+    _local = None
+
+    def __init__(self, storage, appname, timeout=1200, period=20,
+                 shards=None, index=False, external_housekeeping=False,
+                 touch_granularity=1, pooled=False, pool_size=7,
+                 cache_size=400, cache_size_bytes=0, period_bounds=None,
+                 bucket_type=None, key_codec=None, session_end_events=True):
+        from ZODB.DB import DB
+        self.db = DB(storage, pool_size=pool_size, cache_size=cache_size,
+                     cache_size_bytes=cache_size_bytes)
+        self.appname = appname
+        self.timeout = timeout
+        self.period = period
+        self.shards = shards
+        self.index = index
+        self.external_housekeeping = external_housekeeping
+        self.touch_granularity = touch_granularity
+        self.period_bounds = period_bounds
+        self.bucket_type = bucket_type
+        self.key_codec = key_codec
+        self.session_end_events = session_end_events
+        self.pooled = pooled
+
+    def __del__(self):
+        self.db.close()
+
     def __call__(self, connection_handler=None):
-        conn = self.db.open()
+        if self.pooled:
+            conn = self._thread_connection()
+        else:
+            conn = self.db.open()
         if connection_handler:
             connection_handler(conn)
+        return self._manager(conn)
+
+    def _manager(self, conn):
         root = conn.root()
         if root.get(self.appname) is None:
-            root[self.appname] = SessionDataManager(self.timeout, self.period)
+            root[self.appname] = self.new_manager()
         return root[self.appname]
 
+    def _thread_connection(self):
+        # In pooled mode a thread opens one connection and keeps it,
+        # which is much cheaper than opening a connection per request.
+        # The first call in each transaction brings the connection up
+        # to date with what other connections committed since the
+        # last one ended; later calls in the same transaction return
+        # it as is.  Neither aborts the transaction in progress.
+        local = self._local
+        if local is None:
+            with _local_lock:
+                local = self._local
+                if local is None:
+                    local = self._local = threading.local()
+        conn = getattr(local, 'conn', None)
+        if conn is None or conn.opened is None:
+            # never opened in this thread, or closed (e.g. by a
+            # ConnectionManager) since
+            conn = local.conn = self.db.open()
+            local.txn = conn.transaction_manager.get()
+        else:
+            txn = conn.transaction_manager.get()
+            if txn is not local.txn:
+                conn.newTransaction(txn)
+                local.txn = txn
+        return conn
+
+    def close_thread_connection(self):
+        """ In pooled mode, close the current thread's connection,
+        returning it to the database's connection pool.  Call this
+        from a thread which will not use the factory again. """
+        local = self._local
+        conn = local is not None and getattr(local, 'conn', None)
+        if conn:
+            local.conn = None
+            if conn.opened is not None:
+                conn.transaction_manager.abort()
+                conn.close()
+
+    @contextmanager
+    def session_manager(self):
+        """ A context manager yielding the session manager::
+
+          with factory.session_manager() as manager:
+              manager.get(key)['name'] = 'fred'
+              transaction.commit()
+
+        Unless the factory is pooled, the connection is returned to
+        the database's pool when the block exits; a pooled factory
+        keeps it for the thread's next block.  Whatever the block has
+        not committed when it exits, normally or by raising, is
+        aborted. """
+        if self.pooled:
+            conn = self._thread_connection()
+        else:
+            conn = self.db.open()
+        try:
+            yield self._manager(conn)
+        finally:
+            conn.transaction_manager.abort()
+            if not self.pooled:
+                conn.close()
+
+    def new_manager(self):
+        if self.shards:
+            return ShardedSessionDataManager(
+                self.timeout, self.period, self.shards, index=self.index,
+                external_housekeeping=self.external_housekeeping,
+                touch_granularity=self.touch_granularity,
+                period_bounds=self.period_bounds,
+                bucket_type=self.bucket_type, key_codec=self.key_codec,
+                session_end_events=self.session_end_events)
+        return SessionDataManager(
+            self.timeout, self.period, index=self.index,
+            external_housekeeping=self.external_housekeeping,
+            touch_granularity=self.touch_granularity,
+            period_bounds=self.period_bounds,
+            bucket_type=self.bucket_type, key_codec=self.key_codec,
+            session_end_events=self.session_end_events)
+
 class FileStorageSessionManagerFactory(SessionManagerFactory):
     """ Create a factory that is, in turn, capable of creating a
     session manager.  The session manager is stored in a ZODB
-    FileStorage.  ``filename`` is he ZODB filestorage filename,
-    ``appname`` is the name in the ZODB under which the session
-    manager will be stored.  ``timeout`` is the session manager
-    :term:`timeout`, and ``period`` is the session manager
-    :term:`period`"""
-    def __init__(self, filename, appname, timeout=1200, period=20):
+    FileStorage.  ``filename`` is he ZODB filestorage filename; the
+    other arguments are those of :class:`SessionManagerFactory`."""
+    def __init__(self, filename, appname, timeout=1200, period=20,
+                 shards=None, index=False, external_housekeeping=False,
+                 touch_granularity=1, pooled=False, pool_size=7,
+                 cache_size=400, cache_size_bytes=0, period_bounds=None,
+                 bucket_type=None, key_codec=None, session_end_events=True):
         from ZODB.FileStorage.FileStorage import FileStorage
-        from ZODB.DB import DB
-        f = FileStorage(filename)
-        self.db = DB(f)
-        self.appname = appname
-        self.timeout = timeout
-        self.period = period
+        SessionManagerFactory.__init__(
+            self, FileStorage(filename), appname, timeout, period, shards,
+            index, external_housekeeping, touch_granularity, pooled,
+            pool_size, cache_size, cache_size_bytes, period_bounds,
+            bucket_type, key_codec, session_end_events)
 
-    def __del__(self):
-        self.db.close()
+class ZEOSessionManagerFactory(SessionManagerFactory):
+    """ Create a factory that is, in turn, capable of creating a
+    session manager.  The session manager is stored in a ZEO server,
+    so that the processes of a multi-process deployment share it.
+    ``address`` is the server address (a ``(host, port)`` tuple or a
+    Unix socket path) and ``storage`` the name of the storage it
+    serves.  The other arguments up to ``session_end_events`` are
+    those of :class:`SessionManagerFactory`.
+
+    ``client_cache_size`` is the size in bytes of the ZEO client
+    cache, which holds recently loaded object records for all
+    connections of the process.  If ``client_cache`` is given, the
+    cache is persistent: it is kept in the file
+    ``<client_cache>-<storage>.zec`` in ``client_cache_dir`` (the
+    current directory by default) and survives restarts; otherwise it
+    is kept in memory.  Session objects change too often for a large
+    cache to help much; a cache big enough for the buckets of the
+    current timeslices usually suffices.
+
+    If ``read_only`` is true, the storage is opened read-only.  If
+    ``read_only_fallback`` is true, the client falls back to
+    read-only access when the server does not allow writing (sessions
+    can then be read but not changed); at most one of the two should
+    be true.
+
+    This needs the ``ZEO`` package (install ``repoze.session[zeo]``)."""
+    def __init__(self, address, appname, timeout=1200, period=20,
+                 shards=None, index=False, external_housekeeping=False,
+                 touch_granularity=1, pooled=False, pool_size=7,
+                 cache_size=400, cache_size_bytes=0, period_bounds=None,
+                 bucket_type=None, key_codec=None, session_end_events=True,
+                 storage='1',
+                 client_cache_size=20 * 1024 * 1024, client_cache=None,
+                 client_cache_dir=None, read_only=False,
+                 read_only_fallback=False):
+        from ZEO.ClientStorage import ClientStorage
+        client_storage = ClientStorage(
+            address, storage=storage, cache_size=client_cache_size,
+            client=client_cache, var=client_cache_dir, read_only=read_only,
+            read_only_fallback=read_only_fallback)
+        SessionManagerFactory.__init__(
+            self, client_storage, appname, timeout, period, shards, index,
+            external_housekeeping, touch_granularity, pooled, pool_size,
+            cache_size, cache_size_bytes, period_bounds, bucket_type,
+            key_codec, session_end_events)
 
 class ConnectionManager(object):
     """ An object willing to manage a ZODB database connection """
@@ -308,12 +1329,34 @@ class ConnectionManager(object):
         """ Store the connection. """
         self.conn = conn
 
+    conn = None
+
     def close(self):
-        """ Close the connection. """
-        self.conn.close()
+        """ Close the connection, if it is open. """
+        conn, self.conn = self.conn, None
+        if conn is not None and getattr(conn, 'opened', True) is not None:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Abort whatever was not committed: a connection joined to a
+        # transaction can't be closed, and even a block which only
+        # reads may have changed the session manager (rotating its
+        # head or copying a session forward).
+        if self.conn is not None:
+            self.conn.transaction_manager.abort()
+        self.close()
 
     def __del__(self):
-        self.close()
+        # A last resort only: garbage collection may happen in another
+        # thread, at interpreter shutdown or with changes pending, so
+        # close explicitly or use the manager as a context manager.
+        try:
+            self.close()
+        except Exception:
+            pass
 
     def commit(self, transaction=transaction):
         """ Commit a transaction. """
@@ -0,0 +1,282 @@
+""" A session data manager keeping its sessions in process memory.
+
+:class:`MemorySessionDataManager` is a drop-in replacement for
+:class:`repoze.session.manager.SessionDataManager` for single-process
+deployments: it has the same ``timeout`` / ``period`` expiry rules,
+sends the same begin and end events and hands out the same
+:class:`repoze.session.data.SessionData` objects, but nothing is
+pickled or written to disk.  Sessions do not survive a restart and are
+not shared between processes.
+
+Session data objects are live: changes to a session which was already
+stored are visible to other threads at once, and aborting the
+transaction does not undo them.  As with ``SessionDataManager``, a
+session created by ``get`` is only stored when the transaction commits
+and only if it was modified.
+"""
+import threading
+
+import transaction
+from zope.interface import implementer
+from zope.event import notify
+
+from repoze.session.data import SessionData
+from repoze.session.interfaces import ISessionDataManager
+from repoze.session.manager import SessionBeginEvent
+from repoze.session.manager import notify_ended
+from repoze.session.manager import timeslice
+
+@implementer(ISessionDataManager)
+class MemorySessionDataManager(object):
+    """ An object that manages sessions in memory.
+
+    Sessions live in a ring of ``timeout // period + 2`` dict buckets,
+    one per timeslice, plus a dict mapping each key to the timeslice of
+    the bucket holding it, so that a lookup is two dict probes no matter
+    how many buckets are current.  The manager is thread-safe.
+
+    Sessions found within the newest ``touch_granularity`` timeslices
+    are not moved forward into the head bucket (see
+    :class:`repoze.session.manager.SessionDataManager`).
+    """
+
+    _DATA_TYPE = SessionData
+
+    # Whether to send an ISessionEndEvent for each ended session (see
+    # SessionDataManager)
+    session_end_events = True
+
+    # Process-local statistics (see repoze.session.stats)
+    stats = None
+
+    nonlazy = False # for unit testing
+
+    def __init__(self, timeout, period, when=None, touch_granularity=1):
+        self.timeout = timeout # seconds
+        self.period = period   # seconds
+        self.touch_granularity = touch_granularity
+        # a bucket older than 'timeout' is expired before its slot is
+        # reused, so a bucket never shares a slot with a current one
+        self.size = int(timeout // period) + 2
+        self.slices = [None] * self.size
+        self.buckets = [None] * self.size
+        self.where = {}
+        self.lock = threading.RLock()
+        self.head_slice = None
+        self._rotate(timeslice(period, when))
+
+    #   ISessionDataManager implementation
+
+    def get(self, key, when=None):  # 'when' for testing
+        """
+        If an object already exists in the manager with key "k", it
+        is returned.
+
+        Otherwise, create a new subobject of the type supported by this
+        container with key "k" and return it.
+        """
+        sdo = self.search(key, when=when)
+
+        if sdo is None or not sdo.is_valid():
+            sdo = self._DATA_TYPE()
+            # see SessionDataManager.get for the rationale behind
+            # laziness
+            if self.nonlazy:
+                self.set(key, sdo, when)
+            else:
+                lm = sdo.last_modified
+                t = transaction.get()
+                t.addBeforeCommitHook(self.set_if_modified,
+                                      (key, sdo, lm, when))
+
+            stats = self.stats
+            if stats is not None:
+                stats.incr('sessions_created')
+
+            notify(SessionBeginEvent(sdo))
+
+        return sdo
+
+    def query(self, key, default=None):
+        """
+        Return value associated with key k.  If value associated with
+        k does not exist, return default.
+        """
+        return self.search(key, default)
+
+    def get_many(self, keys, when=None):  # 'when' for testing
+        """
+        Return a dict mapping each of ``keys`` to its session data
+        object, creating new ones as ``get`` does.
+        """
+        result = {}
+        for key in keys:
+            if key not in result:
+                result[key] = self.get(key, when)
+        return result
+
+    def query_many(self, keys, default=None):
+        """
+        Return a dict mapping each of ``keys`` to its value, or to
+        ``default`` if it has none.
+        """
+        return dict([(key, self.search(key, default)) for key in keys])
+
+    def has_key(self, key):
+        """
+        Return true if manager has value associated with key k, else
+        return false.
+        """
+        return self.search(key, None) is not None
+
+    #
+    # Ring management
+    #
+    def _slot(self, ts):
+        return int(ts // self.period) % self.size
+
+    def _rotate(self, now_slice):
+        # Make 'now_slice' the head, first expiring every bucket
+        # older than 'timeout' (including the one in the head's slot).
+        # Return the number of expired buckets and the values of the
+        # sessions which ended.
+        expired = 0
+        ended = []
+        stats = self.stats
+        where = self.where
+        for i, ts in enumerate(self.slices):
+            if ts is None or now_slice - ts <= self.timeout:
+                continue
+            bucket = self.buckets[i]
+            self.slices[i] = self.buckets[i] = None
+            for k, v in bucket.items():
+                if where.get(k) == ts:
+                    del where[k]
+                    ended.append(v)
+            expired += 1
+        if stats is not None and expired:
+            stats.incr('buckets_expired', expired)
+            stats.incr('sessions_ended', len(ended))
+        slot = self._slot(now_slice)
+        self.slices[slot] = now_slice
+        self.buckets[slot] = {}
+        self.head_slice = now_slice
+        return expired, ended
+
+    def _head(self, when):
+        # Return the head slice and bucket, the number of buckets
+        # which expired because the head moved, and the values of the
+        # sessions which ended with them.  Called with the lock held.
+        now_slice = timeslice(self.period, when)
+        expired, ended = 0, ()
+        if now_slice > self.head_slice:
+            expired, ended = self._rotate(now_slice)
+            stats = self.stats
+            if stats is not None:
+                stats.incr('head_rotations')
+        head_slice = self.head_slice
+        bucket = self.buckets[self._slot(head_slice)]
+        return head_slice, bucket, expired, ended
+
+    def notify_end(self, ended):
+        notify_ended(ended, self.session_end_events)
+
+    def search(self, k, default=None, when=None):   # 'when' for testing
+        with self.lock:
+            head_slice, head_bucket, expired, ended = self._head(when)
+            value = default
+            found = False
+            ts = self.where.get(k)
+            if ts is not None:
+                found = True
+                if ts == head_slice:
+                    value = head_bucket[k]
+                else:
+                    value = self._move_forward(k, ts, head_slice,
+                                               head_bucket)
+        stats = self.stats
+        if stats is not None:
+            if found:
+                depth = int((head_slice - ts) // self.period)
+                stats.incr_labeled('hits', depth)
+            else:
+                stats.incr('misses')
+        # subscribers run without the lock held
+        self.notify_end(ended)
+        return value
+
+    def _move_forward(self, k, ts, head_slice, head_bucket):
+        # Move a value found in an older bucket into the head bucket,
+        # unless it was found within the newest 'touch_granularity'
+        # timeslices.  Called with the lock held.
+        bucket = self.buckets[self._slot(ts)]
+        stats = self.stats
+        untouched = (self.touch_granularity - 1) * self.period
+        if head_slice - ts <= untouched:
+            if stats is not None:
+                stats.incr('copy_forwards_skipped')
+            return bucket[k]
+        value = head_bucket[k] = bucket.pop(k)
+        self.where[k] = head_slice
+        if stats is not None:
+            stats.incr('copy_forwards')
+            stats.incr('head_writes')
+        return value
+
+    def housekeep(self, when=None):
+        """ Expire the buckets (and end the sessions) which have timed
+        out, even if no lookup has moved the head since.  Return the
+        number of expired buckets."""
+        with self.lock:
+            head_slice, head_bucket, expired, ended = self._head(when)
+        self.notify_end(ended)
+        return expired
+
+    def set(self, k, v, when=None):
+        with self.lock:
+            head_slice, head_bucket, expired, ended = self._head(when)
+            ts = self.where.get(k)
+            if ts is not None and ts != head_slice:
+                self.buckets[self._slot(ts)].pop(k, None)
+            head_bucket[k] = v
+            self.where[k] = head_slice
+        stats = self.stats
+        if stats is not None:
+            stats.incr('head_writes')
+        self.notify_end(ended)
+
+    def set_if_modified(self, k, v, old_lm, when=None):
+        if v.last_modified is None:
+            return
+        if v.last_modified != old_lm:
+            self.set(k, v, when)
+            stats = self.stats
+            if stats is not None:
+                stats.incr('sessions_persisted')
+
+    def __len__(self):
+        return len(self.where)
+
+class MemorySessionManagerFactory(object):
+    """ Create a factory that is, in turn, capable of creating a
+    session manager.  Unlike
+    :class:`repoze.session.manager.FileStorageSessionManagerFactory`,
+    the session manager is a :class:`MemorySessionDataManager` kept
+    by the factory itself, so every call returns the same one.
+    ``timeout``, ``period`` and ``touch_granularity`` are as for the
+    other factories.  A ``connection_handler`` (such as a
+    ``ConnectionManager``) is accepted for compatibility but there is
+    no connection to hand it."""
+    def __init__(self, timeout=1200, period=20, touch_granularity=1):
+        self.timeout = timeout
+        self.period = period
+        self.touch_granularity = touch_granularity
+        self.manager = self.new_manager()
+
+    def __call__(self, connection_handler=None):
+        return self.manager
+
+    def new_manager(self):
+        return MemorySessionDataManager(
+            self.timeout, self.period,
+            touch_granularity=self.touch_granularity)
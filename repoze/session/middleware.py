@@ -0,0 +1,249 @@
+""" WSGI middleware providing a lazily loaded session.
+
+:class:`SessionMiddleware` puts a :class:`LazySession` into the WSGI
+environ (under ``repoze.session`` by default).  The session manager
+factory is not called, and so no ZODB connection is opened, until the
+application first touches the session; requests which never do (static
+assets, most bot traffic) cost no session work at all::
+
+  from repoze.session.manager import FileStorageSessionManagerFactory
+  from repoze.session.middleware import SessionMiddleware
+
+  factory = FileStorageSessionManagerFactory('sessions.fs', 'sessions')
+  app = SessionMiddleware(app, factory)
+
+  # in the application
+  session = environ['repoze.session']
+  session['first_name'] = 'fred'
+
+The session key is kept in a cookie, which is only sent once a new
+session has been modified.  A key the session manager doesn't know
+(or whose session has ended) is never used for a new session: the
+request switches to a fresh key, sent in a new cookie, so a key
+planted in the browser by someone else is never given a session.
+Invalidating the session (on logout, say) switches keys in the same
+way.
+Modify or invalidate the session before calling ``start_response``,
+as the cookie is decided then.
+
+Once the server has consumed and closed the response, the middleware
+commits the transaction if the session was used (ZODB writes nothing
+if neither the session nor the session manager changed) and then
+closes the connection; it aborts instead if the application raised.
+The application may therefore use the session while its response is
+being iterated.
+"""
+import binascii
+import os
+import re
+
+import transaction
+
+from repoze.session.manager import ConnectionManager
+from repoze.session._compat import SimpleCookie
+
+_KEY = re.compile(r'^[0-9a-f]{32}$')
+
+def new_key():
+    """ Return a new random session key. """
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+class LazySession(object):
+    """ A stand-in for the request's session data object, loading it
+    on first use.  It supports the mapping interface, ``invalidate``,
+    ``is_valid``, ``created`` and ``last_modified``."""
+    def __init__(self, factory, key, is_new):
+        self._factory = factory
+        self.key = key
+        self.is_new = is_new
+        self.rekeyed = False
+        self._cm = None
+        self._manager = None
+        self._sdo = None
+        self._lm = None
+
+    @property
+    def loaded(self):
+        """ True once the session has been loaded. """
+        return self._manager is not None
+
+    def load(self):
+        """ Return the session data object, loading it if needed. """
+        if self._sdo is None:
+            if self._manager is None:
+                self._cm = ConnectionManager()
+                self._manager = self._factory(self._cm)
+            if not self.is_new:
+                sdo = self._manager.query(self.key)
+                if sdo is None or not sdo.is_valid():
+                    # an expired or unknown (perhaps planted) key: never
+                    # create a session under a key the client chose
+                    self.key = new_key()
+                    self.is_new = True
+                    self.rekeyed = True
+            self._sdo = self._manager.get(self.key)
+            self._lm = self._sdo.last_modified
+        return self._sdo
+
+    def modified(self):
+        """ True if the session was loaded and changed since. """
+        sdo = self._sdo
+        if sdo is None:
+            return False
+        return sdo.last_modified != self._lm or not sdo.is_valid()
+
+    def finish(self, commit=True):
+        """ End the request: commit the transaction (or abort it if
+        ``commit`` is false) and close the connection. """
+        if self._manager is None:
+            return
+        try:
+            if commit:
+                transaction.commit()
+            else:
+                transaction.abort()
+        finally:
+            self._cm.close()
+
+    # ISessionData
+
+    def invalidate(self):
+        """ Invalidate the session and switch to a new key; the
+        session is empty and new from then on. """
+        self.load().invalidate()
+        self.key = new_key()
+        self.is_new = True
+        self.rekeyed = True
+        self._sdo = None
+
+    def is_valid(self):
+        return self.load().is_valid()
+
+    @property
+    def created(self):
+        return self.load().created
+
+    @property
+    def last_modified(self):
+        return self.load().last_modified
+
+    # IMapping
+
+    def __getattr__(self, name):
+        # get, keys, items, values, setdefault, pop, update, clear...
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __getitem__(self, k):
+        return self.load()[k]
+
+    def __setitem__(self, k, v):
+        self.load()[k] = v
+
+    def __delitem__(self, k):
+        del self.load()[k]
+
+    def __contains__(self, k):
+        return k in self.load()
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+class _FinishingIterable(object):
+    # The application's response, finishing the session when the
+    # server closes it (which WSGI requires it to do).
+    def __init__(self, app_iter, session):
+        self.app_iter = app_iter
+        self.session = session
+        self.failed = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.app_iter:
+                yield chunk
+        except:
+            self.failed = True
+            raise
+
+    def close(self):
+        try:
+            close = getattr(self.app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.session.finish(commit=not self.failed)
+
+class SessionMiddleware(object):
+    """ WSGI middleware putting a :class:`LazySession` for the session
+    manager produced by ``factory`` into the environ under
+    ``environ_key``.
+
+    The session key is read from and written to the cookie named
+    ``cookie_name``, with the given ``cookie_path``, ``cookie_secure``
+    and ``cookie_httponly`` attributes.  If ``commit`` is false the
+    middleware never commits, leaving that to something else (which
+    must also close the connection; see the ``pooled`` option of the
+    session manager factories)."""
+    def __init__(self, app, factory, environ_key='repoze.session',
+                 cookie_name='repoze.session', cookie_path='/',
+                 cookie_secure=False, cookie_httponly=True, commit=True):
+        self.app = app
+        self.factory = factory
+        self.environ_key = environ_key
+        self.cookie_name = cookie_name
+        self.cookie_path = cookie_path
+        self.cookie_secure = cookie_secure
+        self.cookie_httponly = cookie_httponly
+        self.commit = commit
+
+    def __call__(self, environ, start_response):
+        key = self.read_key(environ)
+        if key is None:
+            session = LazySession(self.factory, new_key(), True)
+        else:
+            session = LazySession(self.factory, key, False)
+        environ[self.environ_key] = session
+
+        def session_start_response(status, headers, exc_info=None):
+            if session.rekeyed or (session.is_new and session.modified()):
+                headers = list(headers)
+                headers.append(('Set-Cookie', self.cookie(session.key)))
+            return start_response(status, headers, exc_info)
+
+        try:
+            app_iter = self.app(environ, session_start_response)
+        except:
+            if self.commit:
+                session.finish(commit=False)
+            raise
+        if self.commit:
+            return _FinishingIterable(app_iter, session)
+        return app_iter
+
+    def read_key(self, environ):
+        """ Return the session key in the request's cookie, or None. """
+        header = environ.get('HTTP_COOKIE')
+        if not header:
+            return None
+        cookies = SimpleCookie()
+        try:
+            cookies.load(header)
+        except Exception:
+            return None
+        morsel = cookies.get(self.cookie_name)
+        if morsel is None or not _KEY.match(morsel.value):
+            return None
+        return morsel.value
+
+    def cookie(self, key):
+        """ Return the ``Set-Cookie`` header value for ``key``. """
+        value = '%s=%s; Path=%s' % (self.cookie_name, key, self.cookie_path)
+        if self.cookie_secure:
+            value += '; Secure'
+        if self.cookie_httponly:
+            value += '; HttpOnly'
+        return value
@@ -0,0 +1,437 @@
+""" A session data manager keeping its sessions in an SQLite database.
+
+:class:`SQLiteSessionDataManager` stores one row per session key,
+holding the pickled session data and the timeslice the session was
+last accessed in (indexed), in a database file in WAL mode.  Several
+processes on one host may share the file, without a ZEO server.
+
+Expiry is a single indexed ``DELETE ... RETURNING`` of the rows whose
+timeslice is older than ``timeout``, run whenever a new timeslice
+starts (or by :meth:`SQLiteSessionDataManager.housekeep` if
+``external_housekeeping`` is true); one ``ISessionEndEvent`` is sent
+for each deleted session, and one ``ISessionsEndedEvent`` for all of
+them, in whichever process deleted them.  Deleted sessions are only
+unpickled if something subscribes to either event.
+
+Session data objects are unpickled once per transaction and key.
+Those which were modified (or invalidated) are written back, and
+sessions which need their timeslice bumped are touched, in one SQLite
+transaction from a before-commit hook of the current transaction.
+Like the ZODB session manager, a session created by ``get`` is only
+stored if it was modified.  Keys must be text, bytes or integers.
+
+Each row carries a version, bumped by every write.  A session read in
+a transaction is only written back if its row still has the version
+it was read with, and a new session is only inserted if no live row
+has its key; otherwise the commit fails with a ``ConflictError``, to
+be retried as with ZODB.  There is no conflict resolution: concurrent
+changes to the same session always conflict.  ``set`` is a blind
+write, replacing whatever is stored.
+"""
+import re
+import sqlite3
+import threading
+
+import transaction
+from zope.interface import implementer
+from zope.event import notify
+from ZODB.POSException import ConflictError
+
+from repoze.session.data import SessionData
+from repoze.session.interfaces import ISessionDataManager
+from repoze.session.manager import SessionBeginEvent
+from repoze.session.manager import end_listeners
+from repoze.session.manager import notify_ended
+from repoze.session.manager import timeslice
+from repoze.session._compat import pickle
+
+# DELETE ... RETURNING needs SQLite 3.35
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+_PROTOCOL = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS %(table)s (
+    key PRIMARY KEY,
+    slice INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS %(table)s_slice ON %(table)s (slice);
+"""
+
+class _Loaded(object):
+    # A value read (or created, or set) in the current transaction,
+    # and what it looked like then.
+    __slots__ = ('value', 'slice', 'when', 'created', 'force', 'version',
+                 'lm', 'iv')
+
+    def __init__(self, value, slice, when, created=False, force=False,
+                 version=None):
+        self.value = value
+        self.slice = slice # the stored timeslice, None if not stored
+        self.when = when
+        self.created = created
+        self.force = force
+        self.version = version # of the row read, None if none was
+        self.lm = getattr(value, 'last_modified', None)
+        self.iv = getattr(value, '_iv', False)
+
+    def modified(self):
+        value = self.value
+        if self.force:
+            return True
+        if self.created and value.last_modified is None:
+            # see SessionDataManager.set_if_modified
+            return False
+        return (getattr(value, 'last_modified', None) != self.lm
+                or getattr(value, '_iv', False) != self.iv)
+
+@implementer(ISessionDataManager)
+class SQLiteSessionDataManager(object):
+    """ An object that manages sessions in the SQLite database
+    ``filename``, in table ``table`` (created if needed).
+
+    ``timeout``, ``period`` and ``touch_granularity`` have the same
+    meaning as for :class:`repoze.session.manager.SessionDataManager`:
+    a session expires ``timeout`` seconds after the timeslice it was
+    last accessed in, and its row is only touched when it was last
+    accessed more than ``touch_granularity`` timeslices ago.  Each
+    thread uses its own SQLite connection; ``busy_timeout`` is how
+    long (in seconds) a connection waits for another one's write.
+    """
+
+    _DATA_TYPE = SessionData
+
+    # Whether to send an ISessionEndEvent for each ended session (see
+    # SessionDataManager)
+    session_end_events = True
+
+    # Process-local statistics (see repoze.session.stats)
+    stats = None
+
+    nonlazy = False # for unit testing
+
+    def __init__(self, filename, timeout=1200, period=20, table='sessions',
+                 touch_granularity=1, external_housekeeping=False,
+                 busy_timeout=30):
+        if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', table):
+            raise ValueError('Invalid table name %r' % table)
+        self.filename = filename
+        self.timeout = timeout # seconds
+        self.period = period   # seconds
+        self.table = table
+        self.touch_granularity = touch_granularity
+        self.external_housekeeping = external_housekeeping
+        self.busy_timeout = busy_timeout
+        self.head_slice = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        conn = self.connection()
+        conn.executescript(_SCHEMA % {'table': table})
+        columns = [row[1] for row in
+                   conn.execute('PRAGMA table_info(%s)' % table)]
+        if 'version' not in columns:
+            # created by an earlier version
+            conn.execute('ALTER TABLE %s ADD COLUMN version INTEGER '
+                         'NOT NULL DEFAULT 0' % table)
+
+    def connection(self):
+        """ Return the current thread's SQLite connection. """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # autocommit; explicit transactions are begun where needed
+            conn = sqlite3.connect(self.filename, timeout=self.busy_timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """ Close the current thread's SQLite connection. """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+
+    #   ISessionDataManager implementation
+
+    def get(self, key, when=None):  # 'when' for testing
+        """
+        If an object already exists in the manager with key "k", it
+        is returned.
+
+        Otherwise, create a new subobject of the type supported by this
+        container with key "k" and return it.
+        """
+        sdo = self.search(key, when=when)
+
+        if sdo is None or not sdo.is_valid():
+            sdo = self._DATA_TYPE()
+            if self.nonlazy:
+                self.set(key, sdo, when)
+            else:
+                # written at commit time if modified by then, replacing
+                # the stored row (if any) read by 'search'
+                loaded = self._loaded()
+                old = loaded.get(key)
+                version = None
+                if old is not None:
+                    version = old.version
+                    if old.modified():
+                        # invalidated in this transaction; written
+                        # instead unless the new session is modified
+                        self._local.invalidated[key] = old
+                loaded[key] = _Loaded(sdo, None, when, created=True,
+                                      version=version)
+
+            stats = self.stats
+            if stats is not None:
+                stats.incr('sessions_created')
+
+            notify(SessionBeginEvent(sdo))
+
+        return sdo
+
+    def query(self, key, default=None):
+        """
+        Return value associated with key k.  If value associated with
+        k does not exist, return default.
+        """
+        return self.search(key, default)
+
+    def get_many(self, keys, when=None):  # 'when' for testing
+        """
+        Return a dict mapping each of ``keys`` to its session data
+        object, creating new ones as ``get`` does.
+        """
+        result = {}
+        for key in keys:
+            if key not in result:
+                result[key] = self.get(key, when)
+        return result
+
+    def query_many(self, keys, default=None):
+        """
+        Return a dict mapping each of ``keys`` to its value, or to
+        ``default`` if it has none.
+        """
+        return dict([(key, self.search(key, default)) for key in keys])
+
+    def has_key(self, key):
+        """
+        Return true if manager has value associated with key k, else
+        return false.
+        """
+        return self.search(key, None) is not None
+
+    #
+    # Storage
+    #
+    def _loaded(self):
+        # The values read in the current transaction, by key; the
+        # first call in a transaction registers the hook which writes
+        # back the modified ones.  Sessions invalidated and then
+        # replaced by 'get' in the transaction are kept apart, in
+        # local.invalidated, so that the invalidation is not lost.
+        local = self._local
+        txn = transaction.get()
+        if getattr(local, 'txn', None) is not txn:
+            local.txn = txn
+            local.loaded = {}
+            local.invalidated = {}
+            txn.addBeforeCommitHook(self._flush,
+                                    (local.loaded, local.invalidated))
+        return local.loaded
+
+    def _head(self, when):
+        # Return the current timeslice, expiring old sessions first if
+        # a new one has started.
+        now_slice = int(timeslice(self.period, when))
+        with self._lock:
+            rotated = self.head_slice is None or now_slice > self.head_slice
+            if rotated:
+                self.head_slice = now_slice
+        if rotated:
+            stats = self.stats
+            if stats is not None:
+                stats.incr('head_rotations')
+            if not self.external_housekeeping:
+                self.housekeep(now_slice)
+        return now_slice
+
+    def search(self, k, default=None, when=None):   # 'when' for testing
+        head_slice = self._head(when)
+        loaded = self._loaded()
+        stats = self.stats
+
+        entry = loaded.get(k)
+        if entry is None:
+            row = self.connection().execute(
+                'SELECT slice, data, version FROM %s '
+                'WHERE key = ? AND slice >= ?'
+                % self.table, (k, head_slice - self.timeout)).fetchone()
+            if row is None:
+                if stats is not None:
+                    stats.incr('misses')
+                return default
+            entry = loaded[k] = _Loaded(pickle.loads(row[1]), row[0], when,
+                                        version=row[2])
+            if stats is not None:
+                depth = int((head_slice - row[0]) // self.period)
+                stats.incr_labeled('hits', depth)
+        elif entry.slice is None and not entry.modified():
+            # created by 'get' in this transaction but not stored
+            return default
+
+        return entry.value
+
+    def set(self, k, v, when=None):
+        """ Store ``v`` under ``k`` when the transaction commits. """
+        self._loaded()[k] = _Loaded(v, None, when, force=True)
+
+    def _flush(self, loaded, invalidated):
+        # Write back what changed in the transaction, and touch the
+        # sessions last accessed before the touch granularity.
+        writes = []
+        touches = []
+        skipped = persisted = 0
+        untouched = (self.touch_granularity - 1) * self.period
+        for k, entry in loaded.items():
+            head_slice = int(timeslice(self.period, entry.when))
+            if not entry.modified() and k in invalidated:
+                entry = invalidated[k]
+            if entry.modified():
+                writes.append((k, head_slice, entry))
+                if entry.created:
+                    persisted += 1
+            elif entry.slice is not None and entry.slice < head_slice:
+                if head_slice - entry.slice > untouched:
+                    touches.append((head_slice, k))
+                else:
+                    skipped += 1
+
+        if writes or touches:
+            conn = self.connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for k, head_slice, entry in writes:
+                    self._write(conn, k, head_slice, entry)
+                if touches:
+                    conn.executemany(
+                        'UPDATE %s SET slice = ? WHERE key = ?' % self.table,
+                        touches)
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+
+        stats = self.stats
+        if stats is not None:
+            if writes:
+                stats.incr('head_writes', len(writes))
+            if persisted:
+                stats.incr('sessions_persisted', persisted)
+            if touches:
+                stats.incr('copy_forwards', len(touches))
+            if skipped:
+                stats.incr('copy_forwards_skipped', skipped)
+
+    def _write(self, conn, k, head_slice, entry):
+        table = self.table
+        data = sqlite3.Binary(pickle.dumps(entry.value, _PROTOCOL))
+        if entry.version is not None:
+            # unchanged since read?
+            written = conn.execute(
+                'UPDATE %s SET slice = ?, data = ?, version = version + 1 '
+                'WHERE key = ? AND version = ?' % table,
+                (head_slice, data, k, entry.version)).rowcount
+        elif entry.force:
+            conn.execute(
+                'INSERT OR REPLACE INTO %s (key, slice, data, version) '
+                'VALUES (?, ?, ?, COALESCE((SELECT version FROM %s '
+                'WHERE key = ?), 0) + 1)' % (table, table),
+                (k, head_slice, data, k))
+            written = 1
+        else:
+            # a new session; it may only replace an expired one which
+            # housekeeping has not deleted yet
+            written = conn.execute(
+                'INSERT OR IGNORE INTO %s (key, slice, data) '
+                'VALUES (?, ?, ?)' % table, (k, head_slice, data)).rowcount
+            if not written:
+                written = conn.execute(
+                    'UPDATE %s SET slice = ?, data = ?, '
+                    'version = version + 1 WHERE key = ? AND slice < ?'
+                    % table, (head_slice, data, k,
+                              head_slice - self.timeout)).rowcount
+        if not written:
+            raise ConflictError('Session %r changed concurrently' % (k,))
+
+    def housekeep(self, when=None):
+        """ Delete the sessions which have timed out and send an
+        ``ISessionEndEvent`` for each (and an ``ISessionsEndedEvent``
+        for all of them).  ``search`` does this whenever
+        a new timeslice starts unless ``external_housekeeping`` is
+        true.  Return the number of ended sessions."""
+        now_slice = int(timeslice(self.period, when))
+        oldest = now_slice - self.timeout
+        conn = self.connection()
+        if HAS_RETURNING:
+            rows = conn.execute(
+                'DELETE FROM %s WHERE slice < ? RETURNING data'
+                % self.table, (oldest,)).fetchall()
+        else: # pragma: no cover
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute(
+                    'SELECT data FROM %s WHERE slice < ?' % self.table,
+                    (oldest,)).fetchall()
+                conn.execute(
+                    'DELETE FROM %s WHERE slice < ?' % self.table, (oldest,))
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        stats = self.stats
+        if stats is not None and rows:
+            stats.incr('sessions_ended', len(rows))
+        each = self.session_end_events
+        notify_each, notify_all = end_listeners(each)
+        if rows and (notify_each or notify_all):
+            notify_ended([pickle.loads(row[0]) for row in rows], each)
+        return len(rows)
+
+    def __len__(self):
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+class SQLiteSessionManagerFactory(object):
+    """ Create a factory that is, in turn, capable of creating a
+    session manager.  The session manager is a
+    :class:`SQLiteSessionDataManager` storing its sessions in the
+    SQLite database ``filename``, in the table named ``appname``;
+    every call returns the same one.  ``timeout``, ``period``,
+    ``touch_granularity`` and ``external_housekeeping`` are as for
+    the other factories.  A ``connection_handler`` (such as a
+    ``ConnectionManager``) is accepted for compatibility but there is
+    no ZODB connection to hand it."""
+    def __init__(self, filename, appname, timeout=1200, period=20,
+                 touch_granularity=1, external_housekeeping=False):
+        self.filename = filename
+        self.appname = appname
+        self.timeout = timeout
+        self.period = period
+        self.touch_granularity = touch_granularity
+        self.external_housekeeping = external_housekeeping
+        self.manager = self.new_manager()
+
+    def __call__(self, connection_handler=None):
+        return self.manager
+
+    def new_manager(self):
+        return SQLiteSessionDataManager(
+            self.filename, self.timeout, self.period, table=self.appname,
+            touch_granularity=self.touch_granularity,
+            external_housekeeping=self.external_housekeeping)
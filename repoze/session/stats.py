@@ -0,0 +1,139 @@
+""" Process-local runtime statistics for session managers.
+
+Statistics are off by default.  :func:`enable` attaches a
+:class:`SessionStats` object to the session classes as the ``stats``
+class attribute, so it is never persisted and is shared by every
+session manager in the process (including the instances ZODB creates
+to resolve conflicts)::
+
+  from repoze.session import stats
+  counters = stats.enable()
+  ...
+  counters.as_dict()
+  counters.to_prometheus()
+
+Counting is a dict update per event and is not locked, so counts from
+concurrent threads are approximate.  Note that ZODB resolves conflicts
+where the storage lives: with ZEO, the ``conflicts_*`` counters are
+collected in the ZEO server process.
+"""
+
+# name: (help, label name or None)
+COUNTERS = {
+    'hits': ('Sessions found, by depth of the bucket they were found in '
+             '(0 is the head bucket)', 'depth'),
+    'misses': ('Searches which found no session', None),
+    'memo_hits': ('Lookups answered from the current transaction\'s '
+                  'memo without searching', None),
+    'copy_forwards': ('Sessions copied forward into the head bucket', None),
+    'copy_forwards_skipped': ('Sessions found in an older bucket but '
+                              'within the touch granularity', None),
+    'head_writes': ('Writes to the head bucket', None),
+    'sessions_created': ('Session data objects created by get', None),
+    'sessions_persisted': ('Lazily created session data objects stored '
+                           'because they were modified', None),
+    'head_rotations': ('Head buckets replaced by the bucket of a new '
+                       'timeslice', None),
+    'period_changes': ('Periods changed by adaptive session managers',
+                       None),
+    'buckets_expired': ('Buckets expired by housekeeping', None),
+    'sessions_ended': ('Sessions ended by housekeeping', None),
+    'conflicts_resolved': ('Write conflicts resolved, by object', 'object'),
+    'conflicts_raised': ('Write conflicts which could not be resolved, '
+                         'by object', 'object'),
+    'compressed_states': ('Session data states at or above the '
+                          'compression threshold', None),
+    'compression_bytes_in': ('Bytes of session data states before '
+                             'compression', None),
+    'compression_bytes_out': ('Bytes of session data states after '
+                              'compression', None),
+    }
+
+class SessionStats(object):
+    """ A set of named counters, some of them split by a label. """
+    def __init__(self):
+        self.counters = {}
+
+    def incr(self, name, n=1):
+        counters = self.counters
+        counters[name] = counters.get(name, 0) + n
+
+    def incr_labeled(self, name, value, n=1):
+        key = (name, value)
+        counters = self.counters
+        counters[key] = counters.get(key, 0) + n
+
+    def get(self, name, value=None):
+        if value is not None:
+            return self.counters.get((name, value), 0)
+        return self.counters.get(name, 0)
+
+    def reset(self):
+        self.counters = {}
+
+    def compression_ratio(self):
+        """ Return the compressed size of the compressed session data
+        states as a fraction of their uncompressed size, or None if
+        nothing was compressed."""
+        bytes_in = self.get('compression_bytes_in')
+        if not bytes_in:
+            return None
+        return float(self.get('compression_bytes_out')) / bytes_in
+
+    def as_dict(self):
+        """ Return the counters as a dict; labeled counters map to a
+        dict of label value to count."""
+        result = {}
+        for key, count in self.counters.items():
+            if isinstance(key, tuple):
+                name, value = key
+                result.setdefault(name, {})[value] = count
+            else:
+                result[key] = count
+        return result
+
+    def to_prometheus(self, prefix='repoze_session'):
+        """ Return the counters in the Prometheus text exposition
+        format."""
+        lines = []
+        counters = self.as_dict()
+        for name in sorted(counters):
+            help, label = COUNTERS.get(name, (name, 'label'))
+            metric = '%s_%s_total' % (prefix, name)
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s counter' % metric)
+            counts = counters[name]
+            if isinstance(counts, dict):
+                for value in sorted(counts):
+                    lines.append('%s{%s="%s"} %d' % (
+                        metric, label, value, counts[value]))
+            else:
+                lines.append('%s %d' % (metric, counts))
+        return '\n'.join(lines) + '\n'
+
+def _stats_classes():
+    from repoze.session.bucket import MergingBucket
+    from repoze.session.data import SessionData
+    from repoze.session.manager import SessionDataManager
+    from repoze.session.memory import MemorySessionDataManager
+    from repoze.session.sqlite import SQLiteSessionDataManager
+    return (SessionDataManager, SessionData, MemorySessionDataManager,
+            SQLiteSessionDataManager, MergingBucket)
+
+def enable(stats=None):
+    """ Start collecting statistics into ``stats`` (a new
+    :class:`SessionStats` by default); return it."""
+    if stats is None:
+        stats = SessionStats()
+    for klass in _stats_classes():
+        klass.stats = stats
+    return stats
+
+def disable():
+    """ Stop collecting statistics. """
+    for klass in _stats_classes():
+        klass.stats = None
+
+def get():
+    """ Return the active :class:`SessionStats`, or None. """
+    return _stats_classes()[0].stats
@@ -0,0 +1,150 @@
+""" Tests of repoze.session.aio, imported by test_aio on Python 3.5+
+only: this module does not compile on older versions. """
+import unittest
+
+class AsyncSessionManagerTests(unittest.TestCase):
+    def setUp(self):
+        import asyncio
+        self.factory = DummyFactory()
+        # an AsyncSessionManager belongs to one event loop
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        manager = getattr(self, 'manager', None)
+        if manager is not None:
+            manager.close()
+        self.loop.close()
+        self.factory.db.close()
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def _makeOne(self, workers=2):
+        from repoze.session.aio import AsyncSessionManager
+        self.manager = AsyncSessionManager(self.factory, workers)
+        return self.manager
+
+    def test_bad_workers(self):
+        from repoze.session.aio import AsyncSessionManager
+        self.assertRaises(ValueError, AsyncSessionManager, self.factory, 0)
+
+    def test_get_commit_query(self):
+        manager = self._makeOne()
+        async def write():
+            async with manager.session() as session:
+                data = await session.get('a')
+                data['x'] = 1
+                await session.commit()
+        async def read():
+            async with manager.session() as session:
+                data = await session.query('a')
+                missing = await session.query('b', 'default')
+                return dict(data), missing
+        self._run(write())
+        self.assertEqual(self._run(read()), ({'x': 1}, 'default'))
+
+    def test_uncommitted_changes_aborted(self):
+        manager = self._makeOne(workers=1)
+        async def write():
+            async with manager.session() as session:
+                data = await session.get('a')
+                data['x'] = 1
+                await session.commit()
+                data['x'] = 2
+        async def read():
+            async with manager.session() as session:
+                return dict(await session.query('a'))
+        self._run(write())
+        self.assertEqual(self._run(read()), {'x': 1})
+
+    def test_abort(self):
+        manager = self._makeOne(workers=1)
+        async def write():
+            async with manager.session() as session:
+                data = await session.get('a')
+                data['x'] = 1
+                await session.abort()
+                return await session.query('a')
+        self.assertEqual(self._run(write()), None)
+
+    def test_one_connection_per_worker(self):
+        import asyncio
+        manager = self._makeOne(workers=2)
+        async def use(i):
+            async with manager.session() as session:
+                await session.query('a')
+                await asyncio.sleep(0.01)
+        async def main():
+            await asyncio.gather(*[use(i) for i in range(6)])
+        self._run(main())
+        self._run(main())
+        self.assertEqual(self.factory.opened, 2)
+
+    def test_at_most_workers_active(self):
+        import asyncio
+        manager = self._makeOne(workers=2)
+        active = []
+        peak = []
+        async def use():
+            async with manager.session() as session:
+                active.append(1)
+                peak.append(len(active))
+                await session.query('a')
+                await asyncio.sleep(0.01)
+                active.pop()
+        async def main():
+            await asyncio.gather(*[use() for i in range(5)])
+        self._run(main())
+        self.assertEqual(max(peak), 2)
+
+    def test_inactive_session(self):
+        manager = self._makeOne()
+        session = manager.session()
+        self.assertRaises(RuntimeError, session._run, 'get')
+
+    def test_closed_session(self):
+        manager = self._makeOne()
+        async def use():
+            async with manager.session() as session:
+                await session.query('a')
+            return session
+        session = self._run(use())
+        for coro in (session.get('a'), session.query('a'),
+                     session.commit(), session.abort()):
+            self.assertRaises(RuntimeError, self._run, coro)
+
+    def test_begin_failure_releases_worker(self):
+        manager = self._makeOne(workers=1)
+        self.factory.fail = True
+        async def use():
+            async with manager.session() as session:
+                pass # pragma: no cover
+        self.assertRaises(ValueError, self._run, use())
+        self.factory.fail = False
+        async def read():
+            async with manager.session() as session:
+                return await session.query('a', 'ok')
+        self.assertEqual(self._run(read()), 'ok')
+
+class DummyFactory(object):
+    opened = 0
+    fail = False
+
+    def __init__(self):
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        self.db = DB(MappingStorage())
+
+    def __call__(self, connection_handler=None):
+        from repoze.session.manager import SessionDataManager
+        import transaction
+        if self.fail:
+            raise ValueError
+        self.opened += 1
+        conn = self.db.open()
+        connection_handler(conn)
+        root = conn.root()
+        if 'sessions' not in root:
+            root['sessions'] = SessionDataManager(1200, 20)
+            transaction.commit()
+        return root['sessions']
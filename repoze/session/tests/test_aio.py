@@ -0,0 +1,5 @@
+import sys
+
+if sys.version_info >= (3, 5): # pragma NO COVER
+    # the tests use coroutine syntax, which older versions can't compile
+    from repoze.session.tests._aio import AsyncSessionManagerTests
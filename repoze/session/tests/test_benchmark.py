@@ -0,0 +1,441 @@
+import unittest
+
+try:
+    import ZEO
+except ImportError: # pragma: no cover
+    ZEO = None
+
+class TestPercentile(unittest.TestCase):
+    def _callFUT(self, samples, fraction):
+        from repoze.session.benchmark.hotpaths import percentile
+        return percentile(samples, fraction)
+
+    def test_empty(self):
+        self.assertEqual(self._callFUT([], 0.5), 0.0)
+
+    def test_it(self):
+        samples = list(range(100, 0, -1))
+        self.assertEqual(self._callFUT(samples, 0.0), 1)
+        self.assertEqual(self._callFUT(samples, 0.5), 51)
+        self.assertEqual(self._callFUT(samples, 0.99), 99)
+        self.assertEqual(self._callFUT(samples, 1.0), 100)
+
+class TestScenario(unittest.TestCase):
+    def _makeOne(self, **kw):
+        from repoze.session.benchmark.hotpaths import Scenario
+        return Scenario(**kw)
+
+    def test_run_mapping(self):
+        from repoze.session.benchmark.hotpaths import OPERATIONS
+        from repoze.session.benchmark.hotpaths import POSITIONS
+        scenario = self._makeOne(sessions=60, depth=3, ops=2)
+        results = scenario.run()
+        for operation in OPERATIONS:
+            for position in POSITIONS:
+                timings = results[(operation, position)]
+                self.assertEqual(len(timings.samples), 2)
+        # hits in the head bucket write nothing
+        self.assertEqual(results[('query', 'head')].bytes_per_commit, 0)
+        # hits in the tail bucket are copied forward into the head
+        self.failUnless(results[('query', 'tail')].bytes_per_commit > 0)
+        # lazily created sessions which are never modified are not stored
+        self.assertEqual(results[('get', 'miss')].bytes_per_commit, 0)
+        self.failUnless(
+            results[('set_if_modified', 'miss')].bytes_per_commit > 0)
+
+    def test_run_file_appendonlydict(self):
+        scenario = self._makeOne(storage='file', sessions=10, depth=2, ops=1,
+                                 bucket_type='appendonlydict')
+        results = scenario.run()
+        self.failUnless(results[('get', 'tail')].bytes_per_commit > 0)
+
+    def test_touch_granularity(self):
+        scenario = self._makeOne(sessions=12, depth=2, ops=1,
+                                 touch_granularity=2)
+        results = scenario.run()
+        # the tail is within the newest two slices; nothing is copied
+        self.assertEqual(results[('query', 'tail')].bytes_per_commit, 0)
+
+    def test_clock_pinned(self):
+        import time
+        wall_clock = time.time
+        ticks = [wall_clock()]
+        def racing_clock():
+            # every reading crosses a timeslice boundary
+            ticks[0] += 20
+            return ticks[0]
+        time.time = racing_clock
+        try:
+            scenario = self._makeOne(sessions=30, depth=3, ops=2, period=20)
+            results = scenario.run()
+            self.failUnless(time.time is racing_clock)
+        finally:
+            time.time = wall_clock
+        # the head was never replaced, so head hits still write nothing
+        self.assertEqual(results[('query', 'head')].bytes_per_commit, 0)
+        self.assertEqual(results[('has_key', 'head')].bytes_per_commit, 0)
+
+    def test_unknown_storage(self):
+        scenario = self._makeOne(storage='nope')
+        self.assertRaises(ValueError, scenario.run)
+
+class TestPinnedClock(unittest.TestCase):
+    def _callFUT(self, when=None):
+        from repoze.session.benchmark.hotpaths import pinned_clock
+        return pinned_clock(when)
+
+    def test_it(self):
+        import time
+        wall_clock = time.time
+        with self._callFUT(1000.5) as when:
+            self.assertEqual(when, 1000.5)
+            self.assertEqual(time.time(), 1000.5)
+        self.failUnless(time.time is wall_clock)
+
+    def test_default_now(self):
+        import time
+        before = time.time()
+        with self._callFUT() as when:
+            self.failUnless(when >= before)
+            self.assertEqual(time.time(), when)
+
+    def test_restored_after_error(self):
+        import time
+        wall_clock = time.time
+        def run():
+            with self._callFUT(1000):
+                raise ValueError
+        self.assertRaises(ValueError, run)
+        self.failUnless(time.time is wall_clock)
+
+class TestConcurrencyScenario(unittest.TestCase):
+    def _makeOne(self, **kw):
+        from repoze.session.benchmark.hotpaths import ConcurrencyScenario
+        return ConcurrencyScenario(**kw)
+
+    def test_run(self):
+        for bucket_type in 'oobtree', 'partitioned':
+            scenario = self._makeOne(sessions=5, threads=2, ops=3,
+                                     bucket_type=bucket_type, think=0)
+            result = scenario.run()
+            self.assertEqual(result.commits + result.failures, 6)
+            self.failUnless(result.commits_per_sec > 0)
+            self.failUnless(result.bytes_per_commit > 0)
+            self.failUnless(0 <= result.conflict_rate < 1)
+
+    def test_empty_result(self):
+        from repoze.session.benchmark.hotpaths import ConcurrencyResult
+        result = ConcurrencyResult()
+        self.assertEqual(result.commits_per_sec, 0.0)
+        self.assertEqual(result.conflict_rate, 0.0)
+        self.assertEqual(result.bytes_per_commit, 0.0)
+
+class TestMain(unittest.TestCase):
+    def test_it(self):
+        from repoze.session._compat import StringIO
+        from repoze.session.benchmark.hotpaths import main
+        out = StringIO()
+        main(['bench', '--storage', 'mapping', '--sessions', '20',
+              '--depth', '2', '--ops', '1'], out)
+        output = out.getvalue()
+        self.failUnless('mapping/oobtree sessions=20 depth=2' in output)
+        self.failUnless('touch=1' in output)
+        self.failUnless('set_if_modified' in output)
+
+    def test_concurrency(self):
+        from repoze.session._compat import StringIO
+        from repoze.session.benchmark.hotpaths import main
+        out = StringIO()
+        main(['bench', '--storage', 'file', '--sessions', '5',
+              '--bucket-type', 'partitioned', '--concurrency', '2',
+              '--ops', '2'], out)
+        output = out.getvalue()
+        self.failUnless('file/partitioned sessions=5 threads=2' in output)
+        self.failUnless('conflict%' in output)
+
+class TestEnginesScenario(unittest.TestCase):
+    def _makeOne(self, **kw):
+        from repoze.session.benchmark.engines import Scenario
+        return Scenario(**kw)
+
+    def test_run(self):
+        from repoze.session.benchmark.engines import ENGINES
+        from repoze.session.benchmark.engines import WORKLOADS
+        for engine in ENGINES:
+            results = self._makeOne(engine=engine, sessions=5, ops=2).run()
+            for workload in WORKLOADS:
+                self.assertEqual(len(results[workload].samples), 2)
+
+    def test_unknown_engine(self):
+        scenario = self._makeOne(engine='nope')
+        self.assertRaises(ValueError, scenario.run)
+
+class TestEnginesMain(unittest.TestCase):
+    def test_it(self):
+        from repoze.session._compat import StringIO
+        from repoze.session.benchmark.engines import main
+        out = StringIO()
+        main(['bench', '--engine', 'memory,sqlite', '--sessions', '5',
+              '--ops', '1'], out)
+        output = out.getvalue()
+        self.failUnless('memory sessions=5' in output)
+        self.failUnless('sqlite sessions=5' in output)
+
+class TestConflictKind(unittest.TestCase):
+    def _callFUT(self, class_name):
+        from repoze.session.benchmark.conflicts import conflict_kind
+        return conflict_kind(class_name)
+
+    def test_it(self):
+        self.assertEqual(
+            self._callFUT('repoze.session.manager.SessionDataManager'),
+            'manager')
+        self.assertEqual(self._callFUT('BTrees.OOBTree.OOBTree'), 'bucket')
+        self.assertEqual(
+            self._callFUT('repoze.session.bucket.MergingBucket'), 'bucket')
+        self.assertEqual(self._callFUT('repoze.session.data.SessionData'),
+                         'session')
+        self.assertEqual(self._callFUT('persistent.list.PersistentList'),
+                         'other')
+        self.assertEqual(self._callFUT(None), 'other')
+
+class TestConflictClassName(unittest.TestCase):
+    def _callFUT(self, error, manager=None):
+        from repoze.session.benchmark.conflicts import conflict_class_name
+        return conflict_class_name(error, manager)
+
+    def test_it(self):
+        from ZODB.POSException import ConflictError
+        from ZODB.POSException import ReadConflictError
+        from repoze.session.data import SessionData
+        sdo = SessionData()
+        sdo._p_oid = b'\0' * 8
+        self.assertEqual(self._callFUT(ConflictError(object=sdo)),
+                         'repoze.session.data.SessionData')
+        error = ReadConflictError(oid=sdo._p_oid)
+        self.assertEqual(self._callFUT(error), '')
+        class DummyJar(object):
+            def get(self, oid):
+                if oid != sdo._p_oid:
+                    raise KeyError(oid)
+                return sdo
+        class DummyManager(object):
+            _p_jar = DummyJar()
+        self.assertEqual(self._callFUT(error, DummyManager()),
+                         'repoze.session.data.SessionData')
+        error = ReadConflictError(oid=b'\1' * 8)
+        self.assertEqual(self._callFUT(error, DummyManager()), '')
+
+class TestParseMix(unittest.TestCase):
+    def _callFUT(self, value):
+        from repoze.session.benchmark.conflicts import parse_mix
+        return parse_mix(value)
+
+    def test_it(self):
+        self.assertEqual(self._callFUT('new=1,read=2.5,'),
+                         {'new': 1.0, 'read': 2.5})
+
+    def test_unknown_operation(self):
+        self.assertRaises(ValueError, self._callFUT, 'new=1,nope=1')
+
+    def test_empty(self):
+        self.assertRaises(ValueError, self._callFUT, 'new=0')
+
+class TestPopularityChooser(unittest.TestCase):
+    def _callFUT(self, popularity, sessions, skew=1.0):
+        from repoze.session.benchmark.conflicts import popularity_chooser
+        return popularity_chooser(popularity, sessions, skew)
+
+    def _counts(self, chooser):
+        import random
+        rng = random.Random(0)
+        counts = [0] * len(chooser.items)
+        for i in range(2000):
+            counts[chooser.choose(rng)] += 1
+        return counts
+
+    def test_uniform(self):
+        counts = self._counts(self._callFUT('uniform', 4))
+        self.failUnless(min(counts) > 400)
+
+    def test_zipf(self):
+        counts = self._counts(self._callFUT('zipf', 10, 2.0))
+        # the most popular session is picked about 60% of the time
+        self.failUnless(counts[0] > 1000)
+        self.failUnless(counts[0] > counts[1] > counts[9])
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, self._callFUT, 'nope', 10)
+
+class TestLoadResult(unittest.TestCase):
+    def _makeOne(self):
+        from repoze.session.benchmark.conflicts import LoadResult
+        return LoadResult()
+
+    def test_empty(self):
+        result = self._makeOne()
+        self.assertEqual(result.units_per_sec, 0.0)
+        self.assertEqual(result.conflict_rate, 0.0)
+        self.assertEqual(result.conflicts_by_kind,
+                         {'manager': 0, 'bucket': 0, 'session': 0,
+                          'other': 0})
+
+    def test_add(self):
+        result = self._makeOne()
+        one = self._makeOne()
+        one.units = 3
+        one.conflicts = {'BTrees.OOBTree.OOBTree': 1}
+        one.retries = {0: 2, 1: 1}
+        one.operations = {'write': 3}
+        one.elapsed = 2.0
+        two = self._makeOne()
+        two.units = 1
+        two.failures = 1
+        two.conflicts = {'BTrees.OOBTree.OOBTree': 1,
+                         'repoze.session.data.SessionData': 6}
+        two.retries = {0: 1}
+        two.operations = {'read': 1}
+        two.elapsed = 1.0
+        result.add(one)
+        result.add(two)
+        self.assertEqual(result.units, 4)
+        self.assertEqual(result.failures, 1)
+        self.assertEqual(result.retries, {0: 3, 1: 1})
+        self.assertEqual(result.operations, {'write': 3, 'read': 1})
+        self.assertEqual(result.elapsed, 2.0)
+        self.assertEqual(result.units_per_sec, 2.0)
+        self.assertEqual(result.conflict_rate, 8.0 / 12)
+        self.assertEqual(result.conflicts_by_kind,
+                         {'manager': 0, 'bucket': 2, 'session': 6,
+                          'other': 0})
+
+class TestLoadScenario(unittest.TestCase):
+    def _makeOne(self, **kw):
+        from repoze.session.benchmark.conflicts import LoadScenario
+        return LoadScenario(**kw)
+
+    def _check(self, result, units):
+        self.assertEqual(result.units + result.failures, units)
+        self.assertEqual(sum(result.retries.values()), result.units)
+        self.assertEqual(sum(result.operations.values()), result.units)
+        self.failUnless(result.units_per_sec > 0)
+
+    def test_run_file(self):
+        mix = {'new': 1, 'read': 1, 'write': 1, 'invalidate': 1}
+        for popularity in 'uniform', 'zipf':
+            scenario = self._makeOne(sessions=5, workers=2, ops=8, mix=mix,
+                                     popularity=popularity, think=0,
+                                     bucket_type='partitioned')
+            self._check(scenario.run(), 16)
+
+    @unittest.skipIf(ZEO is None, 'ZEO is not installed')
+    def test_run_zeo(self):
+        scenario = self._makeOne(storage='zeo', sessions=5, workers=2, ops=4,
+                                 think=0)
+        self._check(scenario.run(), 8)
+
+    def test_unknown_storage(self):
+        scenario = self._makeOne(storage='nope')
+        self.assertRaises(ValueError, scenario.run)
+
+    def test_zeo_unsupported(self):
+        import sys
+        scenario = self._makeOne(storage='zeo')
+        saved = sys.modules.get('ZEO')
+        sys.modules['ZEO'] = None # import fails
+        try:
+            self.assertRaises(RuntimeError, scenario.run)
+        finally:
+            if saved is None:
+                del sys.modules['ZEO']
+            else:
+                sys.modules['ZEO'] = saved
+
+    def test_do(self):
+        from repoze.session.manager import SessionDataManager
+        scenario = self._makeOne()
+        manager = SessionDataManager(1200, 20)
+        scenario.do(manager, 'new', 'a', 1)
+        self.assertEqual(manager.query('a')['hit'], 1)
+        scenario.do(manager, 'read', 'a', 2)
+        scenario.do(manager, 'read', 'b', 2)
+        self.assertEqual(manager.query('a')['hit'], 1)
+        scenario.do(manager, 'write', 'a', 3)
+        self.assertEqual(manager.query('a')['hit'], 3)
+        scenario.do(manager, 'invalidate', 'a', 4)
+        scenario.do(manager, 'invalidate', 'b', 4)
+        self.failIf(manager.query('a').is_valid())
+
+class TestZEOUnsupported(unittest.TestCase):
+    def _callFUT(self):
+        from repoze.session.benchmark.conflicts import zeo_unsupported
+        return zeo_unsupported()
+
+    def _withZEO(self, module, version_info=None):
+        import sys
+        from repoze.session.benchmark import conflicts
+        saved = sys.modules.get('ZEO')
+        sys.modules['ZEO'] = module
+        if version_info is not None:
+            conflicts.sys = DummySys(version_info)
+        try:
+            return self._callFUT()
+        finally:
+            conflicts.sys = sys
+            if saved is None:
+                del sys.modules['ZEO']
+            else:
+                sys.modules['ZEO'] = saved
+
+    def test_old_python(self):
+        reason = self._withZEO(DummyZEO(), (3, 3, 7))
+        self.failUnless('Python 3.4' in reason)
+
+    def test_no_ZEO(self):
+        reason = self._withZEO(None)
+        self.failUnless('ZEO 5' in reason)
+
+    def test_old_ZEO(self):
+        zeo = DummyZEO()
+        del zeo.server
+        self.failUnless('ZEO 5' in self._withZEO(zeo))
+
+    def test_supported(self):
+        self.assertEqual(self._withZEO(DummyZEO(), (3, 4, 0)), None)
+
+class DummySys(object):
+    def __init__(self, version_info):
+        self.version_info = version_info
+
+class DummyZEO(object):
+    def __init__(self):
+        self.server = object()
+
+class TestConflictsMain(unittest.TestCase):
+    def test_it(self):
+        from repoze.session._compat import StringIO
+        from repoze.session.benchmark.conflicts import main
+        out = StringIO()
+        main(['bench', '--sessions', '5', '--workers', '2', '--ops', '2',
+              '--mix', 'new=1,write=1', '--popularity', 'uniform,zipf',
+              '--skew', '1.5', '--think', '0'], out)
+        output = out.getvalue()
+        self.failUnless('file/oobtree sessions=5 workers=2 mix=new=1,write=1 '
+                        'keys=uniform' in output)
+        self.failUnless('keys=zipf(1.5)' in output)
+        self.failUnless('conflict%' in output)
+        self.failUnless('retries: ' in output)
+
+    def test_zeo_unsupported(self):
+        import sys
+        from repoze.session.benchmark.conflicts import main
+        saved = sys.modules.get('ZEO')
+        sys.modules['ZEO'] = None # import fails
+        try:
+            self.assertRaises(SystemExit, main,
+                              ['bench', '--storage', 'file,zeo'])
+        finally:
+            if saved is None:
+                del sys.modules['ZEO']
+            else:
+                sys.modules['ZEO'] = saved
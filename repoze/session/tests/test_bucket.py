@@ -0,0 +1,256 @@
+import unittest
+
+from zope.component.testing import PlacelessSetup
+
+class TestMergingBucket(unittest.TestCase):
+    def _getTargetClass(self):
+        from repoze.session.bucket import MergingBucket
+        return MergingBucket
+
+    def _makeOne(self, *arg):
+        klass = self._getTargetClass()
+        return klass(*arg)
+
+    def _state(self, d):
+        return self._makeOne(d).__getstate__()
+
+    def _resolve(self, old, committed, new):
+        bucket = self._makeOne()
+        resolved = bucket._p_resolveConflict(self._state(old),
+                                             self._state(committed),
+                                             self._state(new))
+        bucket.__setstate__(resolved)
+        return dict(bucket.items())
+
+    def test_distinct_inserts(self):
+        self.assertEqual(self._resolve({'a': 1}, {'a': 1, 'b': 2},
+                                       {'a': 1, 'c': 3}),
+                         {'a': 1, 'b': 2, 'c': 3})
+
+    def test_same_insert(self):
+        self.assertEqual(self._resolve({}, {'a': 1}, {'a': 1}), {'a': 1})
+
+    def test_changes_on_one_side(self):
+        self.assertEqual(self._resolve({'a': 1, 'b': 2}, {'a': 3, 'b': 2},
+                                       {'a': 1}),
+                         {'a': 3})
+        self.assertEqual(self._resolve({'a': 1, 'b': 2}, {'a': 1},
+                                       {'a': 3, 'b': 2}),
+                         {'a': 3})
+        self.assertEqual(self._resolve({'a': 1}, {}, {}), {})
+
+    def test_conflicting_changes(self):
+        from ZODB.POSException import ConflictError
+        self.assertRaises(ConflictError, self._resolve, {}, {'a': 1},
+                          {'a': 2})
+        self.assertRaises(ConflictError, self._resolve, {'a': 1}, {},
+                          {'a': 2})
+        self.assertRaises(ConflictError, self._resolve, {'a': 1}, {'a': 2},
+                          {})
+
+    def test_bucket_in_btree(self):
+        from ZODB.POSException import ConflictError
+        bucket = self._makeOne()
+        state = ((), self._makeOne())
+        self.assertRaises(ConflictError, bucket._p_resolveConflict,
+                          state, state, state)
+
+    def test_uncomparable_values(self):
+        from ZODB.POSException import ConflictError
+        from repoze.session.bucket import _merge
+        class Uncomparable(object):
+            def __eq__(self, other):
+                raise ValueError
+        old, committed, new = Uncomparable(), Uncomparable(), Uncomparable()
+        self.assertRaises(ConflictError, _merge, (('a', old),),
+                          (('a', committed),), (('a', new),))
+
+    def test_stats(self):
+        from ZODB.POSException import ConflictError
+        from repoze.session import stats
+        counters = stats.enable()
+        try:
+            self._resolve({}, {'a': 1}, {'b': 1})
+            self.assertRaises(ConflictError, self._resolve, {}, {'a': 1},
+                              {'a': 2})
+        finally:
+            stats.disable()
+        self.assertEqual(counters.as_dict(),
+                         {'conflicts_resolved': {'bucket': 1},
+                          'conflicts_raised': {'bucket': 1}})
+
+class TestPartitionedBucket(unittest.TestCase):
+    def setUp(self):
+        import transaction
+        transaction.abort()
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+
+    def _getTargetClass(self):
+        from repoze.session.bucket import PartitionedBucket
+        return PartitionedBucket
+
+    def _makeOne(self):
+        klass = self._getTargetClass()
+        return klass()
+
+    def test_mapping(self):
+        bucket = self._makeOne()
+        self.assertEqual(len(bucket.partitions), bucket.min_partitions)
+        self.failIf(bucket)
+        self.assertEqual(bucket.get('a'), None)
+        for i in range(100):
+            bucket['k%d' % i] = i
+        self.failUnless(bucket)
+        self.assertEqual(len(bucket), 100)
+        self.assertEqual(bucket['k5'], 5)
+        self.assertEqual(bucket.get('k6'), 6)
+        self.failUnless('k7' in bucket)
+        self.failUnless(bucket.has_key('k8'))
+        del bucket['k9']
+        self.failIf('k9' in bucket)
+        self.assertRaises(KeyError, bucket.__getitem__, 'k9')
+        self.assertEqual(sorted(bucket.keys()), sorted(list(bucket)))
+        self.assertEqual(sorted(bucket.values()), list(range(9)) +
+                         list(range(10, 100)))
+        self.assertEqual(dict(bucket.items())['k10'], 10)
+        # the keys are spread over the partitions
+        self.failUnless(max([len(p) for p in bucket.partitions]) < 25)
+
+    def test_partition_count(self):
+        klass = self._getTargetClass()
+        self.assertEqual(len(klass(3).partitions), 3)
+
+    def _populated(self, count, sessions):
+        klass = self._getTargetClass()
+        bucket = klass(count)
+        for i in range(sessions):
+            bucket['k%d' % i] = i
+        return bucket
+
+    def test_following(self):
+        klass = self._getTargetClass()
+        # 1000 sessions at 16 a partition
+        bucket = klass.following(self._populated(8, 1000))
+        self.assertEqual(len(bucket.partitions), 64)
+        self.failIf(bucket)
+        # sized from the population, not the previous partition count
+        bucket = klass.following(self._populated(512, 1000))
+        self.assertEqual(len(bucket.partitions), 64)
+
+    def test_following_bounds(self):
+        klass = self._getTargetClass()
+        bucket = klass.following(self._populated(8, 10))
+        self.assertEqual(len(bucket.partitions), klass.min_partitions)
+        class Small(klass):
+            max_partitions = 16
+        bucket = Small.following(self._populated(8, 1000))
+        self.assertEqual(len(bucket.partitions), 16)
+
+    def test_following_other_bucket(self):
+        from BTrees.OOBTree import OOBTree
+        klass = self._getTargetClass()
+        bucket = klass.following(OOBTree({'a': 1}))
+        self.assertEqual(len(bucket.partitions), klass.min_partitions)
+
+    def _open(self, db):
+        import transaction
+        tm = transaction.TransactionManager()
+        return tm, db.open(transaction_manager=tm)
+
+    def test_concurrent_inserts_merge(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.FileStorage.FileStorage import FileStorage
+        from repoze.session.data import SessionData
+        import os
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        db = DB(FileStorage(os.path.join(tmpdir, 'sessions.fs')))
+        try:
+            tm1, conn1 = self._open(db)
+            root = conn1.root()
+            root['bucket'] = self._makeOne()
+            root['sdo'] = SessionData()
+            tm1.commit()
+            tm2, conn2 = self._open(db)
+            bucket1 = conn1.root()['bucket']
+            bucket2 = conn2.root()['bucket']
+            # distinct keys, and the same session copied forward by
+            # both transactions
+            bucket1['a'] = conn1.root()['sdo']
+            bucket2['a'] = conn2.root()['sdo']
+            for i in range(50):
+                bucket1['one%d' % i] = i
+                bucket2['two%d' % i] = i
+            tm1.commit()
+            tm2.commit()
+            tm1.begin()
+            self.assertEqual(len(bucket1), 101)
+            self.assertEqual(bucket1['a']._p_oid, root['sdo']._p_oid)
+            tm1.abort()
+            tm2.abort()
+            conn1.close()
+            conn2.close()
+        finally:
+            transaction.abort()
+            db.close()
+            shutil.rmtree(tmpdir)
+
+class TestPartitionedSessionDataManager(unittest.TestCase, PlacelessSetup):
+    def setUp(self):
+        import transaction
+        transaction.abort()
+        PlacelessSetup.setUp(self)
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+        PlacelessSetup.tearDown(self)
+
+    def _makeOne(self, timeout, period, when=None):
+        from repoze.session.bucket import PartitionedBucket
+        from repoze.session.manager import SessionDataManager
+        return SessionDataManager(timeout, period, when,
+                                  bucket_type=PartitionedBucket)
+
+    def test_bucket_type(self):
+        from repoze.session.bucket import PartitionedBucket
+        from repoze.session.manager import SessionDataManager
+        root = self._makeOne(30, 1)
+        self.failUnless(isinstance(root.get_head()[1], PartitionedBucket))
+        self.failUnless(root._BUCKET_TYPE is PartitionedBucket)
+        self.failIf('_BUCKET_TYPE' in SessionDataManager(30, 1).__dict__)
+
+    def test_head_sized_from_previous(self):
+        root = self._makeOne(30, 1, when=1)
+        head = root.get_head(when=1)[1]
+        self.assertEqual(len(head.partitions), head.min_partitions)
+        for i in range(1000):
+            root.set('k%d' % i, i, when=1)
+        head = root.get_head(when=2)[1]
+        self.assertEqual(len(head.partitions), 64)
+        self.failIf(head)
+        # a quiet timeslice is followed by a small bucket
+        head = root.get_head(when=3)[1]
+        self.assertEqual(len(head.partitions), head.min_partitions)
+
+    def test_copy_forward_and_expire(self):
+        import zope.component
+        from repoze.session.interfaces import ISessionEndEvent
+        gsm = zope.component.getGlobalSiteManager()
+        ended = []
+        def test_event(event):
+            ended.append(event.session)
+        gsm.registerHandler(test_event, (ISessionEndEvent,))
+        root = self._makeOne(30, 1, when=1)
+        root.nonlazy = True
+        a = root.get('a', when=1)
+        b = root.get('b', when=1)
+        self.failUnless(root.get('a', when=20) is a)
+        self.failUnless(root.get_head(when=20)[1].get('a') is a)
+        root.get('c', when=40)
+        self.assertEqual(ended, [b])
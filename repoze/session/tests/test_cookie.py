@@ -0,0 +1,212 @@
+import unittest
+
+from zope.component.testing import PlacelessSetup
+
+try:
+    import cryptography
+except ImportError: # pragma: no cover
+    cryptography = None
+
+class CookieSessionDataManagerTests(unittest.TestCase, PlacelessSetup):
+    def setUp(self):
+        import transaction
+        transaction.abort()
+        PlacelessSetup.setUp(self)
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+        PlacelessSetup.tearDown(self)
+
+    def _getTargetClass(self):
+        from repoze.session.cookie import CookieSessionDataManager
+        return CookieSessionDataManager
+
+    def _makeOne(self, secret='seekrit', **kw):
+        klass = self._getTargetClass()
+        return klass(secret, **kw)
+
+    def _registerHandler(self, iface):
+        import zope.component
+        gsm = zope.component.getGlobalSiteManager()
+        sessions = []
+        def handler(event):
+            sessions.append(event.session)
+        gsm.registerHandler(handler, (iface,))
+        return sessions
+
+    def _fallback(self):
+        from repoze.session.memory import MemorySessionDataManager
+        fallback = MemorySessionDataManager(1200, 20)
+        fallback.nonlazy = True
+        return fallback
+
+    def test_class_conforms_to_ISessionDataManager(self):
+        from zope.interface.verify import verifyClass
+        from repoze.session.interfaces import ISessionDataManager
+        verifyClass(ISessionDataManager, self._getTargetClass())
+
+    def test_get_no_token(self):
+        from repoze.session.interfaces import ISessionBeginEvent
+        from repoze.session.interfaces import ISessionData
+        begun = self._registerHandler(ISessionBeginEvent)
+        sessions = self._makeOne()
+        sdo = sessions.get(None)
+        self.failUnless(ISessionData.providedBy(sdo))
+        self.assertEqual(begun, [sdo])
+        self.assertEqual(sessions.query(''), None)
+        self.assertEqual(sessions.has_key(None), False)
+
+    def test_new_unmodified_session_no_token(self):
+        sessions = self._makeOne()
+        self.assertEqual(sessions.dumps(sessions.get(None)), None)
+
+    def test_roundtrip(self):
+        sessions = self._makeOne()
+        sdo = sessions.get(None, when=100)
+        sdo['name'] = 'fred'
+        token = sessions.dumps(sdo, when=100)
+        loaded = sessions.get(token, when=110)
+        self.assertEqual(dict(loaded), {'name': 'fred'})
+        self.assertEqual(loaded.created, int(sdo.created))
+        self.assertEqual(loaded.last_modified, int(sdo.last_modified))
+        self.failUnless(sessions.has_key(sessions.dumps(loaded)))
+
+    def test_text_and_bytes_tokens(self):
+        sessions = self._makeOne(b'seekrit')
+        sdo = sessions.get(None)
+        sdo['a'] = 1
+        token = sessions.dumps(sdo)
+        self.assertEqual(sessions.query(token)['a'], 1)
+        self.assertEqual(sessions.query(token.encode('ascii'))['a'], 1)
+
+    def test_tampered_token(self):
+        from repoze.session.cookie import InvalidToken
+        sessions = self._makeOne()
+        sdo = sessions.get(None)
+        sdo['admin'] = False
+        token = sessions.dumps(sdo)
+        body, signature = token.rsplit('.', 1)
+        sdo['admin'] = True
+        forged = self._makeOne('other').dumps(sdo)
+        self.assertEqual(sessions.query(forged), None)
+        forged_body = forged.rsplit('.', 1)[0]
+        self.assertEqual(sessions.query(forged_body + '.' + signature), None)
+        self.assertEqual(sessions.query('garbage'), None)
+        self.assertRaises(InvalidToken, sessions.loads, 'a.b')
+        self.assertRaises(InvalidToken, sessions.loads, 'nodot')
+
+    def test_unchanged_recent_not_reissued(self):
+        sessions = self._makeOne(period=20)
+        sdo = sessions.get(None)
+        sdo['a'] = 1
+        token = sessions.dumps(sdo, when=100)
+        loaded = sessions.get(token, when=110)
+        self.assertEqual(sessions.dumps(loaded, when=110), None)
+        loaded = sessions.get(token, when=130)
+        refreshed = sessions.dumps(loaded, when=130)
+        self.failUnless(refreshed)
+        self.assertEqual(sessions.loads(refreshed)[1], 130)
+
+    def test_modified_reissued(self):
+        sessions = self._makeOne()
+        sdo = sessions.get(None)
+        sdo['a'] = 1
+        token = sessions.dumps(sdo, when=100)
+        loaded = sessions.get(token, when=101)
+        loaded['a'] = 2
+        token = sessions.dumps(loaded, when=101)
+        self.assertEqual(sessions.search(token, when=101)['a'], 2)
+
+    def test_expired(self):
+        from repoze.session.interfaces import ISessionEndEvent
+        ended = self._registerHandler(ISessionEndEvent)
+        sessions = self._makeOne(timeout=60)
+        sdo = sessions.get(None)
+        sdo['a'] = 1
+        token = sessions.dumps(sdo, when=100)
+        self.assertEqual(sessions.search(token, when=200), None)
+        self.assertEqual([dict(x) for x in ended], [{'a': 1}])
+        self.assertEqual(dict(sessions.get(token, when=200)), {})
+
+    def test_invalidated(self):
+        sessions = self._makeOne()
+        sdo = sessions.get(None)
+        sdo['a'] = 1
+        sdo.invalidate()
+        self.assertEqual(sessions.dumps(sdo), '')
+
+    def test_invalidated_token_not_revoked(self):
+        sessions = self._makeOne(timeout=60)
+        sdo = sessions.get(None)
+        sdo['a'] = 1
+        token = sessions.dumps(sdo, when=100)
+        loaded = sessions.get(token, when=110)
+        loaded.invalidate()
+        self.assertEqual(sessions.dumps(loaded, when=110), '')
+        # a captured copy of the token is good until it times out
+        self.assertEqual(dict(sessions.search(token, when=150)), {'a': 1})
+        self.assertEqual(sessions.search(token, when=200), None)
+
+    def test_invalidated_reference_revoked(self):
+        sessions = self._makeOne(fallback=self._fallback())
+        sdo = sessions.get(None)
+        sdo['a'] = (1, 2)
+        token = sessions.dumps(sdo, when=100)
+        loaded = sessions.get(token, when=110)
+        loaded.invalidate()
+        self.assertEqual(sessions.dumps(loaded, when=110), '')
+        self.failIf(sessions.search(token, when=120).is_valid())
+
+    def test_too_large_without_fallback(self):
+        sessions = self._makeOne(max_size=100)
+        sdo = sessions.get(None)
+        sdo['a'] = 'x' * 200
+        self.assertRaises(ValueError, sessions.dumps, sdo)
+
+    def test_too_large_falls_back(self):
+        fallback = self._fallback()
+        sessions = self._makeOne(max_size=100, fallback=fallback)
+        sdo = sessions.get(None)
+        sdo['a'] = 'x' * 200
+        token = sessions.dumps(sdo, when=100)
+        kind, issued, reference = sessions.loads(token)
+        self.assertEqual(kind, 'r')
+        self.assertEqual(fallback.query(reference)['a'], 'x' * 200)
+        loaded = sessions.get(token, when=110)
+        self.failUnless(loaded is fallback.query(reference))
+        self.assertEqual(sessions.dumps(loaded, when=110), None)
+        self.assertEqual(sessions.loads(sessions.dumps(loaded, when=200)),
+                         ('r', 200, reference))
+
+    def test_not_json_safe_falls_back(self):
+        fallback = self._fallback()
+        sessions = self._makeOne(fallback=fallback)
+        sdo = sessions.get(None)
+        sdo['a'] = (1, 2)
+        token = sessions.dumps(sdo)
+        self.assertEqual(sessions.loads(token)[0], 'r')
+        self.assertEqual(sessions.query(token)['a'], (1, 2))
+
+    def test_reference_without_fallback(self):
+        sessions = self._makeOne(fallback=self._fallback())
+        sdo = sessions.get(None)
+        sdo[1] = 1 # integer keys don't survive JSON
+        token = sessions.dumps(sdo)
+        self.assertEqual(self._makeOne().query(token), None)
+
+    @unittest.skipIf(cryptography is not None, 'cryptography is installed')
+    def test_encryption_needs_cryptography(self):
+        self.assertRaises(ImportError, self._makeOne, encryption_key=b'k')
+
+    @unittest.skipIf(cryptography is None, 'cryptography is not installed')
+    def test_encrypted(self):
+        from cryptography.fernet import Fernet
+        key = Fernet.generate_key()
+        sessions = self._makeOne(encryption_key=key)
+        sdo = sessions.get(None)
+        sdo['card'] = '1234'
+        token = sessions.dumps(sdo)
+        self.failIf(b'1234' in token.encode('ascii'))
+        self.assertEqual(sessions.query(token)['card'], '1234')
+        self.assertEqual(self._makeOne().query(token), None)
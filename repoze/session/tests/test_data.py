@@ -218,20 +218,94 @@ class TestSessionData(unittest.TestCase):
         self.assertEqual(sdo.created, sdo2.created)
         self.assertEqual(sdo.last_modified, sdo2.last_modified)
 
+    def test_getstate_compact(self):
+        sdo = self._makeOne({'a': 1})
+        sdo._ct = 10.5
+        sdo.last_modified = 20.7
+        self.assertEqual(sdo.__getstate__(), ({'a': 1}, 10, 20, 0))
+        sdo.invalidate()
+        self.assertEqual(sdo.__getstate__(), ({'a': 1}, 10, 20, 1))
+
+    def test_getstate_never_modified(self):
+        sdo = self._makeOne()
+        sdo._ct = 10
+        self.assertEqual(sdo.__getstate__(), ({}, 10, None, 0))
+
+    def test_getstate_extra_attributes(self):
+        sdo = self._makeOne()
+        sdo._ct = 10
+        sdo.extra = 1
+        self.assertEqual(sdo.__getstate__(),
+                         {'data': {}, '_ct': 10, 'extra': 1})
+
+    def test_setstate_compact(self):
+        sdo = self._makeOne()
+        sdo.__setstate__(({'a': 1}, 10, 20, 1))
+        self.assertEqual(dict(sdo), {'a': 1})
+        self.assertEqual(sdo.created, 10)
+        self.assertEqual(sdo.last_modified, 20)
+        self.failIf(sdo.is_valid())
+
+    def test_setstate_old_dict_form(self):
+        sdo = self._makeOne()
+        sdo.__setstate__({'data': {'a': 1}, '_ct': 10.5, '_lm': 20.5,
+                          '_iv': True})
+        self.assertEqual(dict(sdo), {'a': 1})
+        self.assertEqual(sdo.created, 10.5)
+        self.assertEqual(sdo.last_modified, 20.5)
+        self.failIf(sdo.is_valid())
+
+    def test_pickle_roundtrip(self):
+        import pickle
+        sdo = self._makeOne({'a': 1})
+        sdo['b'] = 2
+        copy = pickle.loads(pickle.dumps(sdo, 2))
+        self.assertEqual(dict(copy), {'a': 1, 'b': 2})
+        self.assertEqual(copy.created, int(sdo.created))
+        self.assertEqual(copy.last_modified, int(sdo.last_modified))
+        self.failUnless(copy.is_valid())
+
+    def test_pickle_smaller(self):
+        import pickle
+        sdo = self._makeOne({'user': 'fred'})
+        sdo['cart'] = 3
+        state = sdo.__getstate__()
+        old = {'data': sdo.data, '_ct': sdo._ct, '_lm': sdo._lm}
+        self.failUnless(len(pickle.dumps(state, 3)) <
+                        len(pickle.dumps(old, 3)))
+
+    def test_p_resolveConflict_compact(self):
+        sdo = self._makeOne()
+        old       = ({'a': 1}, 1, 1, 0)
+        committed = ({'a': 1, 'b': 2}, 1, 2, 0)
+        new       = ({'a': 1, 'c': 3}, 1, 3, 1)
+        result = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(result, ({'a': 1, 'b': 2, 'c': 3}, 1, 3, 1))
+
+    def test_p_resolveConflict_mixed_forms(self):
+        # 'old' was written before the compact form existed
+        sdo = self._makeOne()
+        old       = {'data': {'a': 1}, '_ct': 1.5, '_lm': 1.5}
+        committed = ({'a': 1, 'b': 2}, 1, 2, 0)
+        new       = ({'a': 2}, 1, 3, 0)
+        result = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(result, ({'a': 2, 'b': 2}, 1, 3, 0))
+
     def test_p_resolveConflict_same_lm(self):
         sdo = self._makeOne()
         old = {}
         committed = {'_lm':1, 'data': {'committed': 1}}
         new       = {'_lm':1, 'data': {'new': 2}}
         result = sdo._p_resolveConflict(old, committed, new)
-        self.assertEqual(result, {'_lm': 1, 'data': {'new': 2}})
+        self.assertEqual(result,
+                         {'_lm': 1, 'data': {'committed': 1, 'new': 2}})
 
     def test_p_resolveConflict_different_lm_different_data(self):
         from ZODB.POSException import ConflictError
         sdo = self._makeOne()
         old = {}
-        committed = {'_lm':1, 'data': {'committed': 1}}
-        new       = {'_lm':2, 'data': {'new': 2}}
+        committed = {'_lm':1, 'data': {'same': 1}}
+        new       = {'_lm':2, 'data': {'same': 2}}
         self.assertRaises(ConflictError, sdo._p_resolveConflict, old,
                           committed, new)
 
@@ -245,3 +319,213 @@ class TestSessionData(unittest.TestCase):
             result,
             {'_la': 1, 'data': {'same': 1}, '_lm': 2, '_iv': True}
             )
+
+    def test_p_resolveConflict_merges_disjoint_changes(self):
+        sdo = self._makeOne()
+        old       = {'_lm':0, 'data': {'cart': 1, 'page': 'a', 'gone': 1,
+                                       'c_gone': 1}}
+        committed = {'_lm':1, 'data': {'cart': 2, 'page': 'a', 'gone': 1,
+                                       'c_new': 1}}
+        new       = {'_lm':2, 'data': {'cart': 1, 'page': 'b', 'c_gone': 1,
+                                       'n_new': 1}}
+        result = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(result['data'],
+                         {'cart': 2, 'page': 'b', 'c_new': 1, 'n_new': 1})
+        self.assertEqual(result['_lm'], 2)
+
+    def test_p_resolveConflict_same_change_on_both_sides(self):
+        sdo = self._makeOne()
+        old       = {'_lm':0, 'data': {'a': 1, 'b': 1}}
+        committed = {'_lm':1, 'data': {'a': 2}}
+        new       = {'_lm':2, 'data': {'a': 2, 'c': 3}}
+        result = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(result['data'], {'a': 2, 'c': 3})
+
+    def test_p_resolveConflict_delete_vs_change(self):
+        from ZODB.POSException import ConflictError
+        sdo = self._makeOne()
+        old       = {'_lm':0, 'data': {'a': 1}}
+        committed = {'_lm':1, 'data': {}}
+        new       = {'_lm':2, 'data': {'a': 2}}
+        self.assertRaises(ConflictError, sdo._p_resolveConflict, old,
+                          committed, new)
+
+    def test_p_resolveConflict_conflict_message_names_key(self):
+        from ZODB.POSException import ConflictError
+        sdo = self._makeOne()
+        old       = {'_lm':0, 'data': {}}
+        committed = {'_lm':1, 'data': {'cart': 1, 'big': 'x' * 1000}}
+        new       = {'_lm':2, 'data': {'cart': 2}}
+        try:
+            sdo._p_resolveConflict(old, committed, new)
+        except ConflictError as e:
+            self.failUnless("'cart'" in str(e))
+            self.failIf('xxxx' in str(e))
+        else: # pragma: no cover
+            self.fail('ConflictError not raised')
+
+    def test_p_resolveConflict_incomparable_values(self):
+        from ZODB.POSException import ConflictError
+        class Incomparable(object):
+            def __eq__(self, other):
+                raise ValueError
+        sdo = self._makeOne()
+        old       = {'_lm':0, 'data': {'a': Incomparable()}}
+        committed = {'_lm':1, 'data': {'a': Incomparable()}}
+        new       = {'_lm':2, 'data': {'a': Incomparable()}}
+        self.assertRaises(ConflictError, sdo._p_resolveConflict, old,
+                          committed, new)
+
+class TestCompressedSessionData(unittest.TestCase):
+    def _getTargetClass(self):
+        from repoze.session.data import CompressedSessionData
+        return CompressedSessionData
+
+    def _makeOne(self, data=None):
+        return self._getTargetClass()(data)
+
+    def _big(self):
+        return {'wizard': 'step %d ' * 2000, 'page': 1}
+
+    def test_small_not_compressed(self):
+        sdo = self._makeOne({'a': 1})
+        state = sdo.__getstate__()
+        self.assertEqual(state[0], {'a': 1})
+        self.assertEqual(state[3], 0)
+
+    def test_large_compressed(self):
+        import pickle
+        sdo = self._makeOne(self._big())
+        state = sdo.__getstate__()
+        self.assertEqual(state[3], 2)
+        self.failUnless(len(state[0]) < len(pickle.dumps(self._big(), 2)))
+
+    def test_incompressible_not_compressed(self):
+        import os
+        sdo = self._makeOne({'noise': os.urandom(8192)})
+        self.assertEqual(sdo.__getstate__()[3], 0)
+
+    def test_setstate_lazy(self):
+        state = self._makeOne(self._big()).__getstate__()
+        sdo = self._makeOne()
+        sdo.__setstate__(state)
+        self.failIf('data' in sdo.__dict__)
+        self.assertEqual(sdo['page'], 1)
+        self.failUnless('data' in sdo.__dict__)
+        self.assertEqual(dict(sdo), self._big())
+
+    def test_getstate_not_decompressed(self):
+        state = self._makeOne(self._big()).__getstate__()
+        sdo = self._makeOne()
+        sdo.__setstate__(state)
+        sdo.invalidate()
+        new_state = sdo.__getstate__()
+        self.failIf('data' in sdo.__dict__)
+        self.assertEqual(new_state[0], state[0])
+        self.assertEqual(new_state[3], 3)
+
+    def test_base_class_loads_compressed_state(self):
+        from repoze.session.data import SessionData
+        state = self._makeOne(self._big()).__getstate__()
+        sdo = SessionData()
+        sdo.__setstate__(state)
+        self.assertEqual(dict(sdo), self._big())
+
+    def test_p_resolveConflict(self):
+        sdo = self._makeOne()
+        big = self._big()
+        old = self._makeOne(big).__getstate__()
+        big['c'] = 1
+        committed = self._makeOne(big).__getstate__()
+        del big['c']
+        big['n'] = 2
+        new = self._makeOne(big).__getstate__()
+        result = sdo._p_resolveConflict(old, committed, new)
+        self.assertEqual(result[3], 2)
+        resolved = self._makeOne()
+        resolved.__setstate__(result)
+        self.assertEqual(resolved['c'], 1)
+        self.assertEqual(resolved['n'], 2)
+
+    def test_stats(self):
+        from repoze.session.data import SessionData
+        from repoze.session.stats import SessionStats
+        stats = SessionData.stats = SessionStats()
+        try:
+            self._makeOne({'a': 1}).__getstate__()
+            self.assertEqual(stats.compression_ratio(), None)
+            self._makeOne(self._big()).__getstate__()
+        finally:
+            SessionData.stats = None
+        self.assertEqual(stats.get('compressed_states'), 1)
+        self.failUnless(stats.compression_ratio() < 0.1)
+
+    def test_in_database(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        db = DB(MappingStorage())
+        conn = db.open()
+        sdo = conn.root()['s'] = self._makeOne(self._big())
+        transaction.commit()
+        record = db.storage.load(sdo._p_oid)[0]
+        self.failUnless(len(record) < 1000)
+        tm = transaction.TransactionManager()
+        conn2 = db.open(tm)
+        loaded = conn2.root()['s']
+        self.assertEqual(loaded.created, int(sdo.created))
+        self.failIf('data' in loaded.__dict__)
+        self.assertEqual(loaded['page'], 1)
+        self.assertEqual(loaded._p_changed, False)
+        tm.abort()
+        conn2.close()
+        conn.close()
+        db.close()
+
+class TestResolveConflictInDatabase(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        from ZODB.DB import DB
+        from ZODB.FileStorage.FileStorage import FileStorage
+        from repoze.session.data import SessionData
+        import transaction
+        self.tempdir = tempfile.mkdtemp()
+        # MappingStorage doesn't do conflict resolution
+        self.db = DB(FileStorage(os.path.join(self.tempdir, 'Data.fs')))
+        self.tm1 = transaction.TransactionManager()
+        self.tm2 = transaction.TransactionManager()
+        self.conn1 = self.db.open(self.tm1)
+        self.conn2 = self.db.open(self.tm2)
+        self.conn1.root()['sdo'] = SessionData({'a': 1})
+        self.tm1.commit()
+        self.tm2.begin()
+
+    def tearDown(self):
+        import shutil
+        self.conn1.close()
+        self.conn2.close()
+        self.db.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_concurrent_writes_to_different_keys(self):
+        sdo1 = self.conn1.root()['sdo']
+        sdo2 = self.conn2.root()['sdo']
+        sdo1['cart'] = 1
+        sdo2['last_page'] = '/'
+        self.tm1.commit()
+        self.tm2.commit()
+        self.tm1.begin()
+        self.assertEqual(dict(self.conn1.root()['sdo']),
+                         {'a': 1, 'cart': 1, 'last_page': '/'})
+
+    def test_concurrent_writes_to_same_key(self):
+        from ZODB.POSException import ConflictError
+        sdo1 = self.conn1.root()['sdo']
+        sdo2 = self.conn2.root()['sdo']
+        sdo1['a'] = 2
+        sdo2['a'] = 3
+        self.tm1.commit()
+        self.assertRaises(ConflictError, self.tm2.commit)
+        self.tm2.abort()
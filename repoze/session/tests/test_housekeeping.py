@@ -0,0 +1,251 @@
+import unittest
+
+from zope.component.testing import PlacelessSetup
+
+try:
+    import ZEO
+except ImportError: # pragma: no cover
+    ZEO = None
+
+class _Base(PlacelessSetup):
+    def setUp(self):
+        PlacelessSetup.setUp(self)
+        import zope.component
+        from repoze.session.interfaces import ISessionEndEvent
+        self.ended = []
+        def handler(event):
+            self.ended.append(event.session)
+        gsm = zope.component.getGlobalSiteManager()
+        gsm.registerHandler(handler, (ISessionEndEvent,))
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+        PlacelessSetup.tearDown(self)
+
+class ExternalHousekeepingTests(_Base, unittest.TestCase):
+    def _makeOne(self, timeout=30, period=1, when=1):
+        from repoze.session.manager import SessionDataManager
+        manager = SessionDataManager(timeout, period, when,
+                                     external_housekeeping=True)
+        manager.nonlazy = True
+        return manager
+
+    def test_search_does_no_expiry_work(self):
+        manager = self._makeOne()
+        a = manager.get('a', when=1)
+        self.assertEqual(manager.search('a', when=60), None)
+        b = manager.get('b', when=60)
+        self.assertEqual(self.ended, [])
+        # the expired bucket is still there for housekeeping to find
+        self.assertEqual(_occupied(manager), 2)
+        self.failIf(a is b)
+
+    def test_housekeep(self):
+        manager = self._makeOne()
+        a = manager.get('a', when=1)
+        manager.get('b', when=60)
+        self.assertEqual(manager.housekeep(when=60), 1)
+        self.assertEqual(self.ended, [a])
+        self.assertEqual(_occupied(manager), 1)
+        # nothing left to do
+        self.assertEqual(manager.housekeep(when=60), 0)
+        self.assertEqual(len(self.ended), 1)
+
+    def test_housekeep_rotates_head(self):
+        manager = self._makeOne()
+        a = manager.get('a', when=1)
+        self.assertEqual(manager.housekeep(when=600), 1)
+        self.assertEqual(self.ended, [a])
+        self.assertEqual(manager.head_index, 600)
+
+    def test_head_replaces_unhousekept_bucket(self):
+        # housekeeping lagged so far behind that the new head needs
+        # the slot of an expired bucket; it is expired on the spot
+        manager = self._makeOne(timeout=3)
+        a = manager.get('a', when=1)
+        manager.get('b', when=5)
+        self.assertEqual(self.ended, [])
+        manager.get('c', when=6)
+        self.assertEqual(self.ended, [a])
+        self.assertEqual(manager.housekeep(when=6), 0)
+
+    def test_housekeep_sharded(self):
+        from repoze.session.manager import ShardedSessionDataManager
+        manager = ShardedSessionDataManager(30, 1, 2, when=1,
+                                            external_housekeeping=True)
+        for shard in manager.shards:
+            self.assertEqual(shard.external_housekeeping, True)
+            shard.nonlazy = True
+        manager.get('a', when=1)
+        manager.get('b', when=1)
+        self.assertEqual(manager.housekeep(when=600), 2)
+        self.assertEqual(len(self.ended), 2)
+
+class HousekeepTests(_Base, unittest.TestCase):
+    def _callFUT(self, factory, when=None, retries=3):
+        from repoze.session.housekeeping import housekeep
+        return housekeep(factory, when, retries)
+
+    def test_it(self):
+        import transaction
+        factory = DummyFactory()
+        manager = factory()
+        manager.nonlazy = True
+        a = manager.get('a', when=1)
+        transaction.commit()
+        self.assertEqual(self._callFUT(factory, when=600), 1)
+        self.assertEqual(len(self.ended), 1)
+        self.assertEqual(self.ended[0]._p_oid, a._p_oid)
+        self.assertEqual(_occupied(factory()), 1)
+
+    def test_conflict_retried(self):
+        factory = DummyFactory(conflicts=2)
+        self.assertEqual(self._callFUT(factory, when=600), 1)
+        self.assertEqual(factory.calls, 3)
+
+    def test_conflict_retries_exhausted(self):
+        from ZODB.POSException import ConflictError
+        factory = DummyFactory(conflicts=2)
+        self.assertRaises(ConflictError, self._callFUT, factory, 600, 1)
+
+    def test_other_error(self):
+        factory = DummyFactory(error=ValueError)
+        self.assertRaises(ValueError, self._callFUT, factory)
+
+class MainTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def _callFUT(self, argv, sleep=None):
+        from repoze.session.housekeeping import main
+        return main(argv, sleep)
+
+    def test_once(self):
+        import os
+        filename = os.path.join(self.tempdir, 'sessions.fs')
+        self._callFUT(['housekeep', filename, 'sessions'])
+        self.failUnless(os.path.exists(filename))
+
+    def test_interval(self):
+        import os
+        filename = os.path.join(self.tempdir, 'sessions.fs')
+        slept = []
+        def sleep(interval):
+            slept.append(interval)
+            if len(slept) == 2:
+                raise KeyboardInterrupt
+        self.assertRaises(KeyboardInterrupt, self._callFUT,
+                          ['housekeep', '--interval', '5', filename,
+                           'sessions'], sleep)
+        self.assertEqual(slept, [5, 5])
+
+    def test_bad_args(self):
+        self.assertRaises(SystemExit, self._callFUT, ['housekeep'])
+
+    def test_bad_args_server(self):
+        self.assertRaises(SystemExit, self._callFUT,
+                          ['housekeep', '--zconfig', 'zodb.conf'])
+        self.assertRaises(SystemExit, self._callFUT,
+                          ['housekeep', '--zeo', 'zeo.sock', '--zconfig',
+                           'zodb.conf', 'sessions'])
+
+    def test_bad_log_level(self):
+        self.assertRaises(SystemExit, self._callFUT,
+                          ['housekeep', '--log-level', 'chatty', 'x.fs',
+                           'sessions'])
+
+    def _settings(self, filename):
+        # the timeout, period and external_housekeeping of the stored
+        # session manager
+        from ZODB.DB import DB
+        from ZODB.FileStorage.FileStorage import FileStorage
+        db = DB(FileStorage(filename, read_only=True))
+        try:
+            manager = db.open().root()['sessions']
+            return (manager.timeout, manager.period,
+                    manager.external_housekeeping)
+        finally:
+            db.close()
+
+    def test_new_manager_settings(self):
+        import os
+        filename = os.path.join(self.tempdir, 'sessions.fs')
+        self._callFUT(['housekeep', '--timeout', '600', '--period', '30',
+                       filename, 'sessions'])
+        self.assertEqual(self._settings(filename), (600, 30, True))
+
+    def test_zconfig(self):
+        import os
+        filename = os.path.join(self.tempdir, 'sessions.fs')
+        config = os.path.join(self.tempdir, 'zodb.conf')
+        with open(config, 'w') as f:
+            f.write('<filestorage>\n  path %s\n</filestorage>\n'
+                    % filename)
+        self._callFUT(['housekeep', '--zconfig', config, 'sessions'])
+        self.assertEqual(self._settings(filename), (1200, 20, True))
+
+    @unittest.skipIf(ZEO is None, 'ZEO is not installed')
+    def test_zeo(self):
+        import os
+        filename = os.path.join(self.tempdir, 'sessions.fs')
+        address, stop = ZEO.server(filename)
+        try:
+            host, port = address
+            self._callFUT(['housekeep', '--zeo', '%s:%s' % (host, port),
+                           '--period', '30', 'sessions'])
+        finally:
+            stop()
+        self.assertEqual(self._settings(filename), (1200, 30, True))
+
+class ZEOAddressTests(unittest.TestCase):
+    def _callFUT(self, address):
+        from repoze.session.housekeeping import _zeo_address
+        return _zeo_address(address)
+
+    def test_host_port(self):
+        self.assertEqual(self._callFUT('localhost:8100'),
+                         ('localhost', 8100))
+
+    def test_socket_path(self):
+        self.assertEqual(self._callFUT('/var/run/zeo.sock'),
+                         '/var/run/zeo.sock')
+        self.assertEqual(self._callFUT('./zeo:sock'), './zeo:sock')
+
+class DummyFactory(object):
+    calls = 0
+
+    def __init__(self, conflicts=0, error=None):
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from repoze.session.manager import SessionDataManager
+        self.db = DB(MappingStorage())
+        self.conflicts = conflicts
+        self.error = error
+        self.conn = self.db.open()
+        self.conn.root()['sessions'] = SessionDataManager(
+            30, 1, when=1, external_housekeeping=True)
+        import transaction
+        transaction.commit()
+
+    def __call__(self, connection_handler=None):
+        from ZODB.POSException import ConflictError
+        self.calls += 1
+        if connection_handler is None:
+            return self.conn.root()['sessions']
+        conn = self.db.open()
+        connection_handler(conn)
+        if self.error is not None:
+            raise self.error()
+        if self.conflicts:
+            self.conflicts -= 1
+            raise ConflictError()
+        return conn.root()['sessions']
+
+def _occupied(manager):
+    return len([x for x in manager.slots if x is not None])
@@ -0,0 +1,145 @@
+import unittest
+
+from zope.component.testing import PlacelessSetup
+
+class TestDigestKeyCodec(unittest.TestCase):
+    def _makeOne(self):
+        from repoze.session.keys import DigestKeyCodec
+        return DigestKeyCodec()
+
+    def test_encode(self):
+        codec = self._makeOne()
+        key = codec.encode('a' * 40)
+        self.assertEqual(len(key), 16)
+        self.failUnless(isinstance(key, bytes))
+        self.assertEqual(codec.encode('a' * 40), key)
+        self.assertEqual(codec.encode(b'a' * 40), key)
+        self.failIf(codec.encode('b' * 40) == key)
+        self.assertEqual(len(codec.encode(12345)), 16)
+
+class TestIntegerKeyCodec(unittest.TestCase):
+    def _makeOne(self):
+        from repoze.session.keys import IntegerKeyCodec
+        return IntegerKeyCodec()
+
+    def test_encode(self):
+        codec = self._makeOne()
+        keys = [codec.encode('key%d' % i) for i in range(100)]
+        self.assertEqual(len(set(keys)), 100)
+        for key in keys:
+            self.failUnless(-2 ** 63 <= key < 2 ** 63)
+        # both signs occur
+        self.failUnless(min(keys) < 0 < max(keys))
+        self.assertEqual(codec.encode('key0'), keys[0])
+
+    def test_fits_lobtree(self):
+        codec = self._makeOne()
+        bucket = codec.bucket_type()
+        for i in range(100):
+            bucket[codec.encode('key%d' % i)] = i
+        self.assertEqual(bucket[codec.encode('key5')], 5)
+
+class TestKeyCodecSessionDataManager(unittest.TestCase, PlacelessSetup):
+    def setUp(self):
+        import transaction
+        transaction.abort()
+        PlacelessSetup.setUp(self)
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+        PlacelessSetup.tearDown(self)
+
+    def _makeOne(self, codec, timeout=30, period=1, when=None, **kw):
+        from repoze.session.manager import SessionDataManager
+        return SessionDataManager(timeout, period, when, key_codec=codec,
+                                  **kw)
+
+    def _codecs(self):
+        from repoze.session.keys import DigestKeyCodec
+        from repoze.session.keys import IntegerKeyCodec
+        return DigestKeyCodec(), IntegerKeyCodec()
+
+    def test_types(self):
+        from BTrees.LOBTree import LOBTree
+        from repoze.session.bucket import PartitionedBucket
+        from repoze.session.keys import IntegerKeyCodec
+        root = self._makeOne(IntegerKeyCodec(), index=True)
+        self.failUnless(isinstance(root.get_head()[1], LOBTree))
+        self.failUnless(isinstance(root.index, LOBTree))
+        root = self._makeOne(IntegerKeyCodec(),
+                             bucket_type=PartitionedBucket)
+        self.failUnless(isinstance(root.get_head()[1], PartitionedBucket))
+
+    def test_set_get_query(self):
+        for codec in self._codecs():
+            for index in False, True:
+                root = self._makeOne(codec, index=index)
+                key = 'f' * 40
+                root.set(key, 'value')
+                self.assertEqual(list(root.get_head()[1].keys()),
+                                 [codec.encode(key)])
+                self.assertEqual(root.query(key), 'value')
+                self.failUnless(root.has_key(key))
+                self.failIf(root.has_key('e' * 40))
+                self.assertEqual(root.query_many([key, 'x']),
+                                 {key: 'value', 'x': None})
+                if index:
+                    self.assertEqual(list(root.index.keys()),
+                                     [codec.encode(key)])
+
+    def test_get_lazy(self):
+        import transaction
+        for codec in self._codecs():
+            root = self._makeOne(codec)
+            sdo = root.get('a')
+            sdo['x'] = 1
+            for hook, args, kw in transaction.get().getBeforeCommitHooks():
+                hook(*args, **kw)
+            transaction.abort()
+            self.failUnless(root.query('a') is sdo)
+            many = root.get_many(['a', 'b'])
+            self.failUnless(many['a'] is sdo)
+
+    def test_copy_forward_and_expire(self):
+        import zope.component
+        from repoze.session.interfaces import ISessionEndEvent
+        gsm = zope.component.getGlobalSiteManager()
+        ended = []
+        def test_event(event):
+            ended.append(event.session)
+        gsm.registerHandler(test_event, (ISessionEndEvent,))
+        for codec in self._codecs():
+            del ended[:]
+            root = self._makeOne(codec, when=1)
+            root.nonlazy = True
+            a = root.get('a', when=1)
+            b = root.get('b', when=1)
+            self.failUnless(root.get('a', when=20) is a)
+            head_bucket = root.get_head(when=20)[1]
+            self.failUnless(head_bucket.get(codec.encode('a')) is a)
+            root.get('c', when=40)
+            self.assertEqual(ended, [b])
+
+    def test_smaller_bucket_pickle(self):
+        from repoze.session._compat import pickle
+        from repoze.session.keys import IntegerKeyCodec
+        from repoze.session.manager import SessionDataManager
+        keys = ['%040x' % (i * 7919) for i in range(20)]
+        plain = SessionDataManager(30, 1)
+        compact = self._makeOne(IntegerKeyCodec())
+        for root in plain, compact:
+            for key in keys:
+                root.set(key, 1)
+        def size(root):
+            return len(pickle.dumps(root.get_head()[1].__getstate__(), 2))
+        self.failUnless(size(compact) * 2 < size(plain))
+
+    def test_sharded(self):
+        from repoze.session.keys import DigestKeyCodec
+        from repoze.session.manager import ShardedSessionDataManager
+        codec = DigestKeyCodec()
+        root = ShardedSessionDataManager(30, 1, 2, key_codec=codec)
+        self.failUnless(root.shards[0].key_codec is codec)
+        root.set('a', 1)
+        self.assertEqual(root.query('a'), 1)
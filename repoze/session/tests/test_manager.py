@@ -1,17 +1,27 @@
 import unittest
 
 from zope.component.testing import PlacelessSetup
+from ZODB.POSException import ConflictError
+
+try:
+    import ZEO
+except ImportError: # pragma: no cover
+    ZEO = None
 
 class SessionDataManagerTests(unittest.TestCase, PlacelessSetup):
     def setUp(self):
+        import transaction
+        transaction.abort()
         PlacelessSetup.setUp(self)
 
     def tearDown(self):
+        import transaction
+        transaction.abort()
         PlacelessSetup.tearDown(self)
 
-    def _makeOne(self, timeout=60, period=5, when=None):
+    def _makeOne(self, timeout=60, period=5, when=None, **kw):
         klass = self._getTargetClass()
-        return klass(timeout, period, when)
+        return klass(timeout, period, when, **kw)
 
     def _getTargetClass(self):
         from repoze.session.manager import SessionDataManager
@@ -44,31 +54,31 @@ class SessionDataManagerTests(unittest.TestCase, PlacelessSetup):
 
     def test___init__(self):
         root = self._makeOne(30, 1)
-        head = root.head
         self.assertEqual(root.timeout, 30)
         self.assertEqual(root.period, 1)
-        self.assertEqual(head.next, None)
-        self.failUnless(isinstance(head.ob[0], float))
-        self.failUnless(isinstance(head.ob[1], root._BUCKET_TYPE))
-
-    def test_new_head(self):
-        from repoze.session.linkedlist import ListNode
-        root = self._makeOne(30, 1)
-        newhead = root.new_head('abc')
-        self.failUnless(isinstance(newhead, ListNode))
-        self.assertEqual(newhead.next, 'abc')
-        self.failUnless(isinstance(newhead.ob[0], float))
-        self.failUnless(isinstance(newhead.ob[1], root._BUCKET_TYPE))
+        self.assertEqual(root.tick, 1)
+        self.assertEqual(len(root.slots), 32)
+        self.failUnless(isinstance(root.head_index, int))
+        head = root.slots[root.head_index % 32]
+        self.assertEqual([x for x in root.slots if x is not None], [head])
+        self.assertEqual(head[0], root.head_index)
+        self.failUnless(isinstance(head[1], root._BUCKET_TYPE))
+
+    def test___init___adaptive_ring(self):
+        root = self._getTargetClass()(600, 20, when=100,
+                                      period_bounds=(5, 80))
+        # slice indices count the narrowest period
+        self.assertEqual(root.tick, 5)
+        self.assertEqual(len(root.slots), 122)
+        self.assertEqual(root.head_index, 20)
 
     def test_get_head_noreplace(self):
-        from repoze.session.linkedlist import ListNode
         root = self._makeOne(30, 1)
         head = root.get_head()
-        ts, bucket = head.ob
-        self.failUnless(isinstance(head, ListNode))
+        index, bucket = head
         self.failUnless(isinstance(bucket, root._BUCKET_TYPE))
-        self.failUnless(isinstance(ts, float))
-        self.assertEqual(head.next, None)
+        self.failUnless(isinstance(index, int))
+        self.assertEqual(root._chain(), [head])
 
     def test_get_head_successive_timeslices(self):
 
@@ -79,113 +89,449 @@ class SessionDataManagerTests(unittest.TestCase, PlacelessSetup):
 
         # if we ask for the head during timeslice "1", we should not cause the
         # head to be bumped (becase the head bucket is valid until 1)
-        head = root.get_head(when=1)
-        self.assertEqual(len(head), 1)
+        root.get_head(when=1)
+        self.assertEqual(len(root._chain()), 1)
 
         # if we go back in time to timeslice 0, same thing.
-        head = root.get_head(when=0)
-        self.assertEqual(len(head), 1)
+        root.get_head(when=0)
+        self.assertEqual(len(root._chain()), 1)
 
         # the head is valid until 1, so when we ask for 1, we still don't bump
         # the head even after asking for 0
-        head = root.get_head(when=1)
-        self.assertEqual(len(head), 1)
+        root.get_head(when=1)
+        self.assertEqual(len(root._chain()), 1)
 
-        # if we bump up the timeslice to 2, the length of the linked list
+        # if we bump up the timeslice to 2, the number of buckets
         # should become two, because the head bucket will have become
         # invalid and another will have been added (the one that is
         # 'valid until 3').
         head = root.get_head(when=2)
-        self.assertEqual(len(head), 2)
-        self.assertEqual(head.ob[0], 2)
+        self.assertEqual(len(root._chain()), 2)
+        self.assertEqual(head[0], 2)
 
         # and again
         head = root.get_head(when=3)
-        self.assertEqual(len(head), 3)
-        self.assertEqual(head.ob[0], 3)
+        self.assertEqual(len(root._chain()), 3)
+        self.assertEqual(head[0], 3)
 
         # and again
         head = root.get_head(when=4)
-        self.assertEqual(len(head), 4)
-        self.assertEqual(head.ob[0], 4)
+        self.assertEqual(len(root._chain()), 4)
+        self.assertEqual(head[0], 4)
 
         # but fractions don't bump the head
-        head = root.get_head(when=4.1)
-        self.assertEqual(len(head), 4)
+        root.get_head(when=4.1)
+        self.assertEqual(len(root._chain()), 4)
 
-        head = root.get_head(when=4.999)
-        self.assertEqual(len(head), 4)
+        root.get_head(when=4.999)
+        self.assertEqual(len(root._chain()), 4)
 
         # but rollovers to the next whole timeslice do
-        head = root.get_head(when=5)
-        self.assertEqual(len(head), 5)
+        root.get_head(when=5)
+        self.assertEqual(len(root._chain()), 5)
 
         # we can skip timeslices
-        head = root.get_head(when=10)
-        self.assertEqual(len(head), 6)
+        root.get_head(when=10)
+        self.assertEqual(len(root._chain()), 6)
 
-        head = root.get_head(when=10)
-        self.assertEqual(len(head), 6)
+        root.get_head(when=10)
+        self.assertEqual(len(root._chain()), 6)
 
-        head = root.get_head(when=7)
-        self.assertEqual(len(head), 6)
+        root.get_head(when=7)
+        self.assertEqual(len(root._chain()), 6)
 
         # and again
-        head = root.get_head(when=11)
-        self.assertEqual(len(head), 7)
+        root.get_head(when=11)
+        self.assertEqual(len(root._chain()), 7)
 
-        head = root.get_head(when=10)
-        self.assertEqual(len(head), 7)
+        root.get_head(when=10)
+        self.assertEqual(len(root._chain()), 7)
+        self.assertEqual([x[0] for x in root._chain()],
+                         [11, 10, 5, 4, 3, 2, 1])
 
     def test_get_head_replace(self):
         import time
         now = time.time()
         root = self._makeOne(30, 1)
-        originalhead = root.head
+        originalhead = root.get_head(now)
         head = root.get_head(now + 86400) # new timeslice will be 1 day from now
         self.assertNotEqual(originalhead, head)
-        self.assertEqual(head.next, originalhead)
+        self.assertEqual(head[0], int(now + 86400))
+        # the original head expired when it was replaced
+        self.assertEqual(root._chain(), [head])
+        self.assertEqual(len([x for x in root.slots if x is not None]), 1)
+
+    def test_get_head_reuses_slots(self):
+        ended = self._registerEndHandler()
+        root = self._makeOne(3, 1, when=0)
+        self.assertEqual(len(root.slots), 5)
+        for when in range(20):
+            root.set(when, 'v%d' % when, when=when)
+        self.assertEqual(len(root.slots), 5)
+        self.assertEqual([x[0] for x in root._chain()], [19, 18, 17, 16])
+        self.assertEqual(len(ended), 16)
+
+    def test_chain_cached(self):
+        root = self._makeOne(30, 1, when=1)
+        chain = root._chain()
+        self.failUnless(root._chain() is chain)
+        root.get_head(when=2)
+        self.failIf(root._chain() is chain)
+        self.assertEqual(len(root._chain()), 2)
 
     def test_search_findinhead(self):
         root = self._makeOne(30, 1)
-        bucket = root.head.ob[1]
+        bucket = root.get_head()[1]
         bucket['a'] = 1
         self.assertEqual(root.search('a'), 1)
 
     def test_search_findintail(self):
-        root = self._makeOne(30, 1)
-        root.head.ob[1]['a'] = 1
-
-        from repoze.session.linkedlist import ListNode
-        import time
-
-        newbucket = root._BUCKET_TYPE()
-        now = time.time()
-        newhead = ListNode((now, newbucket), root.head)
-        root.head = newhead
-        self.assertEqual(root.search('a'), 1)
+        root = self._makeOne(30, 1, when=1)
+        root.get_head(when=1)[1]['a'] = 1
+        newbucket = root.get_head(when=2)[1]
+        self.assertEqual(root.search('a', when=2), 1)
 
         # value was moved forward
         self.assertEqual(newbucket.get('a'), 1)
 
     def test_search_newer_shadows_older(self):
-        root = self._makeOne(30, 1)
-        root.head.ob[1]['a'] = 1
-
-        from repoze.session.linkedlist import ListNode
-        import time
-
-        newbucket = root._BUCKET_TYPE()
+        root = self._makeOne(30, 1, when=1)
+        root.get_head(when=1)[1]['a'] = 1
+        newbucket = root.get_head(when=2)[1]
         newbucket['a'] = 2
-        now = time.time()
-        newhead = ListNode((now, newbucket), root.head)
-        root.head = newhead
-        self.assertEqual(root.search('a'), 2)
+        self.assertEqual(root.search('a', when=2), 2)
+
+    def test_search_raced_head_buckets(self):
+        # both buckets of a slice raced into by two transactions are
+        # searched, and writes go to the first
+        root = self._makeOne(30, 1, when=1)
+        first, second = root._BUCKET_TYPE(), root._BUCKET_TYPE()
+        second['a'] = 1
+        _ring(root, (2, first, second), (1, root._BUCKET_TYPE()))
+        self.assertEqual(root.search('a', when=2), 1)
+        root.set('b', 2, when=2)
+        self.assertEqual(first['b'], 2)
+        self.failIf('a' in first)
 
     def test_set(self):
         root = self._makeOne(30, 1)
         root.set('a', 1)
-        self.assertEqual(root.head.ob[1]['a'], 1)
+        self.assertEqual(root.get_head()[1]['a'], 1)
+
+    def test___init___index(self):
+        root = self._getTargetClass()(30, 1, index=True)
+        self.failUnless(isinstance(root.index, root._INDEX_TYPE))
+        self.assertEqual(self._makeOne().index, None)
+
+    def test_set_updates_index(self):
+        root = self._getTargetClass()(30, 1, when=1, index=True)
+        root.set('a', 1, when=1)
+        self.assertEqual(root.index['a'], 1)
+        root.set('a', 2, when=2)
+        self.assertEqual(root.index['a'], 2)
+
+    def test_search_with_index_probes_only_indexed_bucket(self):
+        root = self._getTargetClass()(30, 1, when=1, index=True)
+        tail = root.get_head(when=1)[1]
+        tail['a'] = 1
+        middle = _ProbeCountingBucket({'a': 2})
+        head = _ProbeCountingBucket()
+        _ring(root, (3, head), (2, middle), (1, tail))
+        root.index['a'] = 1
+        # the stale 'a' in the middle bucket is never looked at
+        self.assertEqual(root.search('a', when=3), 1)
+        self.assertEqual(middle.probes, 0)
+        self.assertEqual(head.probes, 0)
+        # value was moved forward, and the index follows it
+        self.assertEqual(head['a'], 1)
+        self.assertEqual(root.index['a'], 3)
+        self.assertEqual(root.search('a', when=3), 1)
+        self.assertEqual(head.probes, 1)
+
+    def test_search_with_index_unindexed_key(self):
+        root = self._getTargetClass()(30, 1, when=1, index=True)
+        root.get_head(when=1)[1]['a'] = 1
+        self.assertEqual(root.search('a', 'default', when=1), 'default')
+
+    def test_search_with_index_expired_slot(self):
+        # the index points at a bucket which has expired, but which
+        # external housekeeping has not finalized yet
+        root = self._getTargetClass()(3, 1, when=1, index=True,
+                                      external_housekeeping=True)
+        root.set('a', 1, when=1)
+        self.assertEqual(root.search('a', when=5), None)
+        self.assertEqual(root.index['a'], 1)
+        self.assertEqual(len([x for x in root.slots if x is not None]), 2)
+
+    def test_notify_end_prunes_index(self):
+        root = self._getTargetClass()(30, 1, when=1, index=True)
+        root.nonlazy = True
+        root.get('a', when=1)
+        root.get('b', when=1)
+        root.get('b', when=40) # 'b' copied forward
+        root.get('c', when=60) # walks the whole chain, expiring slice 1
+        self.failIf('a' in root.index)
+        self.assertEqual(root.index['b'], 40)
+        self.assertEqual(root.index['c'], 60)
+
+    def test_search_many(self):
+        root = self._makeOne(30, 1, when=1)
+        tail = root.get_head(when=1)[1]
+        tail['a'] = 1
+        tail['b'] = 2
+        head = _ProbeCountingBucket({'c': 3})
+        _ring(root, (2, head), (1, tail))
+        found = root.search_many(['a', 'c', 'z'], when=2)
+        self.assertEqual(found, {'a': 1, 'c': 3})
+        # hits in older buckets are copied forward
+        self.assertEqual(head['a'], 1)
+        self.failIf('b' in head)
+        # one probe per outstanding key in the head bucket
+        self.assertEqual(head.probes, 3)
+
+    def test_search_many_stops_when_all_found(self):
+        root = self._makeOne(30, 1, when=1)
+        tail = _ProbeCountingBucket({'a': 0})
+        _ring(root, (2, {'a': 1}), (1, tail))
+        self.assertEqual(root.search_many(['a'], when=2), {'a': 1})
+        self.assertEqual(tail.probes, 0)
+
+    def test_search_many_with_index(self):
+        root = self._getTargetClass()(30, 1, when=1, index=True)
+        bucket = root.get_head(when=1)[1]
+        bucket['a'] = 1
+        bucket['b'] = 2
+        root.index['a'] = 1
+        root.get_head(when=2)
+        self.assertEqual(root.search_many(['a', 'b'], when=2), {'a': 1})
+        self.assertEqual(root.index['a'], 2)
+
+    def test_search_many_expires(self):
+        ended = self._registerEndHandler()
+        root = self._makeOne(30, 1, when=1)
+        root.set('a', 'a1', when=1)
+        self.assertEqual(root.search_many(['a', 'b'], when=60), {})
+        self.assertEqual(ended, ['a1'])
+        self.assertEqual(len(root._chain()), 1)
+
+    def test_query_many(self):
+        root = self._makeOne()
+        root.set('a', 1)
+        self.assertEqual(root.query_many(['a', 'b']), {'a': 1, 'b': None})
+        self.assertEqual(root.query_many(['b'], 0), {'b': 0})
+
+    def test_get_many(self):
+        import transaction
+        from repoze.session.interfaces import ISessionBeginEvent
+        import zope.component
+        begun = []
+        gsm = zope.component.getGlobalSiteManager()
+        gsm.registerHandler(lambda event: begun.append(event.session),
+                            (ISessionBeginEvent,))
+        root = self._makeOne(30, 1)
+        existing = root._DATA_TYPE()
+        root.set('a', existing)
+        invalid = root._DATA_TYPE()
+        invalid.invalidate()
+        root.set('i', invalid)
+        result = root.get_many(['a', 'b', 'i', 'b'])
+        self.assertEqual(sorted(result.keys()), ['a', 'b', 'i'])
+        self.failUnless(result['a'] is existing)
+        self.failIf(result['i'] is invalid)
+        self.assertEqual(len(begun), 2)
+        t = transaction.get()
+        hooks = list(t.getBeforeCommitHooks())
+        self.assertEqual(len(hooks), 1)
+        created = hooks[0][1][0]
+        self.assertEqual([x[0] for x in created], ['b', 'i'])
+        # only modified session data objects are stored at commit
+        result['b']['x'] = 1
+        root.set_many_if_modified(created)
+        self.failUnless(root.search('b') is result['b'])
+        self.failUnless(root.search('i') is invalid)
+        # as after 'get', the unmodified replacement hides 'i'
+        self.assertEqual(root.query('i'), None)
+        t.abort()
+
+    def test_get_many_nonlazy(self):
+        root = self._makeOne(30, 1)
+        root.nonlazy = True
+        result = root.get_many(['a'])
+        self.failUnless(root.query('a') is result['a'])
+
+    def test_get_many_all_found_no_hook(self):
+        import transaction
+        root = self._makeOne(30, 1)
+        root.set('a', root._DATA_TYPE())
+        root.get_many(['a'])
+        self.assertEqual(list(transaction.get().getBeforeCommitHooks()), [])
+
+    def test___init___touch_granularity(self):
+        root = self._getTargetClass()(30, 1, touch_granularity=3)
+        self.assertEqual(root.touch_granularity, 3)
+        self.failIf('touch_granularity' in self._makeOne().__dict__)
+
+    def test___init___period_bounds(self):
+        root = self._getTargetClass()(30, 5, period_bounds=[1, 10])
+        self.assertEqual(root.period_bounds, (1, 10))
+        self.failIf('period_bounds' in self._makeOne().__dict__)
+        self.assertRaises(ValueError, self._getTargetClass(), 30, 20,
+                          period_bounds=(1, 10))
+
+    def _makeAdaptive(self, timeout=600, period=20, bounds=(5, 80)):
+        return self._getTargetClass()(timeout, period, when=0,
+                                      period_bounds=bounds)
+
+    def test_get_head_adaptive_busy_shrinks_period(self):
+        root = self._makeAdaptive()
+        root.target_slice_writes = 10
+        for i in range(40):
+            root.set(i, i, when=1)
+        head = root.get_head(when=20)
+        # 4 times the target, but halved at most
+        self.assertEqual(root.period, 10)
+        # slice indices count ticks of min_period (5) seconds
+        self.assertEqual(head[0], 4)
+        self.assertEqual(len(root._chain()), 2)
+
+    def test_get_head_adaptive_idle_widens_period(self):
+        root = self._makeAdaptive()
+        self.assertEqual(root.get_head(when=20)[0], 4)
+        self.assertEqual(root.period, 40)
+        # the next slice starts on a boundary of the new period
+        self.assertEqual(root.get_head(when=39)[0], 4)
+        self.assertEqual(root.get_head(when=40)[0], 8)
+        self.assertEqual(root.period, 80)
+        root.get_head(when=160)
+        self.assertEqual(root.period, 80) # the upper bound
+        starts = [x[0] * root.tick for x in root._chain()]
+        self.assertEqual(starts, [160, 40, 20, 0])
+
+    def test_get_head_adaptive_unaligned_start(self):
+        # a slice of the new period may start within the tick the old
+        # head started in; the new head still gets the next index
+        root = self._getTargetClass()(600, 7, when=10, period_bounds=(5, 14))
+        # the slice starting at 7 is in tick 1 (5 to 10 seconds)
+        self.assertEqual(root.head_index, 1)
+        head = root.get_head(when=8)
+        self.assertEqual(root.period, 14)
+        self.assertEqual(head[0], 2)
+        self.assertEqual(len(root._chain()), 2)
+
+    def test_get_head_adaptive_on_target(self):
+        root = self._makeAdaptive()
+        root.target_slice_writes = 10
+        for i in range(10):
+            root.set(i, i, when=1)
+        root.get_head(when=20)
+        self.assertEqual(root.period, 20)
+        for i in range(10, 20):
+            root.set(i, i, when=21)
+        # the slice lasted twice as long as its period
+        root.get_head(when=60)
+        self.assertEqual(root.period, 40)
+
+    def test_get_head_adaptive_conflicts_widen_period(self):
+        root = self._makeAdaptive()
+        root.target_slice_writes = 10
+        for i in range(10):
+            root.set(i, i, when=1)
+        root.slice_conflicts = 5
+        root.get_head(when=20)
+        self.assertEqual(root.period, 40)
+        self.assertEqual(root.slice_conflicts, 0)
+
+    def test_get_head_adaptive_stats(self):
+        from repoze.session import stats
+        counters = stats.enable()
+        try:
+            root = self._makeAdaptive(bounds=(20, 20))
+            root.get_head(when=20)
+            root = self._makeAdaptive()
+            root.get_head(when=20)
+        finally:
+            stats.disable()
+        self.assertEqual(counters.get('period_changes'), 1)
+
+    def test_search_adaptive_expires_across_widths(self):
+        import zope.component
+        from repoze.session.interfaces import ISessionEndEvent
+        gsm = zope.component.getGlobalSiteManager()
+        ended = []
+        def test_event(event):
+            ended.append(event.session)
+        gsm.registerHandler(test_event, (ISessionEndEvent,))
+        root = self._makeAdaptive(timeout=60, period=10, bounds=(10, 40))
+        root.nonlazy = True
+        a = root.get('a', when=1)
+        self.failUnless(root.get('a', when=45) is a)
+        self.assertEqual(root.period, 20)
+        self.failUnless(root.search('a', when=60) is a)
+        self.assertEqual(ended, [])
+        # 'a' was last copied forward into the slice starting at 40
+        self.failUnless(root.search('a', when=100) is a)
+        self.assertEqual(root.search('a', when=180), None)
+        self.assertEqual(ended, [a])
+
+    def test_search_touch_granularity(self):
+        root = self._getTargetClass()(60, 5, touch_granularity=2)
+        head_bucket = {}
+        _ring(root, (4, head_bucket), (3, {'recent': 1}), (2, {'older': 2}))
+        self.assertEqual(root.search('recent', when=20), 1)
+        self.failIf('recent' in head_bucket)
+        self.assertEqual(root.search('older', when=20), 2)
+        self.assertEqual(head_bucket['older'], 2)
+        self.assertEqual(root.search_many(['recent'], when=20),
+                         {'recent': 1})
+        self.failIf('recent' in head_bucket)
+
+    def test_stats_head_writes(self):
+        from repoze.session import stats
+        counters = stats.enable()
+        try:
+            root = self._getTargetClass()(60, 5, touch_granularity=2)
+            _ring(root, (4, {}), (3, {'recent': 1}), (2, {'older': 2}))
+            root.set('new', 3, when=20)
+            root.search('recent', when=20)
+            root.search('older', when=20)
+            root.search('new', when=20)
+        finally:
+            stats.disable()
+        self.assertEqual(counters.as_dict(),
+                         {'head_writes': 2, 'copy_forwards': 1,
+                          'copy_forwards_skipped': 1,
+                          'hits': {0: 1, 1: 1, 2: 1}})
+
+    def test_stats(self):
+        import transaction
+        from repoze.session import stats
+        counters = stats.enable()
+        try:
+            root = self._makeOne(30, 1, when=1)
+            a = root.get('a', when=1)
+            root.get('b', when=1)
+            t = transaction.get()
+            a['x'] = 1
+            for hook, args, kw in t.getBeforeCommitHooks():
+                hook(*args, **kw)
+            t.abort()
+            root.search_many(['a', 'c'], when=1)
+            root.get_many(['d', 'e'], when=60)
+            self.assertRaises(ConflictError, root._p_resolveConflict,
+                              *_statify(root, self._makeOne(30, 2), root))
+            root._p_resolveConflict(*_statify(root, root, root))
+        finally:
+            stats.disable()
+        result = counters.as_dict()
+        self.assertEqual(result['sessions_created'], 4)
+        self.assertEqual(result['sessions_persisted'], 1)
+        self.assertEqual(result['hits'], {0: 1})
+        self.assertEqual(result['misses'], 5)
+        self.assertEqual(result['head_rotations'], 1)
+        self.assertEqual(result['buckets_expired'], 1)
+        self.assertEqual(result['sessions_ended'], 1)
+        self.assertEqual(result['conflicts_raised'], {'manager': 1})
+        self.assertEqual(result['conflicts_resolved'], {'manager': 1})
 
     # Tres' tests
     def test_CR_period_conflict_raises_ConflictError(self):
@@ -208,251 +554,282 @@ class SessionDataManagerTests(unittest.TestCase, PlacelessSetup):
                           new._p_resolveConflict,
                           *_statify(old, committed, new))
 
-    def test_CR_committed_tail_newer_than_old_head_raises_ConflictError(self):
-        from ZODB.POSException import ConflictError
-        from repoze.session.linkedlist import ListNode
-
-        old = self._makeOne(30, 1)
-        old.head = ListNode((1234, {}), None)
-
-        # The tail of 'committed' is more recent than the head of 'old',
-        # which makes any attempt at conflict resolution pointless.
-        committed = self._makeOne(30, 1)
-        committed.head = ListNode((2345, {}), None)
-
-        new = self._makeOne(30, 1)
-        new.head = ListNode((3456, {}), None)
-
-        self.assertRaises(ConflictError,
-                          new._p_resolveConflict,
-                          *_statify(old, committed, new))
-
-    def test_CR_new_tail_newer_than_old_head_raises_ConflictError(self):
-        from ZODB.POSException import ConflictError
-        from repoze.session.linkedlist import ListNode
-
-        old = self._makeOne(30, 1)
-        o_h = old.head = ListNode((1234, {}), None)
-
-        committed = self._makeOne(30, 1)
-        committed.head = ListNode((2345, {}), o_h)
-
-        # The tail of 'new' is more recent than the head of 'old',
-        # which makes any attempt at conflict resolution pointless.
-        new = self._makeOne(30, 1)
-        new.head = ListNode((3456, {}), None)
-
-        self.assertRaises(ConflictError,
-                          new._p_resolveConflict,
-                          *_statify(old, committed, new))
+    def _makeRings(self, *rings):
+        # managers with a timeout of 30 and a period of 1, holding the
+        # entries of each of 'rings' (newest first)
+        result = []
+        for entries in rings:
+            root = self._makeOne(30, 1, when=1)
+            _ring(root, *entries)
+            result.append(root)
+        return result
 
     def test_CR_both_adding(self):
-        from repoze.session.linkedlist import ListNode
+        b1, b2, b3, b4 = _buckets(4)
+        old, committed, new = self._makeRings(
+            [(2, b2), (1, b1)],
+            [(3, b3), (2, b2), (1, b1)],
+            [(4, b4), (2, b2), (1, b1)])
 
-        old = self._makeOne(30, 1)
-        oh = old.head = ListNode((1234, {}), ListNode((1000, {}), None))
+        resolved = new._p_resolveConflict(*_statify(old, committed, new))
 
-        committed = self._makeOne(30, 1)
-        committed.head = ListNode((2345, {}), oh)
+        self.assertEqual(_entries(resolved),
+                         [(4, b4), (3, b3), (2, b2), (1, b1)])
+        self.assertEqual(resolved['head_index'], 4)
 
-        new = self._makeOne(30, 1)
-        new.head = ListNode((3456, {}), oh)
+    def test_CR_both_adding_same_slice(self):
+        b1, bc, bn = _buckets(3)
+        old, committed, new = self._makeRings(
+            [(1, b1)],
+            [(2, bc), (1, b1)],
+            [(2, bn), (1, b1)])
 
         resolved = new._p_resolveConflict(*_statify(old, committed, new))
 
-        nodes = _flatten(resolved['head'])
-        self.assertEqual(len(nodes), 4)
-        self.assertEqual([x[0] for x in nodes], [3456, 2345, 1234, 1000])
+        # both buckets are kept, new's first
+        self.assertEqual(_entries(resolved), [(2, bn, bc), (1, b1)])
+        self.assertEqual(resolved['head_index'], 2)
+
+    def test_CR_references(self):
+        # in a storage the states hold PersistentReferences, which
+        # raise ValueError when compared with a different reference
+        from ZODB.ConflictResolution import PersistentReference
+        def ref(n):
+            return PersistentReference(b'\0' * 7 + chr(n).encode('ascii'))
+        old, committed, new = self._makeRings(
+            [(1, ref(1))],
+            [(2, ref(2)), (1, ref(1))],
+            [(2, ref(3)), (1, ref(1))])
+        states = _statify(old, committed, new)
+        states[0]['_expired_buckets'] = (ref(4),)
+        states[1]['_expired_buckets'] = ()
+        states[2]['_expired_buckets'] = (ref(4),)
+
+        resolved = new._p_resolveConflict(*states)
+
+        entries = _entries(resolved)
+        self.assertEqual([[r.oid for r in entry[1:]]
+                          for entry in entries],
+                         [[ref(3).oid, ref(2).oid], [ref(1).oid]])
+        self.assertEqual(resolved['_expired_buckets'], ())
 
     def test_CR_both_truncating(self):
-        from repoze.session.linkedlist import ListNode
-
-        old = self._makeOne(30, 1)
-        oh = old.head = ListNode((1234, {}), ListNode((1000, {}), None))
-
-        committed = self._makeOne(30, 1)
-        committed.head = ListNode((1234, {}), None)
-
-        new = self._makeOne(30, 1)
-        new.head = ListNode((1234, {}), None)
+        b1, b33 = _buckets(2)
+        old, committed, new = self._makeRings(
+            [(33, b33), (1, b1)],
+            [(33, b33)],
+            [(33, b33)])
 
         resolved = new._p_resolveConflict(*_statify(old, committed, new))
 
-        nodes = _flatten(resolved['head'])
-        self.assertEqual(len(nodes), 1)
-        self.assertEqual([x[0] for x in nodes], [1234])
+        self.assertEqual(_entries(resolved), [(33, b33)])
 
     def test_CR_committed_adding_new_truncating(self):
-        from repoze.session.linkedlist import ListNode
-
-        old = self._makeOne(30, 1)
-        oh = old.head = ListNode((1234, {}), ListNode((1000, {}), None))
-
-        committed = self._makeOne(30, 1)
-        committed.head = ListNode((2345, {}), oh)
-
-        new = self._makeOne(30, 1)
-        new.head = ListNode((1234, {}), None) # truncating only
+        b1, b33, b34 = _buckets(3)
+        old, committed, new = self._makeRings(
+            [(33, b33), (1, b1)],
+            [(34, b34), (33, b33), (1, b1)],
+            [(33, b33)]) # truncating only
 
         resolved = new._p_resolveConflict(*_statify(old, committed, new))
 
-        nodes = _flatten(resolved['head'])
-        self.assertEqual(len(nodes), 2)
-        self.assertEqual([x[0] for x in nodes], [2345, 1234])
+        self.assertEqual(_entries(resolved), [(34, b34), (33, b33)])
+        self.assertEqual(resolved['head_index'], 34)
 
     def test_CR_committed_truncating_new_adding(self):
-        from repoze.session.linkedlist import ListNode
-
-        old = self._makeOne(30, 1)
-        oh = old.head = ListNode((1234, {}), ListNode((1000, {}), None))
-
-        committed = self._makeOne(30, 1)
-        committed.head = ListNode((1234, {}), None) # truncating only
-
-        new = self._makeOne(30, 1)
-        new.head = ListNode((2345, {}), oh)
+        b1, b33, b34 = _buckets(3)
+        old, committed, new = self._makeRings(
+            [(33, b33), (1, b1)],
+            [(33, b33)], # truncating only
+            [(34, b34), (33, b33), (1, b1)])
 
         resolved = new._p_resolveConflict(*_statify(old, committed, new))
 
-        nodes = _flatten(resolved['head'])
-        self.assertEqual(len(nodes), 2)
-        self.assertEqual([x[0] for x in nodes], [2345, 1234])
+        self.assertEqual(_entries(resolved), [(34, b34), (33, b33)])
+        self.assertEqual(resolved['head_index'], 34)
 
     def test_CR_both_adding_committed_truncating(self):
-        from repoze.session.linkedlist import ListNode
+        b1, b33, b34, b35 = _buckets(4)
+        old, committed, new = self._makeRings(
+            [(33, b33), (1, b1)],
+            [(34, b34), (33, b33)],
+            [(35, b35), (33, b33), (1, b1)])
 
-        old = self._makeOne(30, 1)
-        oh = old.head = ListNode((1234, {}), ListNode((1000, {}), None))
+        resolved = new._p_resolveConflict(*_statify(old, committed, new))
 
-        committed = self._makeOne(30, 1)
-        committed.head = ListNode((2345, {}), ListNode((1234, {}), None))
+        self.assertEqual(_entries(resolved), [(35, b35), (34, b34), (33, b33)])
 
-        new = self._makeOne(30, 1)
-        new.head = ListNode((3456, {}), oh)
+    def test_CR_new_head_replacing_truncated_slot(self):
+        # committed expired the bucket in slot 0, new replaced it with
+        # its head
+        b0, b31, b32 = _buckets(3)
+        old, committed, new = self._makeRings(
+            [(31, b31), (0, b0)],
+            [(31, b31)],
+            [(32, b32), (31, b31)])
 
         resolved = new._p_resolveConflict(*_statify(old, committed, new))
 
-        nodes = _flatten(resolved['head'])
-        self.assertEqual(len(nodes), 3)
-        self.assertEqual([x[0] for x in nodes], [3456, 2345, 1234])
+        self.assertEqual(_entries(resolved), [(32, b32), (31, b31)])
 
-    def test_CR_both_adding_new_truncating(self):
-        from repoze.session.linkedlist import ListNode
+    def test_CR_conflicting_heads_raises_ConflictError(self):
+        # new heads for different slices in the same slot
+        from ZODB.POSException import ConflictError
+        b1, bc, bn = _buckets(3)
+        old, committed, new = self._makeRings(
+            [(1, b1)],
+            [(33, bc)],
+            [(65, bn)])
 
-        old = self._makeOne(30, 1)
-        oh = old.head = ListNode((1234, {}), ListNode((1000, {}), None))
+        self.assertRaises(ConflictError,
+                          new._p_resolveConflict,
+                          *_statify(old, committed, new))
 
-        committed = self._makeOne(30, 1)
-        committed.head = ListNode((2345, {}), oh)
+    def test_CR_linked_list_old(self):
+        # the old state was pickled before the ring existed
+        from repoze.session.linkedlist import ListNode
+        b1, b2, b3 = _buckets(3)
+        committed, new = self._makeRings(
+            [(3, b3), (2, b2), (1, b1)],
+            [(2, b2)])
+        old = {'timeout': 30, 'period': 1,
+               'head': ListNode((2.0, b2), ListNode((1.0, b1)))}
 
-        new = self._makeOne(30, 1)
-        new.head = ListNode((3456, {}), ListNode((1234, {}), None))
+        resolved = new._p_resolveConflict(old, *_statify(committed, new))
 
-        resolved = new._p_resolveConflict(*_statify(old, committed, new))
-
-        nodes = _flatten(resolved['head'])
-        self.assertEqual(len(nodes), 3)
-        self.assertEqual([x[0] for x in nodes], [3456, 2345, 1234])
+        self.assertEqual(_entries(resolved), [(3, b3), (2, b2)])
+        self.assertEqual(resolved['head_index'], 3)
 
 
     # Chris' tests
-    def _makeState(self, timeout, period, head):
-        return {'timeout':timeout, 'period':period, 'head':head}
+    def _makeState(self, timeout, period, slots=(None, None, None),
+                   head_index=0):
+        return {'timeout':timeout, 'period':period, 'slots':slots,
+                'head_index':head_index}
 
     def test__p_resolveConflict_differingperiods(self):
         root = self._makeOne(30, 1)
-        old       = self._makeState(1, 1, None)
-        committed = self._makeState(1, 2, None)
-        new       = self._makeState(1, 2, None)
+        old       = self._makeState(1, 1)
+        committed = self._makeState(1, 2)
+        new       = self._makeState(1, 2)
         from ZODB.POSException import ConflictError
         self.assertRaises(ConflictError, root._p_resolveConflict,
                           old, committed, new)
 
+    def test__p_resolveConflict_adaptive_differingperiods(self):
+        root = self._makeOne(30, 1)
+        b0, b20, b40 = _buckets(3)
+        old       = self._makeState(600, 20, _slots(122, (4, b20), (0, b0)),
+                                    4)
+        committed = self._makeState(600, 40, _slots(122, (8, b40), (4, b20),
+                                                     (0, b0)), 8)
+        new       = self._makeState(600, 20, _slots(122, (4, b20), (0, b0)),
+                                    4)
+        for state in old, committed, new:
+            state['period_bounds'] = (5, 80)
+        result = root._p_resolveConflict(old, committed, new)
+        self.assertEqual(result['period'], 40)
+        self.assertEqual(result['slice_conflicts'], 1)
+        self.assertEqual(result['head_index'], 8)
+
+    def test__p_resolveConflict_adaptive_new_head(self):
+        root = self._makeOne(30, 1)
+        b0, b20, b40 = _buckets(3)
+        old       = self._makeState(600, 20, _slots(122, (4, b20), (0, b0)),
+                                    4)
+        committed = self._makeState(600, 20, _slots(122, (4, b20), (0, b0)),
+                                    4)
+        new       = self._makeState(600, 10, _slots(122, (8, b40), (4, b20),
+                                                     (0, b0)), 8)
+        for state in old, committed, new:
+            state['period_bounds'] = (5, 80)
+        committed['slice_conflicts'] = 2
+        result = root._p_resolveConflict(old, committed, new)
+        self.assertEqual(result['period'], 10)
+        self.assertEqual(result['slice_conflicts'], 1)
+
+    def test__p_resolveConflict_differing_period_bounds(self):
+        root = self._makeOne(30, 1)
+        old       = self._makeState(1, 1)
+        committed = self._makeState(1, 1)
+        new       = self._makeState(1, 1)
+        new['period_bounds'] = (1, 2)
+        self.assertRaises(ConflictError, root._p_resolveConflict,
+                          old, committed, new)
+
     def test__p_resolveConflict_differingtimeouts(self):
         root = self._makeOne(30, 1)
-        old       = self._makeState(1, 1, None)
-        committed = self._makeState(2, 1, None)
-        new       = self._makeState(2, 1, None)
+        old       = self._makeState(1, 1)
+        committed = self._makeState(2, 1)
+        new       = self._makeState(2, 1)
         from ZODB.POSException import ConflictError
         self.assertRaises(ConflictError, root._p_resolveConflict,
                           old, committed, new)
 
-    def test__p_resolveConflict_nointersection(self):
-        from repoze.session.linkedlist import ListNode
-        from ZODB.POSException import ConflictError
+    def test__p_resolveConflict_differing_ring_sizes(self):
         root = self._makeOne(30, 1)
-        old       = self._makeState(1, 1, ListNode((1, {}),None))
-        committed = self._makeState(1, 1, ListNode((2, {}),None))
-        new       = self._makeState(1, 1, ListNode((3, {}),None))
+        old       = self._makeState(1, 1)
+        committed = self._makeState(1, 1)
+        new       = self._makeState(1, 1, (None,) * 4)
         self.assertRaises(ConflictError, root._p_resolveConflict,
                           old, committed, new)
 
-    def test__p_resolveConflict_both_committed_and_new_have_new_head(self):
-        from repoze.session.linkedlist import ListNode
+    def test__p_resolveConflict_migrated_expired_buckets(self):
         root = self._makeOne(30, 1)
-        shared_node_tail = ListNode((1, {}), None)
-        shared_node_head = ListNode((2, {}), shared_node_tail)
-        old       = self._makeState(1, 1, shared_node_head)
-        committed = self._makeState(1, 1, ListNode((3, {}), shared_node_head))
-        new       = self._makeState(1, 1, ListNode((4, {}), shared_node_head))
+        b0, = _buckets(1)
+        old       = self._makeState(1, 1)
+        committed = self._makeState(1, 1)
+        new       = self._makeState(1, 1)
+        old['_expired_buckets'] = new['_expired_buckets'] = (b0,)
+        # committed finalized them
         result = root._p_resolveConflict(old, committed, new)
-        # note that we've composed the linked list out of both the
-        # shared elements and the new head elements in committed and
-        # new
-        self.assertEqual(result['period'], 1)
-        self.assertEqual(result['timeout'], 1)
-        head = result['head']
-        self.assertEqual(head.ob[0], 4)
-        next = head.next
-        self.assertEqual(next.ob[0], 3)
-        next = next.next
-        self.assertEqual(next.ob[0], 2)
-        next = next.next
-        self.assertEqual(next.ob[0], 1)
-        next = next.next
-        self.assertEqual(next, None)
-
-    def test__p_resolveConflict_differing_tails(self):
-        from repoze.session.linkedlist import ListNode
-        root = self._makeOne(30, 1)
-
-        long_tail     = ListNode((1, {}), None)
-        long_between  = ListNode((2, {}), long_tail)
-        long_head     = ListNode((3, {}), long_between)
-
-        mid_tail      = ListNode((2, {}), None)
-        mid_head      = ListNode((3, {}), mid_tail)
-
-        short_head    = ListNode((3, {}), None)
+        self.assertEqual(result['_expired_buckets'], ())
 
-        old       = self._makeState(1, 1, long_head)
-        committed = self._makeState(1, 1, mid_head)
-        new       = self._makeState(1, 1, short_head)
-
-        result = root._p_resolveConflict(old, committed, new)
-        self.assertEqual(result['period'], 1)
-        self.assertEqual(result['timeout'], 1)
-        # we take the intersection of the three states, so we only get "3" back
-        head = result['head']
-        self.assertEqual(head.ob[0], 3)
-        next = head.next
-        self.assertEqual(next, None)
+    def test___setstate___migrates_linked_list(self):
+        from BTrees.OOBTree import OOBTree
+        from repoze.session.linkedlist import ListNode
+        b1, b2, b40 = _buckets(3)
+        b1['gone'] = 'g'
+        b2['a'] = 'a2'
+        b40['b'] = 'b40'
+        index = OOBTree({'a': 20.0, 'b': 40.0})
+        state = {'timeout': 30, 'period': 20, 'index': index,
+                 'head': ListNode((40.0, b40), ListNode((20.0, b2),
+                                                        ListNode((0.0, b1))))}
+        root = self._getTargetClass().__new__(self._getTargetClass())
+        root.__setstate__(state)
+        self.failIf(hasattr(root, 'head'))
+        self.assertEqual(root.tick, 20)
+        self.assertEqual(len(root.slots), 3)
+        self.assertEqual(root.head_index, 2)
+        self.assertEqual(root._chain(), [(2, b40), (1, b2)])
+        self.assertEqual(root._expired_buckets, (b1,))
+        self.failUnless(root._index_in_seconds)
+        # the index still maps to timestamps
+        self.assertEqual(root.search('a', when=40), 'a2')
+        self.assertEqual(index['a'], 40)
+        self.assertEqual(root.search('b', when=40), 'b40')
+        # the leftover bucket is finalized by the next expiry
+        ended = self._registerEndHandler()
+        self.assertEqual(root.housekeep(when=40), 1)
+        self.assertEqual(ended, ['g'])
+        self.assertEqual(root._expired_buckets, ())
 
     def test_set_if_modified(self):
         root = self._makeOne(30, 1)
         sdo = root.get('a')
         root.set_if_modified('a', sdo, 0)
-        self.failIf(sdo is root.get('a'))
+        self.failIf(sdo is root.search('a'))
         sdo['foo'] = 'bar'
         root.set_if_modified('a', sdo, 0)
-        self.failIf(sdo is not root.get('a'))
+        self.failIf(sdo is not root.search('a'))
 
     def test_set_if_modified_short_circuit(self):
         root = self._makeOne(30, 1)
         sdo = root.get('a')
         sdo.last_modified = 123
         root.set_if_modified('a', sdo, 123)
-        self.failIf(sdo is root.get('a'))
+        self.failIf(sdo is root.search('a'))
 
     def test_laziness(self):
         import transaction
@@ -469,6 +846,127 @@ class SessionDataManagerTests(unittest.TestCase, PlacelessSetup):
 
         t.abort() # clear commit hooks
 
+    def test_get_memoized_new_session(self):
+        import transaction
+        import zope.component
+        from repoze.session.interfaces import ISessionBeginEvent
+        gsm = zope.component.getGlobalSiteManager()
+        begun = []
+        def test_event(event):
+            begun.append(event.session)
+        gsm.registerHandler(test_event, (ISessionBeginEvent,))
+        root = self._makeOne(3600, 600)
+        sdo = root.get('a')
+        self.failUnless(root.get('a') is sdo)
+        self.assertEqual(root.query('a'), None)
+        self.assertEqual(root.has_key('a'), False)
+        sdo['foo'] = 'bar'
+        self.failUnless(root.query('a') is sdo)
+        self.assertEqual(root.has_key('a'), True)
+        self.assertEqual(begun, [sdo])
+        hooks = list(transaction.get().getBeforeCommitHooks())
+        self.assertEqual(len(hooks), 1)
+
+    def test_get_memoized_no_search(self):
+        import transaction
+        root = self._makeOne(3600, 600)
+        root.set('a', root._DATA_TYPE())
+        transaction.abort()
+        searches = []
+        search = root.search
+        def counting_search(*arg, **kw):
+            searches.append(arg)
+            return search(*arg, **kw)
+        root.search = counting_search
+        sdo = root.get('a')
+        self.failUnless(root.get('a') is sdo)
+        self.failUnless(root.query('a') is sdo)
+        self.assertEqual(root.query('b'), None)
+        self.assertEqual(root.query('b', 1), 1)
+        self.assertEqual(len(searches), 2)
+        transaction.abort()
+        self.failUnless(root.get('a') is sdo) # found again
+        self.assertEqual(len(searches), 3)
+
+    def test_get_memo_cleared_on_abort(self):
+        import transaction
+        root = self._makeOne(3600, 600)
+        sdo = root.get('a')
+        transaction.abort()
+        self.failIf(root.get('a') is sdo)
+
+    def test_get_memo_invalidated_session(self):
+        root = self._makeOne(3600, 600)
+        sdo = root.get('a')
+        sdo.invalidate()
+        new = root.get('a')
+        self.failIf(new is sdo)
+        self.failUnless(root.get('a') is new)
+
+    def test_get_memo_new_timeslice(self):
+        root = self._makeOne(30, 1, when=1)
+        root.nonlazy = True
+        a = root.get('a', when=1)
+        self.failUnless(root.get('a', when=1) is a)
+        root.get('b', when=60) # 'a' expires
+        self.failIf(root.get('a', when=60) is a)
+
+    def test_get_many_memoized(self):
+        import transaction
+        root = self._makeOne(3600, 600)
+        root.set('a', root._DATA_TYPE())
+        transaction.abort()
+        searched = []
+        search_many = root.search_many
+        def counting_search_many(keys, when=None):
+            searched.append(sorted(keys))
+            return search_many(keys, when)
+        root.search_many = counting_search_many
+        a = root.get('a')
+        new = root.get('n')
+        result = root.get_many(['a', 'n', 'b'])
+        self.failUnless(result['a'] is a)
+        self.failUnless(result['n'] is new)
+        self.assertEqual(searched, [['b']])
+        self.failUnless(root.get('b') is result['b'])
+        # only 'get' registered a hook for 'n'; 'get_many' one for 'b'
+        hooks = list(transaction.get().getBeforeCommitHooks())
+        self.assertEqual(len(hooks), 2)
+        self.assertEqual([x[0] for x in hooks[1][1][0]], ['b'])
+        self.assertEqual(root.get_many(['b', 'a']),
+                         {'a': a, 'b': result['b']})
+        self.assertEqual(len(searched), 1)
+        transaction.abort()
+
+    def test_query_many_memoized(self):
+        import transaction
+        root = self._makeOne(3600, 600)
+        root.set('a', root._DATA_TYPE())
+        transaction.abort()
+        searched = []
+        search_many = root.search_many
+        def counting_search_many(keys, when=None):
+            searched.append(sorted(keys))
+            return search_many(keys, when)
+        root.search_many = counting_search_many
+        a = root.get('a')
+        new = root.get('n')
+        self.assertEqual(root.query_many(['a', 'n', 'b'], 0),
+                         {'a': a, 'n': 0, 'b': 0})
+        new['x'] = 1
+        self.assertEqual(root.query_many(['n', 'b']), {'n': new, 'b': None})
+        self.assertEqual(searched, [['b']])
+        self.failUnless(root.get_many(['b'])['b'] is root.get('b'))
+        transaction.abort()
+
+    def test_set_updates_memo(self):
+        root = self._makeOne(3600, 600)
+        root.get('a')
+        sdo = root._DATA_TYPE()
+        root.set('a', sdo)
+        self.failUnless(root.query('a') is sdo)
+        self.failUnless(root.get('a') is sdo)
+
     def test_begin_notifier(self):
         import zope.component
         gsm = zope.component.getGlobalSiteManager()
@@ -529,9 +1027,305 @@ class SessionDataManagerTests(unittest.TestCase, PlacelessSetup):
 
     def test_notify_end_with_current_buckets(self):
         sdc = self._makeOne(30, 1, when=1)
-        sdc.notify_end(None, current_buckets=[{'a':1}, {'b':2}])
+        sdc.notify_end([], current_buckets=[{'a':1}, {'b':2}])
+
+    def _registerEndHandler(self):
+        import zope.component
+        from repoze.session.interfaces import ISessionEndEvent
+        gsm = zope.component.getGlobalSiteManager()
+        ended = []
+        def test_event(event):
+            ended.append(event.session)
+        gsm.registerHandler(test_event, (ISessionEndEvent,))
+        return ended
+
+    def test_notify_end_multiple_expired_buckets(self):
+        from BTrees.OOBTree import OOBTree
+        ended = self._registerEndHandler()
+        sdc = self._makeOne(30, 1, when=1)
+        current = [OOBTree({'a': 'a3'}), OOBTree({'b': 'b2'})]
+        expired = [OOBTree({'a': 'a2', 'c': 'c2'}),
+                   OOBTree({'b': 'b1', 'c': 'c1', 'd': 'd1'})]
+        sdc.notify_end(expired, current)
+        # 'a' and 'b' are current, 'c' is finalized once, with its
+        # newest value
+        self.assertEqual(sorted(ended), ['c2', 'd1'])
+
+    def test_notify_end_non_btree_buckets(self):
+        from BTrees.OOBTree import OOBTree
+        ended = self._registerEndHandler()
+        sdc = self._makeOne(30, 1, when=1)
+        expired = [{'a': 'a1', 'b': 'b1'}]
+        sdc.notify_end(expired, [OOBTree({'a': 'a2'})])
+        self.assertEqual(ended, ['b1'])
+
+    def _registerEndedHandler(self):
+        import zope.component
+        from repoze.session.interfaces import ISessionsEndedEvent
+        gsm = zope.component.getGlobalSiteManager()
+        batches = []
+        def test_event(event):
+            batches.append(sorted(event.sessions))
+        gsm.registerHandler(test_event, (ISessionsEndedEvent,))
+        return batches
+
+    def test_notify_end_one_batch_per_pass(self):
+        from BTrees.OOBTree import OOBTree
+        ended = self._registerEndHandler()
+        batches = self._registerEndedHandler()
+        sdc = self._makeOne(30, 1, when=1)
+        expired = [OOBTree({'a': 'a2', 'c': 'c2'}),
+                   OOBTree({'b': 'b1', 'd': 'd1'})]
+        sdc.notify_end(expired, [OOBTree({'a': 'a3'})])
+        self.assertEqual(sorted(ended), ['b1', 'c2', 'd1'])
+        self.assertEqual(batches, [['b1', 'c2', 'd1']])
+        # nothing ended, nothing sent
+        sdc.notify_end([OOBTree({'a': 'a1'})],
+                       [OOBTree({'a': 'a3'})])
+        self.assertEqual(batches, [['b1', 'c2', 'd1']])
+
+    def test_notify_end_session_end_events_false(self):
+        from BTrees.OOBTree import OOBTree
+        ended = self._registerEndHandler()
+        batches = self._registerEndedHandler()
+        sdc = self._makeOne(30, 1, when=1, session_end_events=False)
+        self.failIf(sdc.session_end_events)
+        sdc.notify_end([OOBTree({'a': 'a1'})], [])
+        self.assertEqual(ended, [])
+        self.assertEqual(batches, [['a1']])
+
+    def test_notify_end_unlistened(self):
+        from BTrees.OOBTree import OOBTree
+        sdc = self._makeOne(30, 1, when=1, index=True)
+        sdc.index['a'] = 1
+        class Values(OOBTree):
+            def values(self, *arg):
+                raise AssertionError('values not needed')
+        sdc.notify_end([Values({'a': 'a1'})], [])
+        self.failIf('a' in sdc.index)
+
+    def test_end_listeners(self):
+        import zope.event
+        from repoze.session.manager import end_listeners
+        self.assertEqual(end_listeners(), (False, False))
+        self._registerEndHandler()
+        self.assertEqual(end_listeners(), (True, False))
+        self.assertEqual(end_listeners(each=False), (False, False))
+        self._registerEndedHandler()
+        self.assertEqual(end_listeners(), (True, True))
+        subscribers = zope.event.subscribers[:]
+        try:
+            del zope.event.subscribers[:]
+            self.assertEqual(end_listeners(), (False, False))
+            zope.event.subscribers.append(lambda event: None)
+            self.assertEqual(end_listeners(), (True, True))
+        finally:
+            zope.event.subscribers[:] = subscribers
+
+    def test_notify_ended_empty(self):
+        from repoze.session.manager import notify_ended
+        batches = self._registerEndedHandler()
+        notify_ended([])
+        self.assertEqual(batches, [])
         
 
+class ShardedSessionDataManagerTests(unittest.TestCase, PlacelessSetup):
+    def setUp(self):
+        PlacelessSetup.setUp(self)
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+        PlacelessSetup.tearDown(self)
+
+    def _getTargetClass(self):
+        from repoze.session.manager import ShardedSessionDataManager
+        return ShardedSessionDataManager
+
+    def _makeOne(self, timeout=60, period=5, shards=4, when=None):
+        klass = self._getTargetClass()
+        return klass(timeout, period, shards, when)
+
+    def test_class_conforms_to_ISessionDataManager(self):
+        from zope.interface.verify import verifyClass
+        from repoze.session.interfaces import ISessionDataManager
+        verifyClass(ISessionDataManager, self._getTargetClass())
+
+    def test_inst_conforms_to_ISessionDataManager(self):
+        from zope.interface.verify import verifyObject
+        from repoze.session.interfaces import ISessionDataManager
+        verifyObject(ISessionDataManager, self._makeOne())
+
+    def test___init__(self):
+        from repoze.session.manager import SessionDataManager
+        root = self._makeOne(30, 1, 3)
+        self.assertEqual(root.timeout, 30)
+        self.assertEqual(root.period, 1)
+        self.assertEqual(root.shard_count, 3)
+        for shard in root.shards:
+            self.failUnless(isinstance(shard, SessionDataManager))
+            self.assertEqual(shard.timeout, 30)
+            self.assertEqual(shard.period, 1)
+
+    def test___init___session_end_events(self):
+        klass = self._getTargetClass()
+        root = klass(60, 5, 2, session_end_events=False)
+        for shard in root.shards:
+            self.failIf(shard.session_end_events)
+        root = klass(60, 5, 2)
+        for shard in root.shards:
+            self.failUnless(shard.session_end_events)
+
+    def test___init__no_shards(self):
+        self.assertRaises(ValueError, self._makeOne, shards=0)
+
+    def test_shard_for_is_stable_and_spreads_keys(self):
+        root = self._makeOne(shards=4)
+        used = set()
+        for i in range(100):
+            key = 'key%d' % i
+            shard = root.shard_for(key)
+            self.failUnless(shard is root.shard_for(key))
+            used.add(id(shard))
+        self.assertEqual(len(used), 4)
+
+    def test_shard_for_non_string_key(self):
+        root = self._makeOne(shards=4)
+        self.failUnless(root.shard_for(12345) is root.shard_for(12345))
+
+    def test_set_query_and_has_key(self):
+        root = self._makeOne()
+        self.assertEqual(root.has_key('foo'), False)
+        self.assertEqual(root.query('foo'), None)
+        self.assertEqual(root.query('foo', 'default'), 'default')
+        root.set('foo', 'bar')
+        self.assertEqual(root.has_key('foo'), True)
+        self.assertEqual(root.query('foo'), 'bar')
+        self.assertEqual(root.search('foo'), 'bar')
+        shard = root.shard_for('foo')
+        self.assertEqual(shard.query('foo'), 'bar')
+        for other in root.shards:
+            if other is not shard:
+                self.assertEqual(other.query('foo'), None)
+
+    def test_get(self):
+        from repoze.session.interfaces import ISessionData
+        root = self._makeOne()
+        sdo = root.get('a')
+        self.failUnless(ISessionData.providedBy(sdo))
+        sdo['x'] = 1
+        import transaction
+        transaction.commit()
+        self.failUnless(root.get('a') is sdo)
+        self.failUnless(root.shard_for('a').query('a') is sdo)
+
+    def test_get_many_and_query_many(self):
+        root = self._makeOne(shards=4)
+        from repoze.session.data import SessionData
+        keys = ['key%d' % i for i in range(10)]
+        stored = {}
+        for key in keys[:5]:
+            stored[key] = SessionData()
+            root.set(key, stored[key])
+        result = root.query_many(keys, 'missing')
+        expected = dict([(k, 'missing') for k in keys[5:]])
+        expected.update(stored)
+        self.assertEqual(result, expected)
+        result = root.get_many(keys)
+        self.assertEqual(sorted(result.keys()), keys)
+        self.failUnless(result['key0'] is stored['key0'])
+
+    def test_shards_are_separate_records(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        db = DB(MappingStorage())
+        conn = db.open()
+        root = conn.root()['sessions'] = self._makeOne(shards=2)
+        transaction.commit()
+        oids = set([root._p_oid] + [x._p_oid for x in root.shards])
+        self.assertEqual(len(oids), 3)
+        conn.close()
+        db.close()
+
+class TestShardHash(unittest.TestCase):
+    def _callFUT(self, key):
+        from repoze.session.manager import shard_hash
+        return shard_hash(key)
+
+    def test_bytes_and_text_agree(self):
+        from repoze.session._compat import text_type
+        self.assertEqual(self._callFUT(b'abc'),
+                         self._callFUT(text_type('abc')))
+
+    def test_stable(self):
+        import zlib
+        self.assertEqual(self._callFUT(b'abc'), zlib.crc32(b'abc'))
+        self.assertEqual(self._callFUT(1), zlib.crc32(b'1'))
+
+class TestDifference(unittest.TestCase):
+    def _callFUT(self, c1, c2):
+        from repoze.session.manager import _difference
+        return _difference(c1, c2)
+
+    def test_chained_LOBTrees(self):
+        from BTrees.LOBTree import LOBTree
+        from BTrees.LOBTree import LOBucket
+        c1 = LOBTree({1: 'a', 2: 'b', 3: 'c'})
+        result = self._callFUT(c1, LOBTree({1: 'x'}))
+        self.failUnless(isinstance(result, LOBucket))
+        result = self._callFUT(result, LOBTree({2: 'y'}))
+        self.failUnless(isinstance(result, LOBucket))
+        self.assertEqual(list(result.items()), [(3, 'c')])
+
+    def test_chained_OOBTrees(self):
+        from BTrees.OOBTree import OOBTree
+        from BTrees.OOBTree import OOBucket
+        c1 = OOBTree({'a': 1, 'b': 2, 'c': 3})
+        result = self._callFUT(c1, OOBTree({'a': 0}))
+        result = self._callFUT(result, OOBTree({'b': 0}))
+        self.failUnless(isinstance(result, OOBucket))
+        self.assertEqual(list(result.items()), [('c', 3)])
+
+    def test_other_mappings(self):
+        result = self._callFUT({'a': 1, 'b': 2}, {'a': 0})
+        self.assertEqual(result, {'b': 2})
+
+class TestSessionManagerFactory(unittest.TestCase):
+    def _getTargetClass(self):
+        from repoze.session.manager import SessionManagerFactory
+        return SessionManagerFactory
+
+    def _makeOne(self, storage, appname, **kw):
+        klass = self._getTargetClass()
+        return klass(storage, appname, **kw)
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+
+    def test_it(self):
+        from ZODB.MappingStorage import MappingStorage
+        from repoze.session.manager import ShardedSessionDataManager
+        storage = MappingStorage()
+        factory = self._makeOne(storage, 'sessions', timeout=60, period=5,
+                                shards=2, pool_size=3, cache_size=50)
+        self.failUnless(factory.db.storage is storage)
+        self.assertEqual(factory.db.getPoolSize(), 3)
+        self.assertEqual(factory.db.getCacheSize(), 50)
+        manager = factory()
+        self.failUnless(isinstance(manager, ShardedSessionDataManager))
+        self.assertEqual(manager.timeout, 60)
+        self.assertEqual(manager.shards[0].period, 5)
+        factory.db.close()
+
+    def test___del___closes_storage(self):
+        from ZODB.MappingStorage import MappingStorage
+        storage = MappingStorage()
+        factory = self._makeOne(storage, 'sessions')
+        factory.__del__()
+        self.failIf(storage.opened())
+
 class TestFileStorageSessionManagerFactory(unittest.TestCase):
     def _getTargetClass(self):
         from repoze.session.manager import FileStorageSessionManagerFactory
@@ -547,6 +1341,8 @@ class TestFileStorageSessionManagerFactory(unittest.TestCase):
 
     def tearDown(self):
         import os
+        import transaction
+        transaction.abort()
         os.remove(self.tempfile)
 
     def test_no_conn_handler(self):
@@ -567,6 +1363,303 @@ class TestFileStorageSessionManagerFactory(unittest.TestCase):
         self.assertEqual(e['conn']._db, factory.db)
         factory.db.close()
 
+    def test_sharded(self):
+        from repoze.session.manager import ShardedSessionDataManager
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', shards=3)
+        manager = factory()
+        self.failUnless(isinstance(manager, ShardedSessionDataManager))
+        self.assertEqual(manager.shard_count, 3)
+        self.assertEqual(manager.shards[0].index, None)
+        factory.db.close()
+
+    def test_index(self):
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', index=True)
+        manager = factory()
+        self.failIf(manager.index is None)
+        factory.db.close()
+
+    def test_period_bounds(self):
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', period=20,
+                        period_bounds=(10, 40))
+        manager = factory()
+        self.assertEqual(manager.period_bounds, (10, 40))
+        factory.db.close()
+
+    def test_key_codec(self):
+        from BTrees.LOBTree import LOBTree
+        from repoze.session.keys import IntegerKeyCodec
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', key_codec=IntegerKeyCodec())
+        manager = factory()
+        self.failUnless(isinstance(manager.key_codec, IntegerKeyCodec))
+        self.failUnless(isinstance(manager.get_head()[1], LOBTree))
+        factory.db.close()
+
+    def test_session_end_events(self):
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', session_end_events=False)
+        self.failIf(factory().session_end_events)
+        factory.db.close()
+
+    def test_sharded_session_end_events(self):
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', shards=2,
+                        session_end_events=False)
+        manager = factory()
+        self.failIf(manager.shards[1].session_end_events)
+        factory.db.close()
+
+    def test_sharded_period_bounds(self):
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', period=20, shards=2,
+                        period_bounds=(10, 40))
+        manager = factory()
+        self.assertEqual(manager.shards[1].period_bounds, (10, 40))
+        factory.db.close()
+
+    def _conn(self, factory):
+        conns = []
+        factory(conns.append)
+        return conns[0]
+
+    def test_db_settings(self):
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', pool_size=3,
+                        cache_size=50, cache_size_bytes=1 << 20)
+        self.assertEqual(factory.db.getPoolSize(), 3)
+        self.assertEqual(factory.db.getCacheSize(), 50)
+        self.assertEqual(factory.db.getCacheSizeBytes(), 1 << 20)
+        factory.db.close()
+
+    def test_unpooled_opens_per_call(self):
+        factory = self._makeOne(self.tempfile, 'session')
+        self.failIf(self._conn(factory) is self._conn(factory))
+        factory.db.close()
+
+    def test_pooled_reuses_thread_connection(self):
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', pooled=True)
+        self.failUnless(self._conn(factory) is self._conn(factory))
+        factory.db.close()
+
+    def test_pooled_connection_per_thread(self):
+        import threading
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', pooled=True)
+        jars = []
+        def work():
+            jars.append(self._conn(factory))
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.failIf(self._conn(factory) is jars[0])
+        factory.close_thread_connection()
+        factory.db.close()
+
+    def test_pooled_syncs(self):
+        import threading
+        import transaction
+        from repoze.session.data import SessionData
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', pooled=True)
+        factory()
+        transaction.commit()
+        def work():
+            factory().set('a', SessionData({'b': 1}))
+            transaction.commit()
+            factory.close_thread_connection()
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        manager = factory()
+        self.assertEqual(manager.query('a')['b'], 1)
+        factory.close_thread_connection()
+        factory.db.close()
+
+    def test_pooled_calls_in_one_transaction(self):
+        import transaction
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', pooled=True)
+        factory()
+        transaction.commit()
+        manager = factory()
+        manager.get('k')['x'] = 1
+        self.failUnless(factory() is manager)
+        transaction.commit()
+        self.assertEqual(factory().query('k')['x'], 1)
+        factory.close_thread_connection()
+        factory.db.close()
+
+    def test_pooled_reopens_closed_connection(self):
+        from repoze.session.manager import ConnectionManager
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', pooled=True)
+        import transaction
+        cm = ConnectionManager()
+        factory(cm)
+        transaction.commit()
+        jar = cm.conn
+        cm.close()
+        self.assertEqual(jar.opened, None)
+        self.failIf(self._conn(factory).opened is None)
+        factory.close_thread_connection()
+        factory.db.close()
+
+    def test_close_thread_connection(self):
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', pooled=True)
+        jar = self._conn(factory)
+        factory.close_thread_connection()
+        self.assertEqual(jar.opened, None)
+        factory.close_thread_connection() # no-op
+        factory.db.close()
+
+    def test_session_manager_closes_connection(self):
+        import transaction
+        from repoze.session.manager import SessionDataManager
+        factory = self._makeOne(self.tempfile, 'session')
+        with factory.session_manager() as manager:
+            self.failUnless(isinstance(manager, SessionDataManager))
+            transaction.commit()
+            jar = manager._p_jar
+        self.assertEqual(jar.opened, None)
+        factory.db.close()
+
+    def test_session_manager_read_without_commit(self):
+        import transaction
+        factory = self._makeOne(self.tempfile, 'session')
+        with factory.session_manager() as manager:
+            transaction.commit()
+        with factory.session_manager() as manager:
+            self.assertEqual(manager.query('a'), None)
+            # a head rotation, as a read may do, dirties the manager
+            manager.get_head(when=10 ** 10)
+            jar = manager._p_jar
+            self.failUnless(jar._registered_objects)
+        self.assertEqual(jar.opened, None)
+        factory.db.close()
+
+    def test_session_manager_aborts_on_error(self):
+        import transaction
+        factory = self._makeOne(self.tempfile, 'session')
+        def fail():
+            with factory.session_manager() as manager:
+                manager.get('a')['b'] = 1
+                raise KeyError('x')
+        self.assertRaises(KeyError, fail)
+        with factory.session_manager() as manager:
+            self.assertEqual(manager.query('a'), None)
+            transaction.commit()
+        factory.db.close()
+
+    def test_session_manager_pooled_keeps_connection(self):
+        import transaction
+        klass = self._getTargetClass()
+        factory = klass(self.tempfile, 'session', pooled=True)
+        with factory.session_manager() as manager:
+            transaction.commit()
+            jar = manager._p_jar
+        self.failIf(jar.opened is None)
+        with factory.session_manager() as manager:
+            self.failUnless(manager._p_jar is jar)
+        factory.close_thread_connection()
+        factory.db.close()
+
+@unittest.skipIf(ZEO is None, 'ZEO is not installed')
+class TestZEOSessionManagerFactory(unittest.TestCase):
+    def _getTargetClass(self):
+        from repoze.session.manager import ZEOSessionManagerFactory
+        return ZEOSessionManagerFactory
+
+    def _makeOne(self, appname='session', **kw):
+        klass = self._getTargetClass()
+        factory = klass(self.address, appname, **kw)
+        self.factories.append(factory)
+        return factory
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+        self.address, self.stop = ZEO.server(
+            os.path.join(self.tempdir, 'sessions.fs'))
+        self.factories = []
+
+    def tearDown(self):
+        import shutil
+        import transaction
+        transaction.abort()
+        for factory in self.factories:
+            factory.db.close()
+        self.stop()
+        shutil.rmtree(self.tempdir)
+
+    def test_it(self):
+        import transaction
+        from repoze.session.data import SessionData
+        from repoze.session.manager import SessionDataManager
+        factory = self._makeOne()
+        manager = factory()
+        self.failUnless(isinstance(manager, SessionDataManager))
+        manager.set('a', SessionData({'b': 1}))
+        transaction.commit()
+        # another client, as in another process, sees the session
+        other = self._makeOne()
+        self.assertEqual(other().query('a')['b'], 1)
+
+    def test_manager_settings(self):
+        from repoze.session.bucket import PartitionedBucket
+        from repoze.session.manager import ShardedSessionDataManager
+        factory = self._makeOne(period=20, shards=2, period_bounds=(10, 40),
+                                bucket_type=PartitionedBucket,
+                                session_end_events=False)
+        manager = factory()
+        self.failUnless(isinstance(manager, ShardedSessionDataManager))
+        self.failIf(manager.shards[0].session_end_events)
+        self.assertEqual(manager.shards[1].period_bounds, (10, 40))
+        self.failUnless(isinstance(manager.shards[0].get_head()[1],
+                                   PartitionedBucket))
+
+    def test_db_settings(self):
+        factory = self._makeOne(pool_size=3, cache_size=50,
+                                cache_size_bytes=1 << 20)
+        self.assertEqual(factory.db.getPoolSize(), 3)
+        self.assertEqual(factory.db.getCacheSize(), 50)
+        self.assertEqual(factory.db.getCacheSizeBytes(), 1 << 20)
+
+    def test_client_cache(self):
+        import os
+        factory = self._makeOne(client_cache_size=1 << 20)
+        self.assertEqual(factory.db.storage._cache.maxsize, 1 << 20)
+        self._makeOne(client_cache='sessions',
+                      client_cache_dir=self.tempdir)
+        self.failUnless(os.path.exists(os.path.join(self.tempdir,
+                                                    'sessions-1.zec')))
+
+    def test_read_only(self):
+        import transaction
+        from ZODB.POSException import ReadOnlyError
+        from repoze.session.data import SessionData
+        self._makeOne()()
+        transaction.commit()
+        factory = self._makeOne(read_only=True)
+        self.failUnless(factory.db.storage.isReadOnly())
+        manager = factory()
+        self.assertEqual(manager.query('a'), None)
+        manager.set('a', SessionData())
+        self.assertRaises(ReadOnlyError, transaction.commit)
+
+    def test_pooled(self):
+        factory = self._makeOne(pooled=True)
+        conns = []
+        factory(conns.append)
+        factory(conns.append)
+        self.failUnless(conns[0] is conns[1])
+        factory.close_thread_connection()
+
 class TestConnectioManager(unittest.TestCase):
     def _getTargetClass(self):
         from repoze.session.manager import ConnectionManager
@@ -598,6 +1691,78 @@ class TestConnectioManager(unittest.TestCase):
         gc.collect()
         self.assertEqual(conn.closed, True)
 
+    def test_close_twice(self):
+        conn = DummyConnection()
+        manager = self._makeOne()
+        manager(conn)
+        manager.close()
+        conn.closed = False
+        manager.close()
+        self.assertEqual(conn.closed, False)
+
+    def test_close_without_connection(self):
+        manager = self._makeOne()
+        manager.close()
+        self.assertEqual(manager.conn, None)
+
+    def test_del_without_connection(self):
+        import gc
+        manager = self._makeOne()
+        del manager
+        gc.collect()
+
+    def test_del_swallows_errors(self):
+        import gc
+        conn = DummyConnection()
+        def close():
+            raise ValueError('pending changes')
+        conn.close = close
+        manager = self._makeOne()
+        manager(conn)
+        del manager
+        gc.collect()
+
+    def test_context_manager(self):
+        conn = DummyConnection()
+        conn.transaction_manager = DummyTransaction()
+        with self._makeOne() as manager:
+            manager(conn)
+        self.assertEqual(conn.transaction_manager.aborted, True)
+        self.assertEqual(conn.closed, True)
+
+    def test_context_manager_read_only_block(self):
+        # reading may rotate the head bucket, joining the connection
+        # to the transaction; leaving the block must still close it
+        import os
+        import shutil
+        import tempfile
+        from repoze.session.manager import FileStorageSessionManagerFactory
+        tempdir = tempfile.mkdtemp()
+        try:
+            factory = FileStorageSessionManagerFactory(
+                os.path.join(tempdir, 'sessions.fs'), 'session',
+                period=1)
+            with self._makeOne() as manager:
+                factory(manager)
+                conn = manager.conn
+                conn.root()['session'].get_head(when=10 ** 10)
+                self.failUnless(conn._registered_objects)
+            self.assertEqual(conn.opened, None)
+            factory.db.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_context_manager_aborts_on_error(self):
+        conn = DummyConnection()
+        conn.transaction_manager = DummyTransaction()
+        def fail():
+            with self._makeOne() as manager:
+                manager(conn)
+                raise KeyError('x')
+        self.assertRaises(KeyError, fail)
+        self.assertEqual(conn.transaction_manager.aborted, True)
+        self.assertEqual(conn.closed, True)
+
     def test_commit(self):
         conn = DummyConnection()
         txn = DummyTransaction()
@@ -627,15 +1792,35 @@ class DummyTransaction:
     def commit(self):
         self.committed = True
 
-def _statify(*things):
-    return [{'timeout':x.timeout, 'period':x.period, 'head':x.head}
-                for x in things]
+    def abort(self):
+        self.aborted = True
 
-def _flatten(head):
-    result = []
-    while head is not None:
-        result.append(head.ob)
-        head = head.next
-    return result
+class _ProbeCountingBucket(dict):
+    probes = 0
+    def get(self, k, default=None):
+        self.probes += 1
+        return dict.get(self, k, default)
 
-            
+def _statify(*things):
+    return [{'timeout':x.timeout, 'period':x.period, 'slots':x.slots,
+             'head_index':x.head_index} for x in things]
+
+def _buckets(count):
+    from BTrees.OOBTree import OOBTree
+    return [OOBTree() for i in range(count)]
+
+def _slots(size, *entries):
+    slots = [None] * size
+    for entry in entries:
+        slots[entry[0] % size] = entry
+    return tuple(slots)
+
+def _ring(root, *entries):
+    # replace the buckets of 'root' with 'entries', newest first
+    root.slots = _slots(len(root.slots), *entries)
+    root.head_index = entries[0][0]
+
+def _entries(state):
+    # the entries of a resolved state, newest first
+    entries = [x for x in state['slots'] if x is not None]
+    return sorted(entries, key=lambda x: x[0], reverse=True)
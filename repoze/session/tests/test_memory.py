@@ -0,0 +1,238 @@
+import unittest
+
+from zope.component.testing import PlacelessSetup
+
+class MemorySessionDataManagerTests(unittest.TestCase, PlacelessSetup):
+    def setUp(self):
+        import transaction
+        transaction.abort()
+        PlacelessSetup.setUp(self)
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+        PlacelessSetup.tearDown(self)
+
+    def _getTargetClass(self):
+        from repoze.session.memory import MemorySessionDataManager
+        return MemorySessionDataManager
+
+    def _makeOne(self, timeout=60, period=5, when=None, **kw):
+        klass = self._getTargetClass()
+        return klass(timeout, period, when, **kw)
+
+    def _registerHandler(self, iface):
+        import zope.component
+        gsm = zope.component.getGlobalSiteManager()
+        sessions = []
+        def handler(event):
+            sessions.append(event.session)
+        gsm.registerHandler(handler, (iface,))
+        return sessions
+
+    def test_class_conforms_to_ISessionDataManager(self):
+        from zope.interface.verify import verifyClass
+        from repoze.session.interfaces import ISessionDataManager
+        verifyClass(ISessionDataManager, self._getTargetClass())
+
+    def test_inst_conforms_to_ISessionDataManager(self):
+        from zope.interface.verify import verifyObject
+        from repoze.session.interfaces import ISessionDataManager
+        verifyObject(ISessionDataManager, self._makeOne())
+
+    def test_ring_size(self):
+        sdc = self._makeOne(60, 5)
+        self.assertEqual(sdc.size, 14)
+        self.assertEqual(len(sdc.slices), 14)
+
+    def test_set_query_and_has_key(self):
+        sdc = self._makeOne()
+        self.assertEqual(sdc.has_key('foo'), False)
+        self.assertEqual(sdc.query('foo'), None)
+        self.assertEqual(sdc.query('foo', 1), 1)
+        sdc.set('foo', 'bar')
+        self.assertEqual(sdc.has_key('foo'), True)
+        self.assertEqual(sdc.query('foo'), 'bar')
+        self.assertEqual(len(sdc), 1)
+
+    def test_get_lazy(self):
+        import transaction
+        from repoze.session.interfaces import ISessionData
+        from repoze.session.interfaces import ISessionBeginEvent
+        begun = self._registerHandler(ISessionBeginEvent)
+        sdc = self._makeOne()
+        sdo = sdc.get('a')
+        self.failUnless(ISessionData.providedBy(sdo))
+        self.assertEqual(begun, [sdo])
+        self.assertEqual(sdc.query('a'), None)
+        sdo['b'] = 1
+        transaction.commit()
+        self.failUnless(sdc.query('a') is sdo)
+        self.failUnless(sdc.get('a') is sdo)
+
+    def test_get_lazy_unmodified(self):
+        import transaction
+        sdc = self._makeOne()
+        sdc.get('a')
+        transaction.commit()
+        self.assertEqual(sdc.query('a'), None)
+
+    def test_get_nonlazy(self):
+        sdc = self._makeOne()
+        sdc.nonlazy = True
+        sdo = sdc.get('a')
+        self.failUnless(sdc.query('a') is sdo)
+
+    def test_get_invalid(self):
+        sdc = self._makeOne()
+        sdc.nonlazy = True
+        sdo = sdc.get('a')
+        sdo.invalidate()
+        self.failIf(sdc.get('a') is sdo)
+
+    def test_get_many_and_query_many(self):
+        sdc = self._makeOne()
+        sdc.nonlazy = True
+        first = sdc.get('a')
+        result = sdc.get_many(['a', 'b', 'b'])
+        self.failUnless(result['a'] is first)
+        self.assertEqual(sorted(result), ['a', 'b'])
+        self.assertEqual(sdc.query_many(['a', 'c'], 0),
+                         {'a': first, 'c': 0})
+
+    def test_move_forward(self):
+        sdc = self._makeOne(30, 1, when=1)
+        sdc.set('a', 'a1', when=1)
+        self.assertEqual(sdc.search('a', when=5), 'a1')
+        self.assertEqual(sdc.where['a'], 5)
+        self.assertEqual(sdc.buckets[sdc._slot(5)], {'a': 'a1'})
+        self.assertEqual(sdc.buckets[sdc._slot(1)], {})
+
+    def test_touch_granularity(self):
+        sdc = self._makeOne(30, 1, when=1, touch_granularity=3)
+        sdc.set('a', 'a1', when=1)
+        self.assertEqual(sdc.search('a', when=3), 'a1')
+        self.assertEqual(sdc.where['a'], 1)
+        self.assertEqual(sdc.search('a', when=4), 'a1')
+        self.assertEqual(sdc.where['a'], 4)
+
+    def test_set_moves_forward(self):
+        sdc = self._makeOne(30, 1, when=1)
+        sdc.set('a', 'a1', when=1)
+        sdc.set('a', 'a2', when=2)
+        self.assertEqual(sdc.buckets[sdc._slot(1)], {})
+        self.assertEqual(sdc.query('a'), None) # expired by now
+
+    def test_expiry(self):
+        from repoze.session.interfaces import ISessionEndEvent
+        ended = self._registerHandler(ISessionEndEvent)
+        sdc = self._makeOne(30, 1, when=1)
+        sdc.set('a', 'a1', when=1)
+        sdc.set('b', 'b1', when=2)
+        self.assertEqual(sdc.search('a', when=31), 'a1')
+        self.assertEqual(ended, [])
+        self.assertEqual(sdc.search('b', when=33), None)
+        self.assertEqual(ended, ['b1'])
+        self.assertEqual(sdc.search('a', when=33), 'a1')
+        self.assertEqual(len(sdc), 1)
+
+    def test_expiry_slot_reuse(self):
+        from repoze.session.interfaces import ISessionEndEvent
+        ended = self._registerHandler(ISessionEndEvent)
+        sdc = self._makeOne(10, 5, when=0)
+        sdc.set('a', 'a1', when=0)
+        # size is 4, so slice 20 reuses slice 0's slot
+        self.assertEqual(sdc.search('a', when=20), None)
+        self.assertEqual(ended, ['a1'])
+        self.assertEqual(sdc.slices.count(None), 3)
+
+    def test_housekeep(self):
+        from repoze.session.interfaces import ISessionEndEvent
+        ended = self._registerHandler(ISessionEndEvent)
+        sdc = self._makeOne(30, 1, when=1)
+        sdc.set('a', 'a1', when=1)
+        sdc.set('b', 'b1', when=2)
+        self.assertEqual(sdc.housekeep(when=10), 0)
+        self.assertEqual(sdc.housekeep(when=40), 2)
+        self.assertEqual(sorted(ended), ['a1', 'b1'])
+        self.assertEqual(sdc.housekeep(when=40), 0)
+
+    def test_housekeep_batch_event(self):
+        import zope.component
+        from repoze.session.interfaces import ISessionEndEvent
+        from repoze.session.interfaces import ISessionsEndedEvent
+        ended = self._registerHandler(ISessionEndEvent)
+        batches = []
+        def handler(event):
+            batches.append(sorted(event.sessions))
+        zope.component.getGlobalSiteManager().registerHandler(
+            handler, (ISessionsEndedEvent,))
+        sdc = self._makeOne(30, 1, when=1)
+        sdc.session_end_events = False
+        sdc.set('a', 'a1', when=1)
+        sdc.set('b', 'b1', when=2)
+        self.assertEqual(sdc.housekeep(when=40), 2)
+        self.assertEqual(ended, [])
+        self.assertEqual(batches, [['a1', 'b1']])
+
+    def test_end_subscriber_may_use_manager(self):
+        import zope.component
+        from repoze.session.interfaces import ISessionEndEvent
+        sdc = self._makeOne(30, 1, when=1)
+        sdc.set('a', 'a1', when=1)
+        seen = []
+        def handler(event):
+            seen.append(sdc.query('b'))
+        zope.component.getGlobalSiteManager().registerHandler(
+            handler, (ISessionEndEvent,))
+        sdc.housekeep(when=40)
+        self.assertEqual(seen, [None])
+
+    def test_stats(self):
+        from repoze.session.stats import SessionStats
+        sdc = self._makeOne(30, 1, when=1)
+        stats = sdc.stats = SessionStats()
+        sdc.set('a', 'a1', when=1)
+        sdc.search('a', when=3)
+        sdc.search('a', when=3)
+        sdc.search('b', when=3)
+        sdc.housekeep(when=40)
+        self.assertEqual(stats.as_dict(), {
+            'head_writes': 2, 'copy_forwards': 1, 'hits': {2: 1, 0: 1},
+            'misses': 1, 'head_rotations': 2, 'buckets_expired': 2,
+            'sessions_ended': 1})
+
+    def test_threads(self):
+        import threading
+        sdc = self._makeOne()
+        def work(n):
+            for i in range(200):
+                key = (n, i % 20)
+                sdc.set(key, sdc.query(key, 0) + 1)
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(sdc), 80)
+        self.assertEqual(sdc.query((0, 0)), 10)
+
+class TestMemorySessionManagerFactory(unittest.TestCase):
+    def _getTargetClass(self):
+        from repoze.session.memory import MemorySessionManagerFactory
+        return MemorySessionManagerFactory
+
+    def test_it(self):
+        from repoze.session.manager import ConnectionManager
+        from repoze.session.memory import MemorySessionDataManager
+        factory = self._getTargetClass()(timeout=60, period=5,
+                                         touch_granularity=2)
+        cm = ConnectionManager()
+        manager = factory(cm)
+        self.failUnless(isinstance(manager, MemorySessionDataManager))
+        self.failUnless(factory() is manager)
+        self.assertEqual(manager.timeout, 60)
+        self.assertEqual(manager.period, 5)
+        self.assertEqual(manager.touch_granularity, 2)
+        cm.close()
@@ -0,0 +1,346 @@
+import unittest
+
+class TestSessionMiddleware(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        import transaction
+        from repoze.session.manager import FileStorageSessionManagerFactory
+        transaction.abort()
+        self.tmpdir = tempfile.mkdtemp()
+        self.factory = FileStorageSessionManagerFactory(
+            os.path.join(self.tmpdir, 'sessions.fs'), 'sessions')
+        self.calls = 0
+
+    def tearDown(self):
+        import shutil
+        import transaction
+        transaction.abort()
+        self.factory.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _counting_factory(self, cm=None):
+        self.calls += 1
+        return self.factory(cm)
+
+    def _makeOne(self, app, **kw):
+        from repoze.session.middleware import SessionMiddleware
+        return SessionMiddleware(app, self._counting_factory, **kw)
+
+    def _request(self, middleware, cookie=None):
+        environ = {}
+        if cookie is not None:
+            environ['HTTP_COOKIE'] = cookie
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+        app_iter = middleware(environ, start_response)
+        try:
+            body = b''.join(app_iter)
+        finally:
+            # as a WSGI server must
+            close = getattr(app_iter, 'close', None)
+            if close is not None:
+                close()
+        return environ, response['headers'], body
+
+    def _set_cookie(self, headers):
+        values = [v for k, v in headers if k == 'Set-Cookie']
+        return values and values[0] or None
+
+    def _last_tid(self):
+        return self.factory.db.storage.lastTransaction()
+
+    def test_untouched(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'static']
+        environ, headers, body = self._request(self._makeOne(app))
+        self.assertEqual(body, b'static')
+        self.assertEqual(self.calls, 0)
+        self.failIf(environ['repoze.session'].loaded)
+        self.assertEqual(self._set_cookie(headers), None)
+
+    def test_new_session_modified(self):
+        def app(environ, start_response):
+            environ['repoze.session']['name'] = 'fred'
+            start_response('200 OK', [])
+            return [b'']
+        middleware = self._makeOne(app)
+        environ, headers, body = self._request(middleware)
+        key = environ['repoze.session'].key
+        self.assertEqual(self._set_cookie(headers),
+                         'repoze.session=%s; Path=/; HttpOnly' % key)
+        manager = self.factory()
+        self.assertEqual(manager.query(key)['name'], 'fred')
+
+        def reader(environ, start_response):
+            start_response('200 OK', [])
+            return [environ['repoze.session']['name'].encode('ascii')]
+        environ, headers, body = self._request(
+            self._makeOne(reader), 'repoze.session=%s' % key)
+        self.assertEqual(body, b'fred')
+        self.assertEqual(self._set_cookie(headers), None)
+
+    def test_new_session_read_only(self):
+        def app(environ, start_response):
+            environ['repoze.session'].get('name')
+            start_response('200 OK', [])
+            return [b'']
+        middleware = self._makeOne(app)
+        # the first request creates the manager and head bucket
+        self._request(middleware)
+        last = self._last_tid()
+        environ, headers, body = self._request(middleware)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self._set_cookie(headers), None)
+        self.assertEqual(self._last_tid(), last)
+
+    def test_existing_session_read_only_no_commit(self):
+        def writer(environ, start_response):
+            environ['repoze.session']['name'] = 'fred'
+            start_response('200 OK', [])
+            return [b'']
+        environ, headers, body = self._request(self._makeOne(writer))
+        key = environ['repoze.session'].key
+        last = self._last_tid()
+        def reader(environ, start_response):
+            environ['repoze.session']['name']
+            start_response('200 OK', [])
+            return [b'']
+        self._request(self._makeOne(reader), 'repoze.session=%s' % key)
+        self.assertEqual(self._last_tid(), last)
+
+    def test_app_raises(self):
+        def app(environ, start_response):
+            environ['repoze.session']['name'] = 'fred'
+            raise KeyError('boom')
+        last = self._last_tid()
+        self.assertRaises(KeyError, self._request, self._makeOne(app))
+        self.assertEqual(self._last_tid(), last)
+
+    def test_streaming(self):
+        # the session is usable until the server closes the response
+        closed = []
+        class Body(object):
+            def __init__(self, environ):
+                self.environ = environ
+            def __iter__(self):
+                yield b'a'
+                self.environ['repoze.session']['name'] = 'fred'
+                yield b'b'
+            def close(self):
+                closed.append(True)
+        def app(environ, start_response):
+            environ['repoze.session']['n'] = 1
+            start_response('200 OK', [])
+            return Body(environ)
+        environ, headers, body = self._request(self._makeOne(app))
+        self.assertEqual(body, b'ab')
+        self.assertEqual(closed, [True])
+        key = environ['repoze.session'].key
+        self.assertEqual(self.factory().query(key)['name'], 'fred')
+
+    def test_streaming_raises(self):
+        def app(environ, start_response):
+            environ['repoze.session']['name'] = 'fred'
+            start_response('200 OK', [])
+            def body():
+                yield b'a'
+                raise KeyError('boom')
+            return body()
+        last = self._last_tid()
+        self.assertRaises(KeyError, self._request, self._makeOne(app))
+        self.assertEqual(self._last_tid(), last)
+
+    def test_rotation_committed_by_read(self):
+        # reading a session from an older bucket copies it forward; the
+        # copy is committed although the session itself is unchanged
+        import transaction
+        def writer(environ, start_response):
+            environ['repoze.session']['name'] = 'fred'
+            start_response('200 OK', [])
+            return [b'']
+        environ, headers, body = self._request(self._makeOne(writer))
+        key = environ['repoze.session'].key
+        manager = self.factory()
+        manager._rotate(manager.head_index + 1)
+        transaction.commit()
+        last = self._last_tid()
+        def reader(environ, start_response):
+            environ['repoze.session']['name']
+            start_response('200 OK', [])
+            return [b'']
+        self._request(self._makeOne(reader), 'repoze.session=%s' % key)
+        self.failIf(self._last_tid() == last)
+
+    def test_invalidate_issues_new_key(self):
+        def writer(environ, start_response):
+            environ['repoze.session']['user'] = 'fred'
+            start_response('200 OK', [])
+            return [b'']
+        environ, headers, body = self._request(self._makeOne(writer))
+        old_key = environ['repoze.session'].key
+        def logout(environ, start_response):
+            environ['repoze.session'].invalidate()
+            start_response('200 OK', [])
+            return [b'']
+        environ, headers, body = self._request(
+            self._makeOne(logout), 'repoze.session=%s' % old_key)
+        session = environ['repoze.session']
+        self.failIf(session.key == old_key)
+        self.assertEqual(self._set_cookie(headers),
+                         'repoze.session=%s; Path=/; HttpOnly' % session.key)
+        self.failIf(self.factory().query(old_key).is_valid())
+        # the old key now only gets a fresh, empty session
+        def reader(environ, start_response):
+            start_response('200 OK', [])
+            return [repr(dict(environ['repoze.session'])).encode('ascii')]
+        environ, headers, body = self._request(
+            self._makeOne(reader), 'repoze.session=%s' % old_key)
+        self.assertEqual(body, b'{}')
+
+    def test_bad_cookie(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return [b'']
+        environ, headers, body = self._request(self._makeOne(app),
+                                               'repoze.session=../etc')
+        self.failUnless(environ['repoze.session'].is_new)
+        environ, headers, body = self._request(self._makeOne(app), '"')
+        self.failUnless(environ['repoze.session'].is_new)
+
+    def test_cookie_attributes(self):
+        middleware = self._makeOne(None, cookie_name='s', cookie_path='/app',
+                                   cookie_secure=True, cookie_httponly=False)
+        self.assertEqual(middleware.cookie('abc'), 's=abc; Path=/app; Secure')
+
+    def test_no_commit(self):
+        def app(environ, start_response):
+            environ['repoze.session']['name'] = 'fred'
+            start_response('200 OK', [])
+            return [b'']
+        last = self._last_tid()
+        environ, headers, body = self._request(self._makeOne(app,
+                                                             commit=False))
+        self.assertEqual(self._last_tid(), last)
+        self.failUnless(self._set_cookie(headers))
+
+    def test_memory_factory(self):
+        from repoze.session.memory import MemorySessionManagerFactory
+        from repoze.session.middleware import SessionMiddleware
+        factory = MemorySessionManagerFactory()
+        def app(environ, start_response):
+            environ['repoze.session']['name'] = 'fred'
+            start_response('200 OK', [])
+            return [b'']
+        environ, headers, body = self._request(SessionMiddleware(app,
+                                                                 factory))
+        key = environ['repoze.session'].key
+        self.assertEqual(factory().query(key)['name'], 'fred')
+
+    def test_planted_key_replaced(self):
+        from repoze.session.memory import MemorySessionManagerFactory
+        from repoze.session.middleware import SessionMiddleware
+        factory = MemorySessionManagerFactory()
+        planted = 'a' * 32
+        def app(environ, start_response):
+            environ['repoze.session']['user'] = 'victim'
+            start_response('200 OK', [])
+            return [b'']
+        middleware = SessionMiddleware(app, factory)
+        environ, headers, body = self._request(
+            middleware, 'repoze.session=%s' % planted)
+        session = environ['repoze.session']
+        self.failIf(session.key == planted)
+        self.assertEqual(factory().query(planted), None)
+        self.assertEqual(factory().query(session.key)['user'], 'victim')
+        self.assertEqual(self._set_cookie(headers),
+                         'repoze.session=%s; Path=/; HttpOnly' % session.key)
+        # the new key is kept, and no new cookie is sent for it
+        environ, headers, body = self._request(
+            middleware, 'repoze.session=%s' % session.key)
+        self.assertEqual(environ['repoze.session'].key, session.key)
+        self.assertEqual(self._set_cookie(headers), None)
+
+class TestLazySession(unittest.TestCase):
+    def setUp(self):
+        import transaction
+        transaction.abort()
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+
+    def _makeOne(self):
+        from repoze.session.memory import MemorySessionManagerFactory
+        from repoze.session.middleware import LazySession
+        return LazySession(MemorySessionManagerFactory(), 'k', True)
+
+    def test_mapping(self):
+        session = self._makeOne()
+        self.failIf(session.modified())
+        session['a'] = 1
+        self.failUnless(session.loaded)
+        self.failUnless(session.modified())
+        self.assertEqual(session['a'], 1)
+        self.failUnless('a' in session)
+        self.assertEqual(list(session), ['a'])
+        self.assertEqual(len(session), 1)
+        self.assertEqual(session.get('b', 2), 2)
+        self.assertEqual(session.setdefault('b', 3), 3)
+        del session['b']
+        self.assertEqual(sorted(session.keys()), ['a'])
+        self.failUnless(session.created)
+        self.failUnless(session.last_modified)
+        self.failUnless(session.is_valid())
+        self.assertRaises(AttributeError, getattr, session, '_nope')
+
+    def test_invalidate(self):
+        session = self._makeOne()
+        session['a'] = 1
+        sdo = session.load()
+        session.invalidate()
+        self.failIf(sdo.is_valid())
+        self.failIf(session.key == 'k')
+        self.failUnless(session.is_new)
+        self.failUnless(session.rekeyed)
+        # a fresh session under the new key
+        self.failUnless(session.is_valid())
+        self.assertEqual(len(session), 0)
+        self.failIf(session.load() is sdo)
+
+    def test_unknown_key(self):
+        from repoze.session.memory import MemorySessionManagerFactory
+        from repoze.session.middleware import LazySession
+        session = LazySession(MemorySessionManagerFactory(), 'k', False)
+        session['a'] = 1
+        self.failIf(session.key == 'k')
+        self.failUnless(session.is_new)
+        self.failUnless(session.rekeyed)
+
+    def test_known_key(self):
+        from repoze.session.memory import MemorySessionManagerFactory
+        from repoze.session.middleware import LazySession
+        factory = MemorySessionManagerFactory()
+        import transaction
+        factory().get('k')['a'] = 1
+        transaction.commit()
+        session = LazySession(factory, 'k', False)
+        self.assertEqual(session['a'], 1)
+        self.assertEqual(session.key, 'k')
+        self.failIf(session.is_new)
+        self.failIf(session.rekeyed)
+
+    def test_finish_unloaded(self):
+        session = self._makeOne()
+        session.finish()
+        self.failIf(session.loaded)
+
+class TestNewKey(unittest.TestCase):
+    def test_it(self):
+        from repoze.session.middleware import new_key
+        key = new_key()
+        self.assertEqual(len(key), 32)
+        self.failIf(key == new_key())
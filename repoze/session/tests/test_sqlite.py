@@ -0,0 +1,383 @@
+import unittest
+
+from zope.component.testing import PlacelessSetup
+
+class SQLiteSessionDataManagerTests(unittest.TestCase, PlacelessSetup):
+    def setUp(self):
+        import tempfile
+        import transaction
+        transaction.abort()
+        PlacelessSetup.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.managers = []
+
+    def tearDown(self):
+        import shutil
+        import transaction
+        transaction.abort()
+        for manager in self.managers:
+            manager.close()
+        shutil.rmtree(self.tmpdir)
+        PlacelessSetup.tearDown(self)
+
+    def _getTargetClass(self):
+        from repoze.session.sqlite import SQLiteSessionDataManager
+        return SQLiteSessionDataManager
+
+    def _makeOne(self, timeout=60, period=5, **kw):
+        import os
+        klass = self._getTargetClass()
+        manager = klass(os.path.join(self.tmpdir, 'sessions.db'), timeout,
+                        period, **kw)
+        self.managers.append(manager)
+        return manager
+
+    def _registerHandler(self, iface):
+        import zope.component
+        gsm = zope.component.getGlobalSiteManager()
+        sessions = []
+        def handler(event):
+            sessions.append(event.session)
+        gsm.registerHandler(handler, (iface,))
+        return sessions
+
+    def test_class_conforms_to_ISessionDataManager(self):
+        from zope.interface.verify import verifyClass
+        from repoze.session.interfaces import ISessionDataManager
+        verifyClass(ISessionDataManager, self._getTargetClass())
+
+    def test_inst_conforms_to_ISessionDataManager(self):
+        from zope.interface.verify import verifyObject
+        from repoze.session.interfaces import ISessionDataManager
+        verifyObject(ISessionDataManager, self._makeOne())
+
+    def test_bad_table_name(self):
+        self.assertRaises(ValueError, self._makeOne, table='a; DROP')
+
+    def test_wal(self):
+        sdc = self._makeOne()
+        mode = sdc.connection().execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def test_set_query_and_has_key(self):
+        import transaction
+        sdc = self._makeOne()
+        self.assertEqual(sdc.has_key('foo'), False)
+        self.assertEqual(sdc.query('foo', 1), 1)
+        sdc.set('foo', 'bar')
+        self.assertEqual(sdc.query('foo'), 'bar')
+        transaction.commit()
+        self.assertEqual(sdc.has_key('foo'), True)
+        self.assertEqual(sdc.query('foo'), 'bar')
+        self.assertEqual(len(sdc), 1)
+
+    def test_set_aborted(self):
+        import transaction
+        sdc = self._makeOne()
+        sdc.set('foo', 'bar')
+        transaction.abort()
+        self.assertEqual(sdc.query('foo'), None)
+
+    def test_get_lazy(self):
+        import transaction
+        from repoze.session.interfaces import ISessionData
+        from repoze.session.interfaces import ISessionBeginEvent
+        begun = self._registerHandler(ISessionBeginEvent)
+        sdc = self._makeOne()
+        sdo = sdc.get('a')
+        self.failUnless(ISessionData.providedBy(sdo))
+        self.assertEqual(begun, [sdo])
+        self.assertEqual(sdc.query('a'), None)
+        sdo['b'] = 1
+        self.failUnless(sdc.query('a') is sdo)
+        transaction.commit()
+        self.assertEqual(dict(sdc.query('a')), {'b': 1})
+
+    def test_get_lazy_unmodified(self):
+        import transaction
+        sdc = self._makeOne()
+        sdc.get('a')
+        transaction.commit()
+        self.assertEqual(len(sdc), 0)
+
+    def test_same_object_within_transaction(self):
+        import transaction
+        sdc = self._makeOne()
+        sdc.get('a')['b'] = 1
+        transaction.commit()
+        first = sdc.get('a')
+        self.failUnless(sdc.get('a') is first)
+        transaction.commit()
+        self.failIf(sdc.get('a') is first)
+
+    def test_modification_only_writes(self):
+        import transaction
+        from repoze.session.stats import SessionStats
+        sdc = self._makeOne()
+        stats = sdc.stats = SessionStats()
+        sdc.get('a')['b'] = 1
+        transaction.commit()
+        sdc.get('a')
+        transaction.commit()
+        self.assertEqual(stats.get('head_writes'), 1)
+        sdc.get('a')['b'] = 2
+        transaction.commit()
+        self.assertEqual(stats.get('head_writes'), 2)
+        self.assertEqual(sdc.query('a')['b'], 2)
+
+    def test_invalidate_is_written(self):
+        import transaction
+        sdc = self._makeOne()
+        sdo = sdc.get('a')
+        sdo['b'] = 1
+        transaction.commit()
+        sdc.get('a').invalidate()
+        transaction.commit()
+        self.failIf(sdc.query('a').is_valid())
+        self.assertEqual(dict(sdc.get('a')), {})
+
+    def test_invalidate_then_get(self):
+        # logging out and getting a fresh session in one transaction
+        import transaction
+        sdc = self._makeOne()
+        sdc.get('a')['user'] = 'fred'
+        transaction.commit()
+        sdc.get('a').invalidate()
+        fresh = sdc.get('a')
+        self.assertEqual(dict(fresh), {})
+        transaction.commit()
+        self.failIf(sdc.query('a').is_valid())
+        # a modified fresh session replaces the invalidated one
+        sdc.get('a').invalidate()
+        sdc.get('a')['user'] = 'barney'
+        transaction.commit()
+        stored = sdc.query('a')
+        self.failUnless(stored.is_valid())
+        self.assertEqual(dict(stored), {'user': 'barney'})
+
+    def _concurrently(self, sdc, first, second):
+        # run 'first' and 'second' in transactions of their own, in
+        # two threads, committing 'first' before 'second'
+        import threading
+        import transaction
+        errors = []
+        def run(func):
+            try:
+                func()
+                transaction.commit()
+            except Exception as e:
+                errors.append(e)
+                transaction.abort()
+            sdc.close()
+        ready = threading.Event()
+        committed = threading.Event()
+        def second_thread():
+            second_func = second()
+            ready.set()
+            committed.wait()
+            run(second_func)
+        thread = threading.Thread(target=second_thread)
+        thread.start()
+        ready.wait()
+        run(first)
+        committed.set()
+        thread.join()
+        return errors
+
+    def test_concurrent_writes_conflict(self):
+        import transaction
+        from ZODB.POSException import ConflictError
+        sdc = self._makeOne()
+        sdc.get('a')['n'] = 0
+        transaction.commit()
+        sdc.close()
+        def first():
+            sdc.get('a')['n'] = 1
+        def second():
+            sdo = sdc.get('a') # read before 'first' commits
+            def write():
+                sdo['n'] = 2
+            return write
+        errors = self._concurrently(sdc, first, second)
+        self.assertEqual(len(errors), 1)
+        self.failUnless(isinstance(errors[0], ConflictError))
+        self.assertEqual(sdc.query('a')['n'], 1)
+
+    def test_concurrent_new_sessions_conflict(self):
+        from ZODB.POSException import ConflictError
+        sdc = self._makeOne()
+        def first():
+            sdc.get('a')['n'] = 1
+        def second():
+            sdo = sdc.get('a')
+            def write():
+                sdo['n'] = 2
+            return write
+        errors = self._concurrently(sdc, first, second)
+        self.assertEqual(len(errors), 1)
+        self.failUnless(isinstance(errors[0], ConflictError))
+        self.assertEqual(sdc.query('a')['n'], 1)
+
+    def test_new_session_replaces_expired_row(self):
+        import transaction
+        sdc = self._makeOne(30, 1, external_housekeeping=True)
+        sdc.set('a', 'a1', when=1)
+        transaction.commit()
+        sdc.get('a', when=40)['n'] = 1
+        transaction.commit()
+        self.assertEqual(dict(sdc.search('a', when=40)), {'n': 1})
+
+    def test_set_is_blind(self):
+        import transaction
+        sdc = self._makeOne()
+        sdc.get('a')['n'] = 1
+        transaction.commit()
+        sdc.query('a')
+        sdc2 = self._makeOne()
+        sdc2.set('a', 'replaced')
+        transaction.commit()
+        self.assertEqual(sdc.query('a'), 'replaced')
+
+    def test_adds_version_column(self):
+        import os
+        import sqlite3
+        import transaction
+        filename = os.path.join(self.tmpdir, 'sessions.db')
+        conn = sqlite3.connect(filename)
+        conn.execute('CREATE TABLE sessions (key PRIMARY KEY, '
+                     'slice INTEGER NOT NULL, data BLOB NOT NULL)')
+        conn.commit()
+        conn.close()
+        sdc = self._makeOne()
+        sdc.get('a')['n'] = 1
+        transaction.commit()
+        sdc.get('a')['n'] = 2
+        transaction.commit()
+        self.assertEqual(sdc.query('a')['n'], 2)
+
+    def test_touch(self):
+        import transaction
+        sdc = self._makeOne(30, 1)
+        sdc.set('a', 'a1', when=1)
+        transaction.commit()
+        self.assertEqual(sdc.search('a', when=5), 'a1')
+        transaction.commit()
+        row = sdc.connection().execute(
+            "SELECT slice FROM sessions WHERE key = 'a'").fetchone()
+        self.assertEqual(row[0], 5)
+
+    def test_touch_granularity(self):
+        import transaction
+        sdc = self._makeOne(30, 1, touch_granularity=3)
+        sdc.set('a', 'a1', when=1)
+        transaction.commit()
+        sdc.search('a', when=3)
+        transaction.commit()
+        select = "SELECT slice FROM sessions WHERE key = 'a'"
+        self.assertEqual(sdc.connection().execute(select).fetchone()[0], 1)
+        sdc.search('a', when=4)
+        transaction.commit()
+        self.assertEqual(sdc.connection().execute(select).fetchone()[0], 4)
+
+    def test_expiry(self):
+        import transaction
+        from repoze.session.interfaces import ISessionEndEvent
+        ended = self._registerHandler(ISessionEndEvent)
+        sdc = self._makeOne(30, 1)
+        sdc.set('a', 'a1', when=1)
+        sdc.set('b', 'b1', when=10)
+        transaction.commit()
+        self.assertEqual(sdc.search('b', when=32), 'b1')
+        self.assertEqual(ended, ['a1'])
+        self.assertEqual(len(sdc), 1)
+
+    def test_expiry_batch_event(self):
+        import transaction
+        import zope.component
+        from repoze.session.interfaces import ISessionEndEvent
+        from repoze.session.interfaces import ISessionsEndedEvent
+        ended = self._registerHandler(ISessionEndEvent)
+        batches = []
+        def handler(event):
+            batches.append(sorted(event.sessions))
+        zope.component.getGlobalSiteManager().registerHandler(
+            handler, (ISessionsEndedEvent,))
+        sdc = self._makeOne(30, 1)
+        sdc.set('a', 'a1', when=1)
+        sdc.set('b', 'b1', when=2)
+        transaction.commit()
+        self.assertEqual(sdc.housekeep(when=40), 2)
+        self.assertEqual(sorted(ended), ['a1', 'b1'])
+        self.assertEqual(batches, [['a1', 'b1']])
+
+    def test_expiry_unlistened_rows_not_unpickled(self):
+        import transaction
+        from repoze.session.sqlite import pickle
+        sdc = self._makeOne(30, 1)
+        sdc.set('a', 'a1', when=1)
+        transaction.commit()
+        loads = pickle.loads
+        def fail(data):
+            raise AssertionError('unpickled')
+        pickle.loads = fail
+        try:
+            self.assertEqual(sdc.housekeep(when=40), 1)
+        finally:
+            pickle.loads = loads
+
+    def test_expired_rows_are_invisible(self):
+        import transaction
+        sdc = self._makeOne(30, 1, external_housekeeping=True)
+        sdc.set('a', 'a1', when=1)
+        transaction.commit()
+        self.assertEqual(sdc.search('a', when=32), None)
+        self.assertEqual(len(sdc), 1)
+        self.assertEqual(sdc.housekeep(when=32), 1)
+        self.assertEqual(len(sdc), 0)
+
+    def test_shared_between_managers(self):
+        import transaction
+        sdc1 = self._makeOne()
+        sdc2 = self._makeOne()
+        sdc1.get('a')['b'] = 1
+        transaction.commit()
+        self.assertEqual(sdc2.query('a')['b'], 1)
+
+    def test_threads(self):
+        import threading
+        import transaction
+        sdc = self._makeOne()
+        def work(n):
+            for i in range(20):
+                sdc.get((n * 100) + i % 5)['n'] = i
+                transaction.commit()
+            sdc.close()
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(sdc), 20)
+        self.assertEqual(sdc.query(104)['n'], 19)
+
+class TestSQLiteSessionManagerFactory(unittest.TestCase):
+    def test_it(self):
+        import os
+        import shutil
+        import tempfile
+        from repoze.session.sqlite import SQLiteSessionDataManager
+        from repoze.session.sqlite import SQLiteSessionManagerFactory
+        tmpdir = tempfile.mkdtemp()
+        try:
+            factory = SQLiteSessionManagerFactory(
+                os.path.join(tmpdir, 'sessions.db'), 'myapp', timeout=60,
+                period=5, touch_granularity=2)
+            manager = factory()
+            self.failUnless(isinstance(manager, SQLiteSessionDataManager))
+            self.failUnless(factory() is manager)
+            self.assertEqual(manager.table, 'myapp')
+            self.assertEqual(manager.touch_granularity, 2)
+            manager.close()
+        finally:
+            shutil.rmtree(tmpdir)
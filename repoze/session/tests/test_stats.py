@@ -0,0 +1,104 @@
+import unittest
+
+class TestSessionStats(unittest.TestCase):
+    def _makeOne(self):
+        from repoze.session.stats import SessionStats
+        return SessionStats()
+
+    def test_incr_and_get(self):
+        stats = self._makeOne()
+        self.assertEqual(stats.get('a'), 0)
+        stats.incr('a')
+        stats.incr('a', 2)
+        self.assertEqual(stats.get('a'), 3)
+        self.assertEqual(stats.as_dict(), {'a': 3})
+
+    def test_incr_labeled(self):
+        stats = self._makeOne()
+        stats.incr_labeled('hits', 0)
+        stats.incr_labeled('hits', 0)
+        stats.incr_labeled('hits', 3, 5)
+        self.assertEqual(stats.get('hits', 0), 2)
+        self.assertEqual(stats.get('hits', 3), 5)
+        self.assertEqual(stats.get('hits', 1), 0)
+        self.assertEqual(stats.as_dict(), {'hits': {0: 2, 3: 5}})
+
+    def test_to_prometheus(self):
+        stats = self._makeOne()
+        stats.incr('misses', 4)
+        stats.incr_labeled('hits', 1)
+        stats.incr_labeled('hits', 0, 2)
+        stats.incr('custom')
+        self.assertEqual(stats.to_prometheus().splitlines(), [
+            '# HELP repoze_session_custom_total custom',
+            '# TYPE repoze_session_custom_total counter',
+            'repoze_session_custom_total 1',
+            '# HELP repoze_session_hits_total Sessions found, by depth of '
+            'the bucket they were found in (0 is the head bucket)',
+            '# TYPE repoze_session_hits_total counter',
+            'repoze_session_hits_total{depth="0"} 2',
+            'repoze_session_hits_total{depth="1"} 1',
+            '# HELP repoze_session_misses_total Searches which found no '
+            'session',
+            '# TYPE repoze_session_misses_total counter',
+            'repoze_session_misses_total 4',
+            ])
+
+    def test_to_prometheus_prefix(self):
+        stats = self._makeOne()
+        stats.incr('misses')
+        self.failUnless('myapp_misses_total 1' in
+                        stats.to_prometheus('myapp'))
+
+    def test_reset(self):
+        stats = self._makeOne()
+        stats.incr('a')
+        stats.reset()
+        self.assertEqual(stats.as_dict(), {})
+
+class TestEnableDisable(unittest.TestCase):
+    def tearDown(self):
+        from repoze.session import stats
+        stats.disable()
+
+    def test_enable_default(self):
+        from repoze.session import stats
+        from repoze.session.manager import SessionDataManager
+        self.assertEqual(stats.get(), None)
+        result = stats.enable()
+        self.failUnless(isinstance(result, stats.SessionStats))
+        self.failUnless(stats.get() is result)
+        self.failUnless(SessionDataManager.stats is result)
+        from repoze.session.data import SessionData
+        self.failUnless(SessionData.stats is result)
+
+    def test_enable_explicit_and_disable(self):
+        from repoze.session import stats
+        from repoze.session.manager import SessionDataManager
+        mine = stats.SessionStats()
+        self.failUnless(stats.enable(mine) is mine)
+        stats.disable()
+        self.assertEqual(SessionDataManager.stats, None)
+        self.assertEqual(stats.get(), None)
+
+    def test_not_persisted(self):
+        from repoze.session import stats
+        from repoze.session.manager import SessionDataManager
+        stats.enable()
+        manager = SessionDataManager(30, 1)
+        self.failIf('stats' in manager.__getstate__())
+
+    def test_data_conflicts(self):
+        from ZODB.POSException import ConflictError
+        from repoze.session import stats
+        from repoze.session.data import SessionData
+        counters = stats.enable()
+        sdo = SessionData()
+        sdo._p_resolveConflict({'data': {}}, {'_lm': 1, 'data': {'a': 1}},
+                               {'_lm': 2, 'data': {'b': 1}})
+        self.assertRaises(ConflictError, sdo._p_resolveConflict,
+                          {'data': {}}, {'_lm': 1, 'data': {'a': 1}},
+                          {'_lm': 2, 'data': {'a': 2}})
+        self.assertEqual(counters.as_dict(),
+                         {'conflicts_resolved': {'data': 1},
+                          'conflicts_raised': {'data': 1}})
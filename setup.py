@@ -27,6 +27,8 @@ install_requires = [
 
 testing_extras = ['nose', 'coverage']
 docs_extras = ['Sphinx']
+crypto_extras = ['cryptography']
+zeo_extras = ['ZEO >= 5']
 
 here = os.path.abspath(os.path.dirname(__file__))
 try:
@@ -67,9 +69,13 @@ setup(name='repoze.session',
       install_requires = install_requires,
       test_suite="repoze.session.tests",
       entry_points = """\
+      [console_scripts]
+      repoze-session-housekeep = repoze.session.housekeeping:main
       """,
       extras_require = {
           'testing':testing_extras,
           'docs':docs_extras,
+          'crypto':crypto_extras,
+          'zeo':zeo_extras,
           },
       )